@@ -8,7 +8,7 @@ from lily.deals.api.views import (DealViewSet, DealStatusViewSet, DealNextStepLi
                                   DealWhyCustomerViewSet, DealContactedByViewSet, DealWhyLostViewSet,
                                   DealFoundThroughViewSet)
 from lily.messaging.email.api.views import (EmailLabelViewSet, EmailAccountViewSet, EmailMessageViewSet,
-                                            EmailTemplateViewSet, SharedEmailConfigViewSet,
+                                            EmailTemplateViewSet, EmailThreadViewSet, SharedEmailConfigViewSet,
                                             TemplateVariableViewSet)
 from lily.notes.api.views import NoteViewSet
 from lily.provide.api.views import DataproviderView
@@ -36,6 +36,7 @@ router.register(r'deals/statuses', DealStatusViewSet)
 router.register(r'messaging/email/label', EmailLabelViewSet)
 router.register(r'messaging/email/account', EmailAccountViewSet)
 router.register(r'messaging/email/email', EmailMessageViewSet)
+router.register(r'messaging/email/thread', EmailThreadViewSet)
 router.register(r'messaging/email/emailtemplate', EmailTemplateViewSet)
 router.register(r'messaging/email/templatevariable', TemplateVariableViewSet)
 router.register(r'messaging/email/shared_email_config', SharedEmailConfigViewSet)
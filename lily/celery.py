@@ -1,10 +1,12 @@
 from __future__ import absolute_import
 
+import gc
 import os
 
 # Necessary for Celery to find iron_celery for transport ironmq://
 import iron_celery  # noqa
 from celery import Celery
+from celery.signals import task_postrun
 
 from django.conf import settings
 
@@ -17,3 +19,24 @@ app = Celery('lily', broker=settings.BROKER_URL)
 # pickle the object when using Windows.
 app.config_from_object('django.conf:settings')
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
+
+# Number of tasks this worker process ran since the last full garbage collection.
+_tasks_since_collect = 0
+
+
+@task_postrun.connect
+def collect_garbage(**kwargs):
+    """
+    Run a full garbage collection every WORKER_GC_TASK_INTERVAL tasks, instead of in the tasks themselves.
+
+    Python's generational collection still runs as usual, setting the interval to 0 disables the full collections.
+    """
+    global _tasks_since_collect
+
+    if not settings.WORKER_GC_TASK_INTERVAL:
+        return
+
+    _tasks_since_collect += 1
+    if _tasks_since_collect >= settings.WORKER_GC_TASK_INTERVAL:
+        _tasks_since_collect = 0
+        gc.collect()
@@ -2,8 +2,8 @@ from rest_framework import serializers
 
 from lily.api.fields import DynamicQuerySetPrimaryKeyRelatedField
 from lily.api.nested.mixins import RelatedSerializerMixin
-from ..models.models import (EmailLabel, EmailAccount, EmailMessage, Recipient, EmailAttachment, EmailTemplate,
-                             SharedEmailConfig, TemplateVariable, DefaultEmailTemplate)
+from ..models.models import (EmailLabel, EmailAccount, EmailMessage, EmailThread, Recipient, EmailAttachment,
+                             EmailTemplate, SharedEmailConfig, TemplateVariable, DefaultEmailTemplate)
 
 
 class SharedEmailConfigSerializer(serializers.ModelSerializer):
@@ -62,6 +62,32 @@ class EmailMessageSerializer(serializers.ModelSerializer):
         )
 
 
+class EmailThreadSerializer(serializers.ModelSerializer):
+    account = serializers.PrimaryKeyRelatedField(read_only=True)
+    participants = RecipientSerializer(many=True, read_only=True)
+
+    class Meta:
+        model = EmailThread
+        fields = (
+            'id',
+            'account',
+            'thread_id',
+            'subject',
+            'snippet',
+            'participants',
+            'last_message_date',
+            'message_count',
+            'unread_count',
+        )
+
+
+class EmailThreadDetailSerializer(EmailThreadSerializer):
+    messages = EmailMessageSerializer(many=True, read_only=True)
+
+    class Meta(EmailThreadSerializer.Meta):
+        fields = EmailThreadSerializer.Meta.fields + ('messages', )
+
+
 class EmailAccountSerializer(serializers.ModelSerializer):
     email_address = serializers.ReadOnlyField()
     labels = EmailLabelSerializer(many=True, read_only=True)
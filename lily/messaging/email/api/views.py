@@ -1,4 +1,5 @@
 import logging
+from django.conf import settings
 from django.db.models import Q
 from django.utils.translation import ugettext_lazy as _
 from rest_framework import viewsets, mixins, status, filters, serializers
@@ -8,20 +9,35 @@ from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet
 
 from lily.messaging.email.utils import get_email_parameter_api_dict
-from lily.search.lily_search import LilySearch
+from lily.search.indexing import update_queryset_in_index
 from lily.tenant.api.mixins import SetTenantUserMixin
 from lily.users.models import LilyUser
 
 from .serializers import (EmailLabelSerializer, EmailAccountSerializer, EmailMessageSerializer,
-                          EmailTemplateSerializer, SharedEmailConfigSerializer, TemplateVariableSerializer)
-from ..models.models import (EmailLabel, EmailAccount, EmailMessage, EmailTemplate, SharedEmailConfig,
+                          EmailTemplateSerializer, EmailThreadDetailSerializer, EmailThreadSerializer,
+                          SharedEmailConfigSerializer, TemplateVariableSerializer)
+from ..models.models import (EmailLabel, EmailAccount, EmailMessage, EmailTemplate, EmailThread, SharedEmailConfig,
                              TemplateVariable)
+from ..mutations import queue_label_mutations
+from ..search import EmailMessageMapping
 from ..tasks import (trash_email_message, delete_email_message, archive_email_message, toggle_read_email_message,
-                     add_and_remove_labels_for_message, toggle_star_email_message, mark_message_as_spam)
+                     mark_message_as_spam, unwatch_email_account)
+from ..templating import get_template_lookups, render_email_template
 
 
 logger = logging.getLogger(__name__)
 
+# Actions for the bulk endpoint with the labels they add and remove, archive, spam and move are handled separately.
+BULK_ACTIONS = {
+    'star': ([settings.GMAIL_LABEL_STARRED], []),
+    'unstar': ([], [settings.GMAIL_LABEL_STARRED]),
+    'read': ([], [settings.GMAIL_LABEL_UNREAD]),
+    'unread': ([settings.GMAIL_LABEL_UNREAD], []),
+    'archive': None,
+    'spam': None,
+    'move': None,
+}
+
 
 class EmailLabelViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = EmailLabel.objects.all()
@@ -86,6 +102,8 @@ class EmailAccountViewSet(mixins.DestroyModelMixin,
         if instance.owner_id is self.request.user.id:
             instance.is_deleted = True
             instance.save()
+            if settings.GMAIL_PUSH_TOPIC:
+                unwatch_email_account.apply_async(args=(instance.pk,))
         else:
             return Response(status=status.HTTP_403_FORBIDDEN)
 
@@ -213,11 +231,12 @@ class EmailMessageViewSet(mixins.RetrieveModelMixin,
         """
         email = self.get_object()
         serializer = self.get_serializer(email, partial=True)
-        add_and_remove_labels_for_message.delay(
-            email.id,
-            remove_labels=request.data['data'].get('remove_labels', []),
-            add_labels=request.data['data'].get('add_labels', []),
-        )
+        queue_label_mutations(email.account_id, {
+            email.message_id: (
+                request.data['data'].get('add_labels', []),
+                request.data['data'].get('remove_labels', []),
+            ),
+        })
         return Response(serializer.data)
 
     @detail_route(methods=['put'])
@@ -231,9 +250,9 @@ class EmailMessageViewSet(mixins.RetrieveModelMixin,
         serializer = self.get_serializer(email, partial=True)
 
         if request.data['starred']:
-            toggle_star_email_message.delay(email.id, star=True)
+            queue_label_mutations(email.account_id, {email.message_id: ([settings.GMAIL_LABEL_STARRED], [])})
         else:
-            toggle_star_email_message.delay(email.id, star=False)
+            queue_label_mutations(email.account_id, {email.message_id: ([], [settings.GMAIL_LABEL_STARRED])})
 
         return Response(serializer.data)
 
@@ -256,6 +275,62 @@ class EmailMessageViewSet(mixins.RetrieveModelMixin,
 
         return Response(serializer.data)
 
+    @list_route(methods=['put'])
+    def bulk(self, request):
+        """
+        Apply an action to multiple messages at once.
+
+        Accepts PUT dict with:
+            {
+                'ids': [<list of EmailMessage ids as ints>],
+                'action': <one of 'star', 'unstar', 'read', 'unread', 'archive', 'spam' or 'move'>,
+                'add_labels': [<list of label ids to add, only for move>],
+                'remove_labels': [<list of label ids to remove, only for move>],
+            }
+
+        The label changes are queued per email account and sent to Gmail in batches.
+
+        Returns:
+            ids of the changed messages
+        """
+        action = request.data.get('action')
+        if action not in BULK_ACTIONS:
+            raise serializers.ValidationError({'action': _('Unknown action')})
+
+        email_messages = self.get_queryset().filter(pk__in=request.data.get('ids', [])).prefetch_related('labels')
+
+        mutations = {}
+        for email_message in email_messages:
+            if action in ['archive', 'spam']:
+                # Archiving and marking as spam removes all current labels.
+                add_labels = [settings.GMAIL_LABEL_SPAM] if action == 'spam' else []
+                remove_labels = [label.label_id for label in email_message.labels.all()]
+            elif action == 'move':
+                add_labels = request.data.get('add_labels', [])
+                remove_labels = request.data.get('remove_labels', [])
+            else:
+                add_labels, remove_labels = BULK_ACTIONS[action]
+
+            mutations.setdefault(email_message.account_id, {})[email_message.message_id] = (add_labels, remove_labels)
+
+        pks = [email_message.pk for email_message in email_messages]
+        if action in ['archive', 'spam']:
+            # Make sure emails are removed instantly from the email list.
+            EmailMessage.objects.filter(pk__in=pks).update(is_removed=True)
+        elif action in ['read', 'unread']:
+            EmailMessage.objects.filter(pk__in=pks).update(read=(action == 'read'))
+            for email_account in EmailAccount.objects.filter(pk__in=mutations.keys()):
+                EmailThread.objects.update_unread_counts(email_account, EmailMessage.objects.filter(
+                    pk__in=pks,
+                    account=email_account,
+                ).values_list('thread_id', flat=True))
+        update_queryset_in_index(EmailMessage.objects.filter(pk__in=pks), EmailMessageMapping)
+
+        for account_id, account_mutations in mutations.items():
+            queue_label_mutations(account_id, account_mutations)
+
+        return Response({'ids': pks})
+
     @detail_route(methods=['get'])
     def history(self, request, pk):
         """
@@ -266,36 +341,30 @@ class EmailMessageViewSet(mixins.RetrieveModelMixin,
         account_email = email.account.email_address
         sent_from_account = (account_email == email.sender.email_address)
 
-        search = LilySearch(
-            request.user.tenant_id,
-            model_type='email_emailmessage',
-            sort='sent_date',
-        )
-
-        search.filter_query('thread_id:%s' % email.thread_id)
-        history, facets, total, took = search.do_search([
-            'message_id',
-            'received_by_email',
-            'received_by_cc_email',
-            'sender_email',
-            'sender_name',
-            'sent_date',
-        ])
-
-        try:
-            index = (key for key, item in enumerate(history) if item['message_id'] == email.message_id).next()
-        except StopIteration:
-            logger.exception('No history for message %s\nhistory:\n%s' % (email.id, history))
-            results = {
-                'history_size': 0,
-            }
-            return Response(results)
-
+        # Messages of a thread are looked up by the indexed thread_id, instead of searching for them. Like the
+        # search, this includes the messages of the thread in the other email accounts of the tenant.
+        thread_messages = EmailMessage.objects.filter(
+            account__tenant_id=request.user.tenant_id,
+            thread_id=email.thread_id,
+        ).select_related('sender').prefetch_related('received_by', 'received_by_cc').order_by('sent_date')
+        history = [{
+            'id': message.id,
+            'message_id': message.message_id,
+            'received_by_email': [recipient.email_address for recipient in message.received_by.all()
+                                  if recipient.email_address],
+            'received_by_cc_email': [recipient.email_address for recipient in message.received_by_cc.all()
+                                     if recipient.email_address],
+            'sender_email': message.sender.email_address,
+            'sender_name': message.sender.name,
+            'sent_date': message.sent_date,
+        } for message in thread_messages]
+
+        index = [item['id'] for item in history].index(email.id)
         messages_after = history[index + 1:]
 
         results = {
             'history': history,
-            'history_size': total,
+            'history_size': len(history),
         }
         if messages_after:
             if sent_from_account:
@@ -321,6 +390,27 @@ class EmailMessageViewSet(mixins.RetrieveModelMixin,
         return Response(results)
 
 
+class EmailThreadViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    EmailThread API, the detail includes the messages of the thread.
+    """
+    queryset = EmailThread.objects.all()
+    serializer_class = EmailThreadSerializer
+
+    # Set all filter backends that this viewset uses.
+    filter_backends = (DjangoFilterBackend,)
+    filter_fields = ('account__id', 'thread_id')
+
+    def get_queryset(self):
+        return EmailThread.objects.filter(account__tenant=self.request.user.tenant).prefetch_related('participants')
+
+    def get_serializer_class(self):
+        if self.action == 'retrieve':
+            return EmailThreadDetailSerializer
+
+        return super(EmailThreadViewSet, self).get_serializer_class()
+
+
 class EmailTemplateViewSet(SetTenantUserMixin, viewsets.ModelViewSet):
     """
     EmailTemplate API.
@@ -341,6 +431,61 @@ class EmailTemplateViewSet(SetTenantUserMixin, viewsets.ModelViewSet):
         """
         return super(EmailTemplateViewSet, self).get_queryset().all()
 
+    @detail_route(methods=['post'])
+    def render(self, request, pk=None):
+        """
+        Render the template for many recipients at once, e.g. for a mail merge.
+
+        The template is compiled once and the contacts and accounts are fetched with one query.
+
+        Accepts POST dict with:
+            {
+                'recipients': [{'contact_id': <int or null>, 'account_id': <int or null>}, ...],
+                'emailaccount_id': <optional id of the EmailAccount that sends the messages>
+            }
+
+        Returns:
+            list with the rendered template and template_subject for every recipient, in the same order
+        """
+        email_template = self.get_object()
+
+        recipients = request.data.get('recipients') or []
+        if len(recipients) > settings.EMAIL_TEMPLATE_BULK_RENDER_LIMIT:
+            raise serializers.ValidationError({
+                'recipients': _('Can\'t render for more than %s recipients at once') %
+                settings.EMAIL_TEMPLATE_BULK_RENDER_LIMIT
+            })
+
+        try:
+            recipients = [
+                (
+                    int(recipient['contact_id']) if recipient.get('contact_id') is not None else None,
+                    int(recipient['account_id']) if recipient.get('account_id') is not None else None,
+                )
+                for recipient in recipients
+            ]
+        except (AttributeError, TypeError, ValueError):
+            raise serializers.ValidationError({'recipients': _('Invalid recipients')})
+
+        try:
+            email_account = EmailAccount.objects.get(pk=int(request.data['emailaccount_id']))
+        except (KeyError, TypeError, ValueError, EmailAccount.DoesNotExist):
+            pass
+        else:
+            request.user.current_email_address = email_account.email_address
+
+        rendered = render_email_template(email_template, request.user, get_template_lookups(request.user, recipients))
+
+        return Response([
+            {
+                'contact_id': contact_id,
+                'account_id': account_id,
+                'template': body,
+                'template_subject': subject,
+            }
+            for (contact_id, account_id), (body, subject) in zip(recipients, rendered)
+        ])
+
 
 class TemplateVariableViewSet(mixins.DestroyModelMixin,
                               mixins.RetrieveModelMixin,
@@ -1,4 +1,5 @@
-import gc
+import weakref
+
 from django.db import IntegrityError
 
 from ..models.models import EmailLabel
@@ -11,7 +12,8 @@ class LabelBuilder(object):
 
     def __init__(self, manager):
         self.label = None
-        self.manager = manager
+        # The manager refers to the builder, a weak reference back prevents a reference cycle.
+        self.manager = weakref.proxy(manager)
 
     def get_or_create_label(self, label_dict):
         """
@@ -45,7 +47,6 @@ class LabelBuilder(object):
         # Name could have changed, always set the name
         self.label.name = label_dict['name']
         self.label.save()
-        gc.collect()
         return self.label, created
 
     def cleanup(self):
@@ -1,26 +1,99 @@
 import base64
+import codecs
 import datetime
 import email
-import gc
+import hashlib
 import logging
 import re
-import StringIO
+import tempfile
+import weakref
 
-from bs4 import BeautifulSoup, UnicodeDammit
+from bs4 import UnicodeDammit
 from dateutil.parser import parse
 from django.conf import settings
 from django.core.files import File
 from django.db import transaction, IntegrityError
 import pytz
 
+from lily.celery import app
+from lily.search.indexing import update_queryset_in_index
 from python_imap.utils import get_extensions_for_type
 
-from ..models.models import EmailMessage, EmailHeader, Recipient, EmailAttachment, NoEmailMessageId
+from ..models.models import (EmailMessage, EmailHeader, Recipient, EmailAttachment, NoEmailMessageId,
+                             UnreferencedAttachmentFile)
+from ..mutations import queue_thread_updates
+from ..search import EmailMessageMapping
+from ..utils import decode_base64url_to_file, deduplicate_attachments
 
 
 logger = logging.getLogger(__name__)
 
 
+# Charset declared in the first part of a html document, e.g. <meta charset="utf-8"> or
+# <meta http-equiv="Content-Type" content="text/html; charset=iso-8859-1">.
+META_CHARSET_RE = re.compile(r'<meta[^>]+charset\s*=\s*["\']?\s*([-\w.:]+)', re.IGNORECASE)
+META_CHARSET_SNIFF_SIZE = 4096
+
+BOM_ENCODINGS = (
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+
+
+def _decode(body, encoding):
+    try:
+        return body.decode(encoding)
+    except (LookupError, UnicodeDecodeError):
+        return None
+
+
+def decode_message_body(body, encoding=None, is_html=False):
+    """
+    Decode a body part of a message, without parsing it.
+
+    The encoding from the headers is tried first, then a BOM, the charset of a html meta tag and utf-8.
+    Only when all of those fail, UnicodeDammit has to guess the encoding.
+
+    Args:
+        body (string): not decoded body
+        encoding (string, optional): encoding from the headers
+        is_html (boolean, optional): True if the body is html
+
+    Returns:
+        unicode: the decoded body or None if the body couldn't be decoded
+    """
+    if encoding:
+        decoded_body = _decode(body, encoding)
+        if decoded_body is not None:
+            return decoded_body
+
+    for bom, bom_encoding in BOM_ENCODINGS:
+        if body.startswith(bom):
+            decoded_body = _decode(body, bom_encoding)
+            if decoded_body is not None:
+                return decoded_body
+
+    if is_html:
+        match = META_CHARSET_RE.search(body, 0, META_CHARSET_SNIFF_SIZE)
+        if match:
+            decoded_body = _decode(body, match.group(1).lower())
+            if decoded_body is not None:
+                return decoded_body
+
+    decoded_body = _decode(body, 'utf-8')
+    if decoded_body is not None:
+        return decoded_body
+
+    dammit = UnicodeDammit(body, is_html=is_html)
+    return dammit.unicode_markup
+
+
+# Fields of an EmailMessage that are updated from Gmail, when a new message turns out to be stored already.
+UPSERT_FIELDS = ('body_html', 'body_html_sanitized', 'body_text', 'has_attachment', 'read', 'sanitize_version',
+                 'sender', 'sent_date', 'snippet', 'subject', 'thread_id')
+
+
 class MessageBuilderException(Exception):
     pass
 
@@ -34,21 +107,26 @@ class MessageBuilder(object):
     Builder to get, create or update Messages
     """
     def __init__(self, manager):
-        self.manager = manager
+        # The manager refers to the builder, a weak reference back prevents a reference cycle.
+        self.manager = weakref.proxy(manager)
         self.message = None
         self.labels = []
         self.headers = []
+        self.sender = None
         self.received_by = None
         self.received_by_cc = None
         self.attachments = []
         self.inline_attachments = {}
+        self.bulk_messages = []
 
-    def get_or_create_message(self, message_dict):
+    def get_or_create_message(self, message_dict, create=False):
         """
         Get or create Message.
 
         Arguments:
             message_dict (dict): with label information
+            create (boolean, optional): if True, the message is known to be new and isn't looked up. When another
+                worker stores the message in the meantime, save updates it instead.
 
         Returns:
             message (instance): unsaved message
@@ -58,59 +136,62 @@ class MessageBuilder(object):
         self.message = None
         self.labels = []
         self.headers = []
+        self.sender = None
         self.received_by = set()
         self.received_by_cc = set()
         self.attachments = []
         self.inline_attachments = {}
 
-        # Prevent memory leaks
-        gc.collect()
-
         # Get or create without save
         created = False
-        with transaction.atomic():
+        if not create:
             try:
                 self.message = EmailMessage.objects.get(
                     message_id=message_dict['id'],
                     account=self.manager.email_account,
                 )
             except EmailMessage.DoesNotExist:
-                self.message = EmailMessage(
-                    message_id=message_dict['id'],
-                    account=self.manager.email_account,
-                )
-                created = True
+                create = True
+
+        if create:
+            self.message = EmailMessage(
+                message_id=message_dict['id'],
+                account=self.manager.email_account,
+            )
+            created = True
 
         if 'threadId' in message_dict:
             self.message.thread_id = message_dict['threadId']
 
         return self.message, created
 
-    def store_message_info(self, message_info, message_id):
+    def store_message_info(self, message_info, message_id, create=False):
         """
         With given dict, create or update current message
 
         Args:
             message_info (dict): with message info
             message_id (string): message_id of email
+            create (boolean, optional): if True, the message is known to be new, see get_or_create_message
         """
         # Save labels
-        self.store_labels_and_thread_for_message(message_info, message_id)
+        self.store_labels_and_thread_for_message(message_info, message_id, create)
 
         self.message.snippet = message_info['snippet']
 
         # Save the payload
         self._save_message_payload(message_info['payload'])
 
-    def store_labels_and_thread_for_message(self, message_info, message_id):
+    def store_labels_and_thread_for_message(self, message_info, message_id, create=False):
         """
         Handle the labels and thread_id for current EmailMessage
 
         Args:
             message_info (dict): message info dict
             message_id (string): message_id of email
+            create (boolean, optional): if True, the message is known to be new, see get_or_create_message
         """
-        self.get_or_create_message({'id': message_id})
+        self.get_or_create_message({'id': message_id}, create)
         self.message.thread_id = message_info['threadId']
 
         # UNREAD identifier check to see if message is read
@@ -145,6 +226,9 @@ class MessageBuilder(object):
         else:
             self._parse_message_part(payload)
 
+        # Sanitize once while syncing, instead of every time the message is opened.
+        self.message.sanitize_body()
+
     def _create_message_headers(self, headers):
         """
         Given header dict, create EmailHeaders for message.
@@ -257,52 +341,70 @@ class MessageBuilder(object):
         if headers and headers.get('content-id', False):
             inline = True
 
-        # Get file data from part or from remote
-        if 'data' in part['body']:
-            file_data = part['body']['data']
-        elif 'attachmentId' in part['body']:
-            file_data = self.manager.get_attachment(self.message.message_id, part['body']['attachmentId'])
-            if file_data:
-                file_data = file_data.get('data')
-            else:
-                logger.warning('No attachment could be downloaded, not storing anything')
-                return
-        else:
-            logger.warning('No attachment, not storing anything')
-            return
-
-        file_data = base64.urlsafe_b64decode(file_data.encode('UTF-8'))
-
-        # create as string file
-        file = StringIO.StringIO(file_data)
         if headers and 'content-type' in headers:
-            file.content_type = headers['content-type'].split(';')[0]
+            content_type = headers['content-type'].split(';')[0]
         else:
-            file.content_type = 'application/octet-stream'
+            content_type = 'application/octet-stream'
 
-        file.size = len(file_data)
-        file.name = part.get('filename', '').rsplit('\\')[-1]
-        if len(file.name) > 200:
-            file.name = None
+        file_name = part.get('filename', '').rsplit('\\')[-1]
+        if len(file_name) > 200:
+            file_name = None
 
         # No filename in part, create a name
-        if not file.name:
-            extensions = get_extensions_for_type(file.content_type)
+        if not file_name:
+            extensions = get_extensions_for_type(content_type)
             if part.get('partId'):
-                file.name = 'attachment-%s%s' % (part.get('partId'), extensions.next())
+                file_name = 'attachment-%s%s' % (part.get('partId'), extensions.next())
             else:
                 logger.warning('No part id, no filename')
-                file.name = 'attachment-%s-%s' % (
+                file_name = 'attachment-%s-%s' % (
                     len(self.attachments) + len(self.inline_attachments),
                     extensions.next()
                 )
 
-        final_file = File(file, file.name)
+        attachment_id = part['body'].get('attachmentId')
+        if attachment_id and settings.GMAIL_LAZY_ATTACHMENTS and not (
+                inline and settings.GMAIL_PREFETCH_INLINE_ATTACHMENTS):
+            # Only store the metadata, the file is downloaded when it's requested for the first time.
+            final_file = file_name
+            size = part['body'].get('size', 0)
+            content_hash = ''
+        else:
+            # Get file data from part or from remote
+            if 'data' in part['body']:
+                file_data = part['body']['data']
+            elif attachment_id:
+                response = self.manager.get_attachment(self.message.message_id, attachment_id)
+                if response:
+                    file_data = response.pop('data')
+                    del response
+                else:
+                    logger.warning('No attachment could be downloaded, not storing anything')
+                    return
+            else:
+                logger.warning('No attachment, not storing anything')
+                return
+
+            # Decode to a temporary file, which is only kept in memory for small attachments. The file is
+            # uploaded to the storage when the attachment is saved.
+            file = tempfile.SpooledTemporaryFile(max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE)
+            digest = hashlib.sha256()
+            size = decode_base64url_to_file(file_data, file, digest)
+            del file_data
+
+            final_file = File(file, file_name)
+            final_file.size = size
+            final_file.content_type = content_type
+            attachment_id = ''
+            content_hash = digest.hexdigest()
 
         # Create a EmailAttachment object
         attachment = EmailAttachment()
         attachment.attachment = final_file
-        attachment.size = file.size
+        attachment.attachment_id = attachment_id
+        attachment.content_hash = content_hash
+        attachment.content_type = content_type
+        attachment.size = size
         attachment.inline = inline
         attachment.tenant_id = self.manager.email_account.tenant_id
 
@@ -320,34 +422,14 @@ class MessageBuilder(object):
             body (string): not encoded string
             encoding (string): possible encoding type
         """
-        decoded_body = None
-
-        # Use given encoding type
-        if encoding:
-            try:
-                decoded_body = body.decode(encoding)
-            except (LookupError, UnicodeDecodeError):
-                pass
-
-        # BS4 decoding second
-        if not decoded_body:
-            soup = BeautifulSoup(body, 'lxml', from_encoding='utf-8')
-            if soup.original_encoding:
-                encoding = soup.original_encoding
-                try:
-                    decoded_body = body.decode(encoding)
-                except (LookupError, UnicodeDecodeError):
-                    pass
-
-        # If decoding fails, just force utf-8
-        if not decoded_body and body:
+        decoded_body = decode_message_body(body, encoding, is_html=True)
+        if decoded_body is None:
             logger.warning('couldn\'t decode, forced utf-8 > %s' % self.message.message_id)
-            encoding = 'utf-8'
-            decoded_body = body.decode(encoding, errors='replace')
+            decoded_body = body.decode('utf-8', 'replace')
 
         # Only add if there is a body
         if decoded_body:
-            self.message.body_html += decoded_body.encode(encoding).decode('utf-8')
+            self.message.body_html += decoded_body
 
     def _create_body_text(self, body, encoding=None):
         """
@@ -357,33 +439,13 @@ class MessageBuilder(object):
             body (string): not encoded string
             encoding (string): possible encoding type
         """
-        decoded_body = None
-
-        # Use given encoding type
-        if encoding:
-            try:
-                decoded_body = body.decode(encoding)
-            except (LookupError, UnicodeDecodeError):
-                pass
-
-        # UnicodeDammit decoding second
-        if not decoded_body:
-            dammit = UnicodeDammit(body)
-            if dammit.original_encoding:
-                encoding = dammit.original_encoding
-                try:
-                    decoded_body = body.decode(encoding)
-                except (LookupError, UnicodeDecodeError):
-                    pass
-
-        # If decoding fails, just force utf-8
-        if not decoded_body and body:
+        decoded_body = decode_message_body(body, encoding)
+        if decoded_body is None:
             logger.warning('couldn\'t decode, forced utf-8 > %s' % self.message.message_id)
-            encoding = 'utf-8'
-            decoded_body = body.decode(encoding, errors='replace')
+            decoded_body = body.decode('utf-8', 'replace')
 
         if decoded_body:
-            self.message.body_text += decoded_body.encode(encoding).decode('utf-8')
+            self.message.body_text += decoded_body
 
     def _create_recipients(self, header_name, header_value):
         """
@@ -418,42 +480,84 @@ class MessageBuilder(object):
                         email_address
                     ))
             else:
-                recipient = Recipient.objects.get_or_create(
-                    name=email_address[0],
-                    email_address=email_address[1],
-                )[0]
+                # Recipients are fetched or created when the message is saved.
+                recipient = (email_address[0], email_address[1])
 
                 # Set recipient to correct field
                 if header_name == 'from':
-                    self.message.sender = recipient
+                    self.sender = recipient
                 elif header_name in ['to', 'delivered-to']:
                     self.received_by.add(recipient)
                 elif header_name == 'cc':
                     self.received_by_cc.add(recipient)
 
+    def _get_or_create_recipients(self, addresses):
+        """
+        Get or create the Recipients for the addresses with one query and one bulk insert.
+
+        Args:
+            addresses (set): of (name, email_address) tuples
+
+        Returns:
+            dict with (name, email_address): Recipient instance
+        """
+        if not addresses:
+            return {}
+
+        email_addresses = set(address[1] for address in addresses)
+
+        def get_recipients():
+            recipients = {}
+            for recipient in Recipient.objects.filter(email_address__in=email_addresses):
+                key = (recipient.name, recipient.email_address)
+                if key in addresses:
+                    recipients[key] = recipient
+            return recipients
+
+        recipients = get_recipients()
+        missing_addresses = addresses - set(recipients.keys())
+        if missing_addresses:
+            try:
+                with transaction.atomic():
+                    Recipient.objects.bulk_create([
+                        Recipient(name=name, email_address=email_address)
+                        for name, email_address in missing_addresses
+                    ])
+            except IntegrityError:
+                # Another worker created some of the recipients in the meantime.
+                for name, email_address in missing_addresses:
+                    Recipient.objects.get_or_create(name=name, email_address=email_address)
+
+            # Bulk create doesn't set the primary keys, so fetch them.
+            recipients = get_recipients()
+
+        return recipients
+
     def save(self):
         # Only save if there is a sent date, otherwise its a chat message
-        if self.message.sent_date and self.message.sender_id:
+        if self.message.sent_date and (self.sender or self.message.sender_id):
+            recipients = self._get_or_create_recipients(
+                self.received_by | self.received_by_cc | (set([self.sender]) if self.sender else set())
+            )
+            if self.sender:
+                self.message.sender = recipients[self.sender]
 
             # Check for attachments
             if self.attachments or self.inline_attachments:
                 self.message.has_attachment = True
 
-            if not self.message.pk:
-                # Save before we can add many to many and foreign keys
-                try:
-                    self.message.save()
-                except IntegrityError:
-                    existing_message = EmailMessage.objects.get(
-                        account_id=self.message.account_id,
-                        message_id=self.message.message_id,
-                    )
-                    self.message.id = existing_message.id
-                    self.message.save()
+            existing = bool(self.message.pk)
+            if not existing:
+                # Save before we can add many to many and foreign keys. Another worker may have stored the
+                # message in the meantime, then it's updated instead.
+                update_fields = list(UPSERT_FIELDS)
+                if self.message.draft_id:
+                    update_fields.append('draft_id')
+                existing = not EmailMessage.objects.upsert(self.message, update_fields)
 
             # Save recipients
-            self.message.received_by.add(*self.received_by)
-            self.message.received_by_cc.add(*self.received_by_cc)
+            self.message.received_by.add(*[recipients[address] for address in self.received_by])
+            self.message.received_by_cc.add(*[recipients[address] for address in self.received_by_cc])
 
             # Save labels
             if len(self.labels):
@@ -473,9 +577,16 @@ class MessageBuilder(object):
             if len(self.attachments):
                 self.message.attachments.all().delete()
 
+            deduplicate_attachments(self.attachments)
             self.message.attachments.add(*self.attachments)
 
-            self.message.save()
+            if existing:
+                self.message.save()
+
+            queue_thread_updates(self.manager.email_account.id, [self.message.thread_id])
+
+            if not existing:
+                self._prerender_bodies([self.message])
         else:
             logger.debug('No emailmessage, storing empty ID')
             NoEmailMessageId.objects.get_or_create(
@@ -483,6 +594,192 @@ class MessageBuilder(object):
                 account=self.manager.email_account
             )
 
+    def add_to_bulk(self):
+        """
+        Keep the current message, so it's saved together with other messages by save_bulk.
+        """
+        self.bulk_messages.append({
+            'message': self.message,
+            'labels': self.labels,
+            'headers': self.headers,
+            'sender': self.sender,
+            'received_by': self.received_by,
+            'received_by_cc': self.received_by_cc,
+            'attachments': self.attachments,
+            'inline_attachments': self.inline_attachments,
+        })
+
+    def _load_from_bulk(self, bulk_message):
+        """
+        Make a message kept by add_to_bulk the current message.
+
+        Args:
+            bulk_message (dict): message state as stored by add_to_bulk
+        """
+        for attribute, value in bulk_message.items():
+            setattr(self, attribute, value)
+
+    def save_bulk(self):
+        """
+        Save all messages kept by add_to_bulk.
+
+        New messages, their recipients, headers, labels and attachments are inserted with a handful of bulk
+        queries. Existing messages, chat messages or messages that were saved by another worker in the meantime
+        are saved one by one with save.
+        """
+        bulk_messages, self.bulk_messages = self.bulk_messages, []
+
+        new_messages = []
+        for bulk_message in bulk_messages:
+            message = bulk_message['message']
+            if message.sent_date and bulk_message['sender'] and not message.pk:
+                new_messages.append(bulk_message)
+            else:
+                self._load_from_bulk(bulk_message)
+                self.save()
+
+        if not new_messages:
+            return
+
+        addresses = set()
+        for bulk_message in new_messages:
+            addresses.add(bulk_message['sender'])
+            addresses.update(bulk_message['received_by'])
+            addresses.update(bulk_message['received_by_cc'])
+        recipients = self._get_or_create_recipients(addresses)
+
+        attachments = []
+        for bulk_message in new_messages:
+            message = bulk_message['message']
+            message.sender = recipients[bulk_message['sender']]
+            message.has_attachment = bool(bulk_message['attachments'] or bulk_message['inline_attachments'])
+            attachments.extend(bulk_message['attachments'])
+
+        # The files are uploaded to the storage when the attachments are inserted, unless they're stored already.
+        deduplicate_attachments(attachments)
+        uploads = [attachment for attachment in attachments if not attachment.attachment._committed]
+
+        try:
+            # The messages are only kept together with all their rows, a retry can't repair half saved messages.
+            with transaction.atomic():
+                message_pks = self._bulk_create_new_messages(new_messages, recipients)
+        except IntegrityError:
+            self._rollback_bulk(new_messages, uploads)
+
+            # Some messages were saved by another worker in the meantime.
+            for bulk_message in new_messages:
+                self._load_from_bulk(bulk_message)
+                self.save()
+            return
+        except Exception:
+            self._rollback_bulk(new_messages, uploads)
+            raise
+
+        # Bulk inserts don't send signals, so index the new messages at once.
+        update_queryset_in_index(EmailMessage.objects.filter(pk__in=message_pks.values()), EmailMessageMapping)
+
+        queue_thread_updates(
+            self.manager.email_account.id,
+            [bulk_message['message'].thread_id for bulk_message in new_messages],
+        )
+
+        self._prerender_bodies([bulk_message['message'] for bulk_message in new_messages])
+
+    def _prerender_bodies(self, messages):
+        """
+        Queue a task to fill the render cache with the html bodies of new messages, if EMAIL_BODY_PRERENDER is set.
+
+        Args:
+            messages (list): saved EmailMessage instances
+        """
+        pks = [message.pk for message in messages if message.body_html]
+        if settings.EMAIL_BODY_PRERENDER and pks:
+            app.send_task('cache_email_bodies', args=[pks])
+
+    def _bulk_create_new_messages(self, new_messages, recipients):
+        """
+        Insert new messages kept by add_to_bulk with their labels, recipients, headers and attachments.
+
+        Args:
+            new_messages (list): message states as stored by add_to_bulk, of messages that aren't stored yet
+            recipients (dict): with email address: Recipient instance, for all addresses of the messages
+
+        Returns:
+            dict with message_id: pk of the inserted messages
+        """
+        EmailMessage.objects.bulk_create([bulk_message['message'] for bulk_message in new_messages])
+
+        # Bulk create doesn't set the primary keys, so fetch them.
+        message_pks = dict(EmailMessage.objects.filter(
+            account=self.manager.email_account,
+            message_id__in=[bulk_message['message'].message_id for bulk_message in new_messages],
+        ).values_list('message_id', 'pk'))
+
+        label_rows = set()
+        received_by_rows = set()
+        received_by_cc_rows = set()
+        headers = []
+        attachments = []
+        for bulk_message in new_messages:
+            message = bulk_message['message']
+            message.pk = message_pks[message.message_id]
+
+            label_rows.update((message.pk, label.pk) for label in bulk_message['labels'])
+            received_by_rows.update((message.pk, recipients[address].pk) for address in bulk_message['received_by'])
+            received_by_cc_rows.update(
+                (message.pk, recipients[address].pk) for address in bulk_message['received_by_cc']
+            )
+
+            for header in bulk_message['headers']:
+                header.message = message
+                headers.append(header)
+
+            for attachment in bulk_message['attachments']:
+                attachment.message = message
+                attachments.append(attachment)
+
+        self._bulk_create_m2m_rows('labels', label_rows)
+        self._bulk_create_m2m_rows('received_by', received_by_rows)
+        self._bulk_create_m2m_rows('received_by_cc', received_by_cc_rows)
+        EmailHeader.objects.bulk_create(headers)
+        EmailAttachment.objects.bulk_create(attachments)
+
+        return message_pks
+
+    def _rollback_bulk(self, new_messages, uploads):
+        """
+        Forget the state of a bulk insert that was rolled back.
+
+        Args:
+            new_messages (list): message states as stored by add_to_bulk
+            uploads (list): EmailAttachment instances whose files were uploaded during the insert
+        """
+        for bulk_message in new_messages:
+            bulk_message['message'].pk = None
+
+        # The files of the attachments were uploaded before the rollback, they're deleted unless they're used again.
+        UnreferencedAttachmentFile.objects.bulk_create([
+            UnreferencedAttachmentFile(name=attachment.attachment.name)
+            for attachment in uploads if attachment.attachment._committed
+        ])
+
+    def _bulk_create_m2m_rows(self, field_name, rows):
+        """
+        Insert rows in the through table of a many to many field of EmailMessage.
+
+        Args:
+            field_name (string): name of the many to many field
+            rows (iterable): of (message pk, related pk) tuples
+        """
+        field = EmailMessage._meta.get_field(field_name)
+        through = field.rel.through
+        source_field_name = '%s_id' % field.m2m_field_name()
+        target_field_name = '%s_id' % field.m2m_reverse_field_name()
+
+        through.objects.bulk_create([
+            through(**{source_field_name: source_id, target_field_name: target_id}) for source_id, target_id in rows
+        ])
+
     def _get_encoding_from_headers(self, headers):
         """
         Try to find encoding from headers
@@ -523,7 +820,9 @@ class MessageBuilder(object):
         self.message = None
         self.labels = []
         self.headers = []
+        self.sender = None
         self.received_by = None
         self.received_by_cc = None
         self.attachments = []
         self.inline_attachments = {}
+        self.bulk_messages = []
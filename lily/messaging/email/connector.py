@@ -5,13 +5,19 @@ import time
 import anyjson
 from django.conf import settings
 from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaInMemoryUpload
+from googleapiclient.http import MediaIoBaseUpload
 
 from .credentials import get_credentials, InvalidCredentialsError
-from .services import build_gmail_service
+from .ratelimit import gmail_rate_limiter
+from .services import gmail_service_cache
 
 logger = logging.getLogger(__name__)
 
+# Gmail doesn't accept more than 100 calls in a single batch request.
+GMAIL_MAX_BATCH_SIZE = 100
+# Gmail doesn't accept more than 1000 message ids in a single batchModify call.
+GMAIL_MAX_BATCH_MODIFY_SIZE = 1000
+
 
 class FailedServiceCallException(Exception):
     pass
@@ -33,11 +39,33 @@ class LabelNotFoundError(ConnectorError):
     pass
 
 
+class RateLimitError(ConnectorError):
+    """
+    Raised instead of sleeping when the rate limit for the account is reached.
+
+    Attributes:
+        countdown (float): seconds before the call should be tried again
+    """
+    def __init__(self, countdown):
+        super(RateLimitError, self).__init__('Rate limited, try again in %s seconds' % countdown)
+        self.countdown = countdown
+
+
 class GmailConnector(object):
     service = None
+    service_entry = None
 
-    def __init__(self, email_account):
+    def __init__(self, email_account, defer_rate_limits=False):
+        """
+        Args:
+            email_account (instance): EmailAccount instance
+            defer_rate_limits (boolean, optional): if True, raise RateLimitError instead of sleeping when the
+                rate limit for the account is reached
+        """
         self.email_account = email_account
+        self.defer_rate_limits = defer_rate_limits
+        # Seconds before deferred calls should be tried again, set when a call was deferred.
+        self.deferred_countdown = None
         self.history_id = self.email_account.history_id
 
         self.service = self.create_service()
@@ -45,53 +73,143 @@ class GmailConnector(object):
     def create_service(self):
         """
         Get or create GMail api service
+
+        The service is taken from the process wide service cache and handed back on cleanup.
         """
         try:
-            credentials = get_credentials(self.email_account)
+            self.service_entry = gmail_service_cache.acquire(self.email_account, get_credentials)
         except InvalidCredentialsError:
             logger.exception('cannot sync account, no valid credentials')
             raise
         else:
-            return build_gmail_service(credentials)
+            return self.service_entry[0]
+
+    def parse_http_error(self, http_error):
+        """
+        Unwrap the error dict from a HttpError returned by the Gmail api.
+
+        Args:
+            http_error (instance): HttpError instance
+
+        Returns:
+            dict with error info
+        """
+        try:
+            error = anyjson.loads(http_error.content)
+            # Error could be nested, so unwrap if necessary.
+            error = error.get('error', error)
+        except ValueError:
+            logger.exception('error %s' % http_error)
+            error = {}
+
+        return error
 
-    def execute_service_call(self, service):
+    def is_rate_limit_error(self, error):
+        """
+        Check if the error is caused by exceeding the rate limit of the user.
+
+        Args:
+            error (dict): error info from parse_http_error
+
+        Returns:
+            boolean: True if the call should be retried later
+        """
+        reason = error.get('errors', [{}])[0].get('reason')
+        if error.get('code') == 403 and reason in ['rateLimitExceeded', 'userRateLimitExceeded']:
+            return True
+
+        return error.get('code') == 429
+
+    def is_retryable_error(self, error):
+        """
+        Check if the error is caused by a rate limit or a backend error, so the call can be tried again.
+
+        Args:
+            error (dict): error info from parse_http_error
+
+        Returns:
+            boolean: True if the call should be retried with backoff
+        """
+        return self.is_rate_limit_error(error) or error.get('code') in [500, 503]
+
+    def defer(self, countdown):
+        """
+        Remember that calls were deferred because of the rate limit.
+
+        Args:
+            countdown (float): seconds before the calls should be tried again
+
+        Returns:
+            RateLimitError instance
+        """
+        self.deferred_countdown = max(countdown, self.deferred_countdown or 0)
+        return RateLimitError(countdown)
+
+    def wait_for_rate_limit(self, tokens=1):
+        """
+        Take tokens from the rate limiter shared by all workers, before calling the api.
+
+        Args:
+            tokens (int, optional): number of api calls
+
+        Raises:
+            RateLimitError: if the calls have to wait and the connector defers rate limits
+        """
+        wait = gmail_rate_limiter.acquire(self.email_account.id, tokens)
+        while wait > 0:
+            if self.defer_rate_limits:
+                raise self.defer(wait)
+
+            logger.debug('Rate limited, sleeping for %s seconds' % wait)
+            time.sleep(wait)
+            wait = gmail_rate_limiter.acquire(self.email_account.id, tokens)
+
+    def get_backoff_time(self, n):
+        """
+        Calculate the exponential backoff time for the given attempt.
+
+        Args:
+            n (int): number of the attempt
+
+        Returns:
+            float: seconds to sleep
+        """
+        return (2 ** n) + random.randint(0, 1000) / 1000
+
+    def execute_service_call(self, service, tokens=1):
         """
         Try to execute a service call.
 
-        If the call fails because the rate limit is exceeded, sleep x seconds to try again.
+        If the call fails because the rate limit is exceeded, the rate for the account is lowered for all
+        workers. When the connector defers rate limits a RateLimitError is raised, so the task can be retried
+        later, otherwise sleep x seconds to try again.
 
         Args:
             service (instance): service instance
+            tokens (int, optional): number of api calls done by the service instance
         Returns:
             response from service instance
         """
         for n in range(0, 6):
+            self.wait_for_rate_limit(tokens)
+
             try:
                 return service.execute()
             except HttpError as e:
-                try:
-                    error = anyjson.loads(e.content)
-                    # Error could be nested, so unwrap if necessary.
-                    error = error.get('error', error)
-                except ValueError:
-                    logger.exception('error %s' % e)
-                    error = e
-
-                if error.get('code') == 403 and error.get('errors')[0].get('reason') in ['rateLimitExceeded',
-                                                                                         'userRateLimitExceeded']:
-                    # Apply exponential backoff.
-                    sleep_time = (2 ** n) + random.randint(0, 1000) / 1000
-                    logger.warning('Limit overrated, sleeping for %s seconds' % sleep_time)
-                    time.sleep(sleep_time)
-                elif error.get('code') == 429:
-                    # Apply exponential backoff.
-                    sleep_time = (2 ** n) + random.randint(0, 1000) / 1000
-                    logger.warning('Too many concurrent requests for user, sleeping for %d seconds' % sleep_time)
-                    time.sleep(sleep_time)
-                elif error.get('code') == 503 or error.get('code') == 500:
+                error = self.parse_http_error(e)
+
+                if self.is_retryable_error(error):
                     # Apply exponential backoff.
-                    sleep_time = (2 ** n) + random.randint(0, 1000) / 1000
-                    logger.warning('Backend error, sleeping for %d seconds' % sleep_time)
+                    sleep_time = self.get_backoff_time(n)
+                    if self.is_rate_limit_error(error):
+                        gmail_rate_limiter.penalize(self.email_account.id)
+                        if self.defer_rate_limits:
+                            raise self.defer(sleep_time)
+
+                    logger.warning('Rate limit or backend error %s, sleeping for %s seconds' % (
+                        error.get('code'),
+                        sleep_time
+                    ))
                     time.sleep(sleep_time)
                 elif error.get('code') == 400 and error.get('message') == 'labelId not found':
                     raise LabelNotFoundError
@@ -104,59 +222,150 @@ class GmailConnector(object):
         logger.warning('Service call failed after all retries')
         raise FailedServiceCallException('Service call failed after all retries')
 
-    def get_history(self):
+    def execute_batch_service_calls(self, service_calls, batch_size):
         """
-        Fetch the history list from the gmail api.
+        Execute multiple service calls using Gmail batch requests.
+
+        Every batch request contains at most batch_size calls. Calls that fail because of a rate limit or a
+        backend error are retried with exponential backoff in a new batch. When the connector defers rate
+        limits, the calls that are rate limited get a RateLimitError instead.
+
+        Args:
+            service_calls (dict): with request_id: service call instance
+            batch_size (int): max number of calls in one batch request
 
         Returns:
-            list with messageIds and threadIds
+            dict with request_id: response, or with request_id: ConnectorError instance if the call failed
         """
-        response = self.execute_service_call(self.service.users().history().list(
-            userId='me',
-            startHistoryId=self.history_id,
-            quotaUser=self.email_account.id,
-        ))
+        results = {}
+        pending = dict(service_calls)
+        batch_size = max(1, min(batch_size, GMAIL_MAX_BATCH_SIZE))
+        rate_limited = []
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                results[request_id] = response
+                return
+
+            if isinstance(exception, HttpError):
+                error = self.parse_http_error(exception)
+            else:
+                error = {}
+
+            if self.is_retryable_error(error):
+                # Leave in pending, so it will be retried.
+                if self.is_rate_limit_error(error):
+                    rate_limited.append(request_id)
+            elif error.get('code') == 400 and error.get('message') == 'labelId not found':
+                results[request_id] = LabelNotFoundError()
+            elif error.get('code') == 404:
+                results[request_id] = MessageNotFoundError()
+            else:
+                logger.error('Unkown error code for batch request %s: %s' % (request_id, exception))
+                results[request_id] = ConnectorError(exception)
 
-        # Get the messageIds.
-        history = response.get('history', [])
-
-        self.history_id = response.get('historyId', self.history_id)
+        for n in range(0, 6):
+            request_ids = list(pending.keys())
+            try:
+                for i in range(0, len(request_ids), batch_size):
+                    batch = self.service.new_batch_http_request(callback=callback)
+                    chunk = request_ids[i:i + batch_size]
+                    for request_id in chunk:
+                        batch.add(pending[request_id], request_id=request_id)
+                    self.execute_service_call(batch, tokens=len(chunk))
+            except RateLimitError as e:
+                # Defer the calls that weren't done yet.
+                for request_id in pending:
+                    results.setdefault(request_id, e)
+                return results
+
+            pending = {request_id: call for request_id, call in pending.items() if request_id not in results}
+            if not pending:
+                return results
+
+            # Apply exponential backoff.
+            sleep_time = self.get_backoff_time(n)
+            if rate_limited:
+                gmail_rate_limiter.penalize(self.email_account.id)
+                del rate_limited[:]
+                if self.defer_rate_limits:
+                    exception = self.defer(sleep_time)
+                    for request_id in pending:
+                        results[request_id] = exception
+                    return results
+
+            logger.warning('%s batched calls were rate limited, sleeping for %s seconds' % (len(pending), sleep_time))
+            time.sleep(sleep_time)
+
+        logger.warning('%s batched calls failed after all retries' % len(pending))
+        for request_id in pending:
+            results[request_id] = FailedServiceCallException('Service call failed after all retries')
+
+        return results
+
+    def get_history_pages(self):
+        """
+        Fetch the history list from the gmail api, one page at a time.
 
-        return history
+        After every page the history_id is moved to the last history record of that page, after the last page
+        to the current history id of the mailbox. So when a page is processed, save_history_id checkpoints it.
+        A page token only belongs to the query that returned it, so every page is requested with the history id
+        the listing started with.
 
-    def get_all_message_id_list(self):
+        Yields:
+            list with history records for every page
         """
-        Fetch all messageIds from the gmail api.
+        start_history_id = self.history_id
+        page_token = None
+        first_page = True
+        while first_page or page_token:
+            response = self.execute_service_call(self.service.users().history().list(
+                userId='me',
+                startHistoryId=start_history_id,
+                pageToken=page_token,
+                quotaUser=self.email_account.id,
+            ))
+            history = response.get('history', [])
+            page_token = response.get('nextPageToken')
+            first_page = False
 
-        Returns:
-            list with messageIds and threadIds
+            if page_token and history:
+                self.history_id = history[-1]['id']
+            elif not page_token:
+                self.history_id = response.get('historyId', self.history_id)
+
+            yield history
+
+    def get_message_id_pages(self):
         """
-        response = self.execute_service_call(self.service.users().messages().list(
-            userId='me',
-            quotaUser=self.email_account.id,
-            q='!in:chats',
-        ))
+        Fetch all messageIds from the gmail api, one page at a time.
 
-        messages = response['messages'] if 'messages' in response else []
+        The history_id is updated when the first page is fetched, so changes made during the listing are
+        picked up by the next history sync.
 
-        # Check if there are more pages.
-        while 'nextPageToken' in response:
-            page_token = response['nextPageToken']
-            response = self.execute_service_call(
-                self.service.users().messages().list(
-                    userId='me',
-                    pageToken=page_token,
-                    quotaUser=self.email_account.id,
-                ))
-            messages.extend(response.get('messages', []))
+        Yields:
+            list with messageIds and threadIds for every page
+        """
+        page_token = None
+        first_page = True
+        while first_page or page_token:
+            response = self.execute_service_call(self.service.users().messages().list(
+                userId='me',
+                pageToken=page_token,
+                quotaUser=self.email_account.id,
+                q='!in:chats',
+            ))
+            messages = response.get('messages', [])
+            page_token = response.get('nextPageToken')
 
-        # Store history_id
-        if messages:
-            message = self.get_message_info(messages[0]['id'])
-            if message['historyId'] > self.history_id:
-                self.history_id = message['historyId']
+            # Store history_id
+            if first_page and messages:
+                message = self.get_message_info(messages[0]['id'])
+                if message['historyId'] > self.history_id:
+                    self.history_id = message['historyId']
+            first_page = False
 
-        return messages
+            yield messages
 
     def get_message_info(self, message_id):
         """
@@ -219,6 +428,74 @@ class GmailConnector(object):
             quotaUser=self.email_account.id,
         ))
 
+    def get_message_info_list(self, message_ids):
+        """
+        Fetch message information for multiple messages using batch requests.
+
+        Args:
+            message_ids (list): ids of the messages
+
+        Returns:
+            dict with message_id: message info, or message_id: ConnectorError instance
+                (e.g. MessageNotFoundError) if the message couldn't be fetched
+        """
+        service_calls = {}
+        for message_id in message_ids:
+            service_calls[message_id] = self.service.users().messages().get(
+                userId='me',
+                id=message_id,
+                quotaUser=self.email_account.id,
+            )
+
+        return self.execute_batch_service_calls(service_calls, settings.GMAIL_FULL_MESSAGE_BATCH_SIZE)
+
+    def get_short_message_info_list(self, message_ids):
+        """
+        Fetch labels & threadId for multiple messages using batch requests.
+
+        Args:
+            message_ids (list): ids of the messages
+
+        Returns:
+            dict with message_id: message info with threadId & labels, or message_id: ConnectorError instance
+                (e.g. MessageNotFoundError) if the message couldn't be fetched
+        """
+        service_calls = {}
+        for message_id in message_ids:
+            service_calls[message_id] = self.service.users().messages().get(
+                userId='me',
+                id=message_id,
+                fields='labelIds,threadId',
+                quotaUser=self.email_account.id,
+            )
+
+        return self.execute_batch_service_calls(service_calls, settings.GMAIL_LABEL_UPDATE_BATCH_SIZE)
+
+    def watch(self, topic_name):
+        """
+        Let Gmail publish a push notification to the Pub/Sub topic when the mailbox changes.
+
+        Args:
+            topic_name (string): full name of the Pub/Sub topic
+
+        Returns:
+            dict with the historyId and the expiration (in ms since epoch) of the watch
+        """
+        return self.execute_service_call(self.service.users().watch(
+            userId='me',
+            body={'topicName': topic_name},
+            quotaUser=self.email_account.id,
+        ))
+
+    def stop_watch(self):
+        """
+        Stop the push notifications for the mailbox.
+        """
+        self.execute_service_call(self.service.users().stop(
+            userId='me',
+            quotaUser=self.email_account.id,
+        ))
+
     def save_history_id(self):
         """
         Save currently set history_id to the EmailAccount
@@ -254,6 +531,22 @@ class GmailConnector(object):
                 quotaUser=self.email_account.id,
             ))
 
+    def batch_update_labels(self, message_ids, labels):
+        """
+        Add and/or remove the same labels for multiple messages in one call.
+
+        Args:
+            message_ids (list): ids of the messages, at most GMAIL_MAX_BATCH_MODIFY_SIZE
+            labels (dict): with addLabelIds and/or removeLabelIds
+        """
+        body = dict(labels, ids=message_ids)
+        return self.execute_service_call(
+            self.service.users().messages().batchModify(
+                userId='me',
+                body=body,
+                quotaUser=self.email_account.id,
+            ))
+
     def trash_email_message(self, message_id):
         return self.execute_service_call(
             self.service.users().messages().trash(
@@ -270,10 +563,10 @@ class GmailConnector(object):
                 quotaUser=self.email_account.id,
             ))
 
-    def send_email_message(self, message_string, thread_id=None):
+    def send_email_message(self, message_file, thread_id=None):
         message_dict = {}
-        media = MediaInMemoryUpload(
-            message_string,
+        media = MediaIoBaseUpload(
+            message_file,
             mimetype='message/rfc822',
             chunksize=settings.GMAIL_CHUNK_SIZE,
             resumable=True
@@ -288,9 +581,9 @@ class GmailConnector(object):
                 quotaUser=self.email_account.id,
             ))
 
-    def create_draft_email_message(self, message_string):
-        media = MediaInMemoryUpload(
-            message_string,
+    def create_draft_email_message(self, message_file):
+        media = MediaIoBaseUpload(
+            message_file,
             mimetype='message/rfc822',
             chunksize=settings.GMAIL_CHUNK_SIZE,
             resumable=True
@@ -302,9 +595,9 @@ class GmailConnector(object):
                 quotaUser=self.email_account.id,
             ))
 
-    def update_draft_email_message(self, message_string, draft_id):
-        media = MediaInMemoryUpload(
-            message_string,
+    def update_draft_email_message(self, message_file, draft_id):
+        media = MediaIoBaseUpload(
+            message_file,
             mimetype='message/rfc822',
             chunksize=settings.GMAIL_CHUNK_SIZE,
             resumable=True
@@ -329,6 +622,9 @@ class GmailConnector(object):
         """
         Cleanup references, to prevent reference cycle
         """
+        if self.service_entry is not None:
+            gmail_service_cache.release(self.email_account.pk, self.service_entry)
+            self.service_entry = None
         self.service = None
         self.email_account = None
         self.history_id = None
@@ -2,6 +2,7 @@ import logging
 from oauth2client.contrib.django_orm import Storage
 
 from .models.models import GmailCredentialsModel
+from .push import clear_watch_expiration
 
 
 logger = logging.getLogger(__name__)
@@ -35,5 +36,7 @@ def get_credentials(gmail_account):
     else:
         gmail_account.is_authorized = False
         gmail_account.save()
+        # The watch can't be stopped or renewed without credentials, so it expires within 7 days.
+        clear_watch_expiration(gmail_account.pk)
         logger.error('no credentials for account %s' % gmail_account)
         raise InvalidCredentialsError('no credentials for account %s' % gmail_account)
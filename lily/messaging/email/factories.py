@@ -1,12 +1,15 @@
 import factory
 
+from lily.tenant.factories import TenantFactory
 from lily.users.factories import LilyUserFactory
 
 from .models.models import EmailAccount, EmailMessage, EmailHeader, EmailLabel
 
 
 class GmailAccountFactory(factory.DjangoModelFactory):
-    user = factory.SubFactory(LilyUserFactory)
+    tenant = factory.SubFactory(TenantFactory)
+    owner = factory.SubFactory(LilyUserFactory, tenant=factory.SelfAttribute('..tenant'))
+    email_address = factory.Sequence(lambda n: 'user{0}@example.com'.format(n))
 
     class Meta:
         model = EmailAccount
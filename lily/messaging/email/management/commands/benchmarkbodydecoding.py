@@ -0,0 +1,62 @@
+import os
+import timeit
+
+from bs4 import BeautifulSoup
+from django.core.management import BaseCommand
+
+from lily.messaging.email.builders.message import decode_message_body
+
+
+def decode_with_beautifulsoup(body):
+    """
+    The decoding MessageBuilder used before, for comparison.
+    """
+    soup = BeautifulSoup(body, 'lxml', from_encoding='utf-8')
+    if soup.original_encoding:
+        try:
+            return body.decode(soup.original_encoding)
+        except (LookupError, UnicodeDecodeError):
+            pass
+
+    return body.decode('utf-8', 'replace')
+
+
+class Command(BaseCommand):
+    help = """
+    Compare the speed of decoding html message bodies with and without BeautifulSoup.
+
+    Args:
+        path: directory with raw (not decoded) html bodies, one per file
+        repeat: number of times every body is decoded, defaults to 10
+    """
+
+    def handle(self, path, repeat=10, **options):
+        bodies = []
+        for file_name in sorted(os.listdir(path)):
+            with open(os.path.join(path, file_name), 'rb') as body_file:
+                bodies.append(body_file.read())
+
+        if not bodies:
+            self.stdout.write('No bodies found in %s' % path)
+            return
+
+        repeat = int(repeat)
+        size = sum(len(body) for body in bodies)
+        self.stdout.write('Decoding %s bodies (%s bytes) %s times' % (len(bodies), size, repeat))
+
+        for name, decode in (
+                ('beautifulsoup', decode_with_beautifulsoup),
+                ('sniffing', lambda body: decode_message_body(body, is_html=True))):
+            seconds = timeit.timeit(lambda: [decode(body) for body in bodies], number=repeat)
+            self.stdout.write('%s: %.3f seconds, %.2f ms per body' % (
+                name,
+                seconds,
+                seconds * 1000 / (len(bodies) * repeat),
+            ))
+
+        differences = [
+            file_name for file_name, body in zip(sorted(os.listdir(path)), bodies)
+            if decode_message_body(body, is_html=True) != decode_with_beautifulsoup(body)
+        ]
+        if differences:
+            self.stdout.write('Decoded differently: %s' % ', '.join(differences))
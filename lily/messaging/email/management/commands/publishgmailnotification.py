@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.core.urlresolvers import reverse
+
+from lily.messaging.email.push import publish_push_notification
+
+
+class Command(BaseCommand):
+    help = """
+    Publish a Gmail push notification to the webhook, like Pub/Sub does, to test push notifications locally.
+
+    Args:
+        email_address: email address of the mailbox that changed
+        history_id: history id of the change
+        host: url of the server, defaults to http://localhost:8000
+    """
+
+    def handle(self, email_address, history_id, host='http://localhost:8000', **options):
+        url = '%s%s?token=%s' % (host, reverse('gmail_push_notification'), settings.GMAIL_PUSH_TOKEN)
+        status_code = publish_push_notification(url, email_address, int(history_id))
+        self.stdout.write('Published notification for %s, webhook responded with %s' % (email_address, status_code))
@@ -0,0 +1,29 @@
+from django.core.management import BaseCommand
+
+from ...models.models import EmailAccount, EmailMessage, EmailThread
+
+
+class Command(BaseCommand):
+    help = """
+    Recalculate the threads of email accounts from their messages, e.g. to fill the threads after upgrading.
+
+    Args:
+        account_id: id of the EmailAccount, defaults to all email accounts
+        chunk_size: number of threads recalculated at once, defaults to 500
+    """
+
+    def handle(self, account_id=None, chunk_size=500, **options):
+        email_accounts = EmailAccount.objects.filter(is_deleted=False)
+        if account_id:
+            email_accounts = email_accounts.filter(pk=account_id)
+
+        chunk_size = int(chunk_size)
+        for email_account in email_accounts:
+            thread_ids = list(EmailMessage.objects.filter(
+                account=email_account,
+            ).order_by().values_list('thread_id', flat=True).distinct())
+
+            for i in range(0, len(thread_ids), chunk_size):
+                EmailThread.objects.update_threads(email_account, thread_ids[i:i + chunk_size])
+
+            self.stdout.write('Updated %s threads for %s' % (len(thread_ids), email_account))
@@ -1,20 +1,34 @@
 import logging
-import gc
+import hashlib
+import tempfile
+import time
 import traceback
 
 from django.conf import settings
+from django.core.cache import cache
+from django.core.files import File
+from django.db import transaction, DatabaseError
+from django.db.models import Count
 from googleapiclient.errors import HttpError
 
 from lily.celery import app
+from lily.search.indexing import update_queryset_in_index, remove_ids_from_index
 from .builders.label import LabelBuilder
 from .builders.message import MessageBuilder
-from .connector import GmailConnector, MessageNotFoundError, LabelNotFoundError
+from .connector import GmailConnector, MessageNotFoundError, LabelNotFoundError, GMAIL_MAX_BATCH_MODIFY_SIZE
 from .credentials import InvalidCredentialsError
-from .models.models import EmailLabel, EmailMessage, NoEmailMessageId
+from .models.models import (EmailAttachment, EmailHeader, EmailLabel, EmailMessage, EmailThread, NoEmailMessageId,
+                            UnreferencedAttachmentFile)
+from .mutations import group_label_mutations, queue_thread_updates
+from .scheduling import queue_first_sync_task, refresh_sync_started
+from .search import EmailMessageMapping
+from .utils import decode_base64url_to_file, deduplicate_attachments
 
 
 logger = logging.getLogger(__name__)
 
+ATTACHMENT_DOWNLOAD_LOCK_KEY = 'email_attachment_download_lock_%s'
+
 
 class ManagerError(Exception):
     pass
@@ -29,18 +43,22 @@ class GmailManager(object):
         email_account: EmailAccount instance
         message_builder: MessageBuilder instance
         label_builder: LabelBuilder instance
+        label_cache: dict with label_id: EmailLabel for the EmailAccount, loaded on first use
     """
-    def __init__(self, email_account):
+    def __init__(self, email_account, defer_rate_limits=False):
         """
         Args:
             email_account (instance): EmailAccount instance
+            defer_rate_limits (boolean, optional): if True, calls that hit the rate limit of the account are
+                deferred instead of waiting for it, see GmailConnector
 
         Raises:
             ManagerError: if sync is not possible
         """
         self.email_account = email_account
+        self.label_cache = None
         try:
-            self.connector = GmailConnector(self.email_account)
+            self.connector = GmailConnector(self.email_account, defer_rate_limits=defer_rate_limits)
         except InvalidCredentialsError:
             raise ManagerError
         else:
@@ -48,56 +66,73 @@ class GmailManager(object):
             self.label_builder = LabelBuilder(self)
 
     def full_synchronize(self):
-        message_ids = self.connector.get_all_message_id_list()
-
-        # Check for message_ids that are saved as non email messages.
-        no_message_ids_in_db = set(
-            NoEmailMessageId.objects.filter(
-                account=self.email_account
-            ).values_list('message_id', flat='true')
-        )
-
-        # Check for message_ids that are saved as email messages.
-        message_ids_in_db = set(
-            EmailMessage.objects.filter(
-                account=self.email_account
-            ).values_list('message_id', flat='true')
-        )
-
-        # What do we need to do with every email message?
-        for i, message_dict in enumerate(message_ids):
-            logger.debug('Check for existing messages, %s/%s' % (i, len(message_ids)))
-            if message_dict['id'] in no_message_ids_in_db:
-                # Not an email, but chatmessage, skip.
-                pass
-            elif message_dict['id'] not in message_ids_in_db:
-                # Message is new.
-                app.send_task(
-                    'download_email_message',
-                    args=[self.email_account.id, message_dict['id']],
-                    queue='email_first_sync'
-                )
-
-            else:
-                # We only need to update the labels for this message.
-                app.send_task(
-                    'update_labels_for_message',
-                    args=[self.email_account.id, message_dict['id']],
-                    queue='email_first_sync'
-                )
+        """
+        Queue tasks to download all messages of the EmailAccount.
+
+        The message ids are fetched and checked against the database one page at a time, so memory use doesn't
+        depend on the size of the mailbox. The tasks are added to the first sync queue of the account, from
+        which the scheduler sends them to the broker.
+        """
+        chunk_size = settings.GMAIL_FIRST_SYNC_CHUNK_SIZE
+        pending_message_ids = []
+        queued = 0
+        # Position of the next task in the first sync queue.
+        position = 0
+
+        for page in self.connector.get_message_id_pages():
+            # The listing of a big mailbox can take longer than the lifetime of the sync mark.
+            refresh_sync_started(self.email_account.id)
+            page_message_ids = [message_dict['id'] for message_dict in page]
+
+            # Check for message_ids that are saved as non email messages.
+            no_message_ids_in_db = set(
+                NoEmailMessageId.objects.filter(
+                    account=self.email_account,
+                    message_id__in=page_message_ids,
+                ).values_list('message_id', flat=True)
+            )
+
+            # Only download or update the messages that aren't chat messages.
+            pending_message_ids.extend(
+                message_id for message_id in page_message_ids if message_id not in no_message_ids_in_db
+            )
+
+            # Every task downloads a chunk of message ids with a single manager and connector.
+            while len(pending_message_ids) >= chunk_size:
+                self._queue_download_messages(position, pending_message_ids[:chunk_size])
+                pending_message_ids = pending_message_ids[chunk_size:]
+                queued += chunk_size
+                position += 1
+
+            logger.debug('Queued %s messages for %s' % (queued, self.email_account.email_address))
+
+        if pending_message_ids:
+            self._queue_download_messages(position, pending_message_ids)
+            position += 1
 
         # Finally, add a task to keep track when the sync queue is finished.
-        app.send_task(
-            'first_sync_finished',
-            args=[self.email_account.id],
-            queue='email_first_sync'
-        )
+        queue_first_sync_task(self.email_account.id, position, 'first_sync_finished', [self.email_account.id])
 
         self.connector.save_history_id()
         # Only if transaction was successful, we update the history ID.
         logger.debug('Finished queuing up tasks for email sync, storing history id for %s' %
                      self.email_account.email_address)
 
+    def _queue_download_messages(self, position, message_ids):
+        """
+        Queue a first sync task to download the given messages.
+
+        Args:
+            position (int): position of the task in the first sync queue
+            message_ids (list): message_ids of the messages
+        """
+        queue_first_sync_task(
+            self.email_account.id,
+            position,
+            'download_email_messages',
+            [self.email_account.id, message_ids],
+        )
+
     def download_message(self, message_id):
         """
         Download message from Google and parse into an EmailMessage
@@ -106,7 +141,9 @@ class GmailManager(object):
             message_id (str): message_id of the message
         """
 
-        # If message if already downloaded, only update it
+        # If message if already downloaded, only update it. Fetching just the labels and thread is a lot cheaper
+        # than downloading and parsing the full message again. A message stored by another worker after this
+        # check is updated by the upsert in MessageBuilder.save.
         if EmailMessage.objects.filter(account=self.email_account, message_id=message_id).exists():
             self.update_labels_for_message(message_id)
             return
@@ -117,24 +154,105 @@ class GmailManager(object):
         except MessageNotFoundError:
             logger.debug('Message already deleted from remote')
         else:
-            self.message_builder.store_message_info(message_info, message_id)
+            self.message_builder.store_message_info(message_info, message_id, create=True)
             self.message_builder.save()
 
+    def download_messages(self, message_ids):
+        """
+        Download multiple messages from Google and parse them into EmailMessages.
+
+        Messages that are already downloaded only get their labels updated. The messages are fetched in
+        batches, so only one batch of full messages is kept in memory.
+
+        Arguments:
+            message_ids (list): message_ids of the messages
+
+        Returns:
+            list: message_ids that couldn't be downloaded and should be tried again
+        """
+        existing_message_ids = set(EmailMessage.objects.filter(
+            account=self.email_account,
+            message_id__in=message_ids,
+        ).values_list('message_id', flat=True))
+
+        failed_message_ids = []
+        if existing_message_ids:
+            failed_message_ids.extend(self.update_labels_for_messages(existing_message_ids))
+
+        new_message_ids = [message_id for message_id in message_ids if message_id not in existing_message_ids]
+
+        batch_size = settings.GMAIL_FULL_MESSAGE_BATCH_SIZE
+        for i in range(0, len(new_message_ids), batch_size):
+            if self.connector.deferred_countdown is not None:
+                # Don't hit the rate limit again, the remaining messages are downloaded on a retry.
+                failed_message_ids.extend(new_message_ids[i:])
+                break
+
+            message_info_list = self.connector.get_message_info_list(new_message_ids[i:i + batch_size])
+
+            for message_id, message_info in message_info_list.items():
+                if isinstance(message_info, MessageNotFoundError):
+                    logger.debug('Message already deleted from remote')
+                elif isinstance(message_info, Exception):
+                    logger.warning('Couldn\'t download message %s for account %s: %s' % (
+                        message_id,
+                        self.email_account.id,
+                        message_info,
+                    ))
+                    failed_message_ids.append(message_id)
+                else:
+                    self.message_builder.store_message_info(message_info, message_id, create=True)
+                    self.message_builder.add_to_bulk()
+
+            # Save the whole batch at once.
+            self.message_builder.save_bulk()
+
+        return failed_message_ids
+
     def sync_by_history(self):
         """
         Synchronize EmailAccount by history.
 
-        Fetches the changes from the GMail api and creates tasks for the mutations.
+        Fetches the changes from the GMail api one page at a time and creates tasks for the mutations. The
+        history id is stored after every page. When more than GMAIL_PARTIAL_SYNC_LIMIT history records are
+        processed, the sync stops and the next sync continues from the stored history id.
+
+        Returns:
+            int: number of history records processed
         """
         logger.info('updating history for %s with history_id %s' % (self.email_account, self.email_account.history_id))
         old_history_id = self.email_account.history_id
 
-        history = self.connector.get_history()
-        if not len(history):
-            return
+        processed = 0
+        for history in self.connector.get_history_pages():
+            refresh_sync_started(self.email_account.id)
+            self.process_history(history)
+
+            # Checkpoint, the changes of this page are processed. The api returns the history id as string.
+            if str(self.connector.history_id) != str(self.email_account.history_id):
+                self.connector.save_history_id()
+
+            processed += len(history)
+            if processed >= settings.GMAIL_PARTIAL_SYNC_LIMIT:
+                logger.info('Partial sync limit reached for %s, continuing next sync' % self.email_account)
+                break
+
+        # Only update the unread count if the history id was updated.
+        if str(old_history_id) != str(self.email_account.history_id):
+            self.update_unread_count()
 
+        return processed
+
+    def process_history(self, history):
+        """
+        Create tasks for the mutations in a page of history records.
+
+        Args:
+            history (list): history records
+        """
         add_messages = set()
         edit_labels = set()
+        delete_messages = set()
         for history_item in history:
             logger.debug('parsing history %s' % history_item)
             # Get new messages
@@ -160,7 +278,10 @@ class GmailManager(object):
                 logger.debug('deleting message %s' % message['message']['id'])
                 add_messages.discard(message['message']['id'])
                 edit_labels.discard(message['message']['id'])
-                EmailMessage.objects.filter(message_id=message['message']['id'], account=self.email_account).delete()
+                delete_messages.add(message['message']['id'])
+
+        # Remove all deleted messages at once.
+        self.delete_messages(delete_messages)
 
         for message_id in add_messages:
             logger.info('creating download_email_message for %s', message_id)
@@ -170,38 +291,106 @@ class GmailManager(object):
             logger.info('creating update_labels_for_message for %s', message_id)
             app.send_task('update_labels_for_message', args=[self.email_account.id, message_id])
 
-        self.connector.save_history_id()
-        # Only update the unread count if the history id was updated.
-        if old_history_id != self.email_account.history_id:
-            self.update_unread_count()
+    def delete_messages(self, message_ids):
+        """
+        Delete the EmailMessages with the given message_ids with a few bulk queries.
+
+        The related rows are deleted without sending signals for every message and the messages are removed
+        from the search index with one request.
+
+        Args:
+            message_ids (iterable): message_ids of the messages
+        """
+        messages = list(EmailMessage.objects.filter(
+            account=self.email_account,
+            message_id__in=message_ids,
+        ).values_list('pk', 'thread_id'))
+        if not messages:
+            return
+
+        message_pks = [pk for pk, thread_id in messages]
+
+        logger.debug('Deleting %s messages for account %s' % (len(message_pks), self.email_account))
+        with transaction.atomic():
+            for field_name in ['labels', 'received_by', 'received_by_cc']:
+                through = EmailMessage._meta.get_field(field_name).rel.through
+                through.objects.filter(emailmessage_id__in=message_pks)._raw_delete(through.objects.db)
+
+            EmailHeader.objects.filter(message_id__in=message_pks)._raw_delete(EmailHeader.objects.db)
+
+            # Delete attachments one by one, so the files are removed from storage.
+            EmailAttachment.objects.filter(message_id__in=message_pks).delete()
+
+            EmailMessage.objects.filter(pk__in=message_pks)._raw_delete(EmailMessage.objects.db)
+
+        remove_ids_from_index(message_pks, EmailMessageMapping)
+        queue_thread_updates(self.email_account.id, [thread_id for pk, thread_id in messages])
 
     def update_unread_count(self):
         """
         Update unread count on every label.
         """
         logger.debug('Updating unread count for every label, account %s' % self.email_account.email_address)
+        # Count the unread messages for all labels with a single query.
+        unread_counts = dict(EmailMessage.objects.filter(
+            account=self.email_account,
+            read=False,
+            labels__isnull=False,
+        ).values_list('labels').annotate(unread=Count('id')).order_by())
+
+        # Group the labels that changed by their new count, so they're updated with one query per count.
+        changed_labels = {}
         for label in self.email_account.labels.all():
-            unread_count = label.messages.filter(read=False).count()
-            label.unread = unread_count
-            label.save()
+            unread_count = unread_counts.get(label.pk, 0)
+            if label.unread != unread_count:
+                changed_labels.setdefault(unread_count, []).append(label.pk)
+
+        for unread_count, label_pks in changed_labels.items():
+            EmailLabel.objects.filter(pk__in=label_pks).update(unread=unread_count)
 
     def get_label(self, label_id):
         """
         Returns the label given the label_id
 
+        All labels of the EmailAccount are loaded once and kept in the label cache. Labels that aren't
+        stored yet are fetched from remote.
+
         Args:
             label_id (string): label_id of the label
 
         Returns:
             EmailLabel instance
         """
-        try:
-            label = EmailLabel.objects.get(account=self.email_account, label_id=label_id)
-        except EmailLabel.DoesNotExist:
+        self.load_label_cache()
+
+        if label_id not in self.label_cache:
+            # Unknown label, store all labels that were created on remote in the meantime.
+            for label_info in self.connector.get_label_list():
+                if label_info['id'] not in self.label_cache:
+                    self.label_cache[label_info['id']] = self.label_builder.get_or_create_label(label_info)[0]
+
+        if label_id not in self.label_cache:
             label_info = self.connector.get_label_info(label_id)
-            label = self.label_builder.get_or_create_label(label_info)[0]
+            self.label_cache[label_id] = self.label_builder.get_or_create_label(label_info)[0]
+
+        return self.label_cache[label_id]
 
-        return label
+    def load_label_cache(self):
+        """
+        Load all labels of the EmailAccount in the label cache, if not loaded yet.
+        """
+        if self.label_cache is None:
+            self.label_cache = {
+                label.label_id: label for label in EmailLabel.objects.filter(account=self.email_account)
+            }
+
+    def invalidate_label_cache(self):
+        """
+        Clear the label cache, so labels are loaded again on the next get_label.
+
+        Should be called when labels are created or deleted outside of get_label.
+        """
+        self.label_cache = None
 
     def get_attachment(self, message_id, attachment_id):
         """
@@ -216,6 +405,64 @@ class GmailManager(object):
         """
         return self.connector.get_attachment(message_id, attachment_id)
 
+    def download_attachment(self, attachment):
+        """
+        Download the file of an attachment that was synced without it and store it.
+
+        Only one process downloads the file of an attachment, concurrent requests wait until it's stored. No
+        database lock is held while the file is fetched from Gmail and uploaded to the storage.
+
+        Args:
+            attachment (instance): EmailAttachment instance
+
+        Returns:
+            the EmailAttachment instance with the stored file
+
+        Raises:
+            ManagerError: if another process is still downloading the file after waiting for it
+            EmailAttachment.DoesNotExist: if the attachment was deleted in the meantime
+        """
+        key = ATTACHMENT_DOWNLOAD_LOCK_KEY % attachment.pk
+        started = time.time()
+        while not cache.add(key, True, settings.EMAIL_ATTACHMENT_DOWNLOAD_TIMEOUT):
+            if time.time() - started > settings.EMAIL_ATTACHMENT_DOWNLOAD_TIMEOUT:
+                raise ManagerError('Attachment %s is still being downloaded' % attachment.pk)
+            time.sleep(0.1)
+
+        try:
+            attachment = EmailAttachment.objects.select_related('message').get(pk=attachment.pk)
+            if attachment.is_downloaded:
+                # Downloaded by a concurrent request.
+                return attachment
+
+            response = self.connector.get_attachment(attachment.message.message_id, attachment.attachment_id)
+            file_data = response.pop('data')
+            del response
+
+            file = tempfile.SpooledTemporaryFile(max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE)
+            digest = hashlib.sha256()
+            attachment.size = decode_base64url_to_file(file_data, file, digest)
+            del file_data
+
+            attachment.attachment = File(file, attachment.name)
+            attachment.attachment_id = ''
+            attachment.content_hash = digest.hexdigest()
+            deduplicate_attachments([attachment])
+            uploaded = not attachment.attachment._committed
+
+            try:
+                # Saving uploads the file, unless the same file is stored already.
+                attachment.save(update_fields=['attachment', 'attachment_id', 'content_hash', 'size'])
+            except DatabaseError:
+                # No row was updated, so the attachment was deleted while downloading.
+                if uploaded:
+                    UnreferencedAttachmentFile.objects.create(name=attachment.attachment.name)
+                raise EmailAttachment.DoesNotExist('Attachment %s was deleted while downloading' % attachment.pk)
+        finally:
+            cache.delete(key)
+
+        return attachment
+
     def update_labels_for_message(self, message_id):
         """
         Fetch the labels for the EmailMessage with the given message_id.
@@ -234,6 +481,42 @@ class GmailManager(object):
         except MessageNotFoundError:
             return
 
+        self.store_label_info_for_message(email_message, message_info)
+
+    def update_labels_for_messages(self, message_ids):
+        """
+        Fetch the labels for multiple EmailMessages with batch requests.
+
+        Args:
+            message_ids (iterable): message_ids of the messages
+
+        Returns:
+            list: message_ids that couldn't be updated and should be tried again
+        """
+        email_messages = EmailMessage.objects.filter(message_id__in=message_ids, account=self.email_account)
+        email_messages = {email_message.message_id: email_message for email_message in email_messages}
+
+        failed_message_ids = []
+        message_info_list = self.connector.get_short_message_info_list(email_messages.keys())
+        for message_id, message_info in message_info_list.items():
+            if isinstance(message_info, MessageNotFoundError):
+                continue
+            elif isinstance(message_info, Exception):
+                failed_message_ids.append(message_id)
+            else:
+                self.store_label_info_for_message(email_messages[message_id], message_info)
+
+        return failed_message_ids
+
+    def store_label_info_for_message(self, email_message, message_info):
+        """
+        Store the labels and thread_id from message_info, if they differ from the EmailMessage.
+
+        Args:
+            email_message (instance): EmailMessage instance
+            message_info (dict): message info with labelIds and threadId
+        """
+        message_id = email_message.message_id
         logger.debug('Storing label info for message: %s, account %s' % (
             message_id,
             self.email_account
@@ -253,6 +536,7 @@ class GmailManager(object):
             changed = True
 
         elif email_message.thread_id != message_info['threadId']:
+            self.message_builder.get_or_create_message({'id': message_id})
             self.message_builder.message.thread_id = message_info['threadId']
             changed = True
 
@@ -263,6 +547,10 @@ class GmailManager(object):
             except Exception:
                 logger.exception(
                     'Couldn\'t save message %s for account %s' % (message_id, self.email_account.id))
+            else:
+                if email_message.thread_id != message_info['threadId']:
+                    # The message moved to another thread, so the old thread changed as well.
+                    queue_thread_updates(self.email_account.id, [email_message.thread_id])
 
     def add_and_remove_labels_for_message(self, email_message, add_labels=[], remove_labels=[], remove_all=False):
         """
@@ -281,6 +569,7 @@ class GmailManager(object):
             except MessageNotFoundError:
                 logger.debug('Message not available on remote.')
                 EmailMessage.objects.get(pk=email_message.id).delete()
+                queue_thread_updates(self.email_account.id, [email_message.thread_id])
                 return
 
             labels = {}
@@ -311,6 +600,8 @@ class GmailManager(object):
                 except LabelNotFoundError:
                     logger.error('label not found, update labels failed! %s: %s' %
                                  (self.email_account, email_message.message_id))
+                    # The label was probably deleted on remote.
+                    self.invalidate_label_cache()
                 except HttpError:
                     # Other that a label error, so raise.
                     logger.error('update labels failed! %s: %s' % (self.email_account, email_message.message_id))
@@ -329,6 +620,86 @@ class GmailManager(object):
 
         self.update_unread_count()
 
+    def batch_add_and_remove_labels(self, mutations):
+        """
+        Add and/or remove labels for multiple EmailMessages.
+
+        Messages with the same label changes are updated with a single batchModify call, after which the
+        labels are updated in the database with a few bulk queries.
+
+        Args:
+            mutations (dict): with message_id: (label_ids to add, label_ids to remove)
+        """
+        self.load_label_cache()
+        through = EmailMessage.labels.through
+        messages = EmailMessage.objects.filter(account=self.email_account, message_id__in=mutations.keys())
+        message_pks = dict(messages.values_list('message_id', 'pk'))
+        read_changed = False
+
+        for (add_labels, remove_labels), message_ids in group_label_mutations(mutations).items():
+            # SENT can't be changed and UNREAD isn't added to the database as an available label.
+            add_labels = [
+                label for label in add_labels if label != settings.GMAIL_LABEL_SENT and
+                (label in self.label_cache or label == settings.GMAIL_LABEL_UNREAD)
+            ]
+            remove_labels = [label for label in remove_labels if label != settings.GMAIL_LABEL_SENT]
+
+            labels = {}
+            if add_labels:
+                labels['addLabelIds'] = add_labels
+            if remove_labels:
+                labels['removeLabelIds'] = remove_labels
+            if not labels:
+                continue
+
+            for i in range(0, len(message_ids), GMAIL_MAX_BATCH_MODIFY_SIZE):
+                chunk = message_ids[i:i + GMAIL_MAX_BATCH_MODIFY_SIZE]
+                try:
+                    self.connector.batch_update_labels(chunk, labels)
+                except LabelNotFoundError:
+                    logger.error('label not found, batch update labels failed! %s: %s' % (self.email_account, chunk))
+                    # The label was probably deleted on remote.
+                    self.invalidate_label_cache()
+                    self.load_label_cache()
+                    continue
+
+                pks = [message_pks[message_id] for message_id in chunk if message_id in message_pks]
+                if not pks:
+                    continue
+
+                remove_label_pks = [self.label_cache[label].pk for label in remove_labels if label in self.label_cache]
+                if remove_label_pks:
+                    through.objects.filter(emailmessage_id__in=pks, emaillabel_id__in=remove_label_pks).delete()
+
+                add_label_pks = [self.label_cache[label].pk for label in add_labels if label in self.label_cache]
+                if add_label_pks:
+                    existing_rows = set(through.objects.filter(
+                        emailmessage_id__in=pks,
+                        emaillabel_id__in=add_label_pks,
+                    ).values_list('emailmessage_id', 'emaillabel_id'))
+                    through.objects.bulk_create([
+                        through(emailmessage_id=pk, emaillabel_id=label_pk)
+                        for pk in pks for label_pk in add_label_pks if (pk, label_pk) not in existing_rows
+                    ])
+
+                if settings.GMAIL_LABEL_UNREAD in add_labels:
+                    EmailMessage.objects.filter(pk__in=pks).update(read=False)
+                    read_changed = True
+                elif settings.GMAIL_LABEL_UNREAD in remove_labels:
+                    EmailMessage.objects.filter(pk__in=pks).update(read=True)
+                    read_changed = True
+
+        # Bulk queries don't send signals, so update the index at once.
+        update_queryset_in_index(EmailMessage.objects.filter(pk__in=message_pks.values()), EmailMessageMapping)
+
+        if read_changed:
+            EmailThread.objects.update_unread_counts(
+                self.email_account,
+                messages.values_list('thread_id', flat=True),
+            )
+
+        self.update_unread_count()
+
     def toggle_star_email_message(self, email_message, star=True):
         """
         (Un)star a message.
@@ -340,9 +711,9 @@ class GmailManager(object):
         add_labels = []
         remove_labels = []
         if star:
-            add_labels = [settings.GMAIL_LABEL_STAR]
+            add_labels = [settings.GMAIL_LABEL_STARRED]
         else:
-            remove_labels = [settings.GMAIL_LABEL_STAR]
+            remove_labels = [settings.GMAIL_LABEL_STARRED]
 
         self.add_and_remove_labels_for_message(email_message, add_labels, remove_labels)
 
@@ -415,16 +786,16 @@ class GmailManager(object):
         else:
             self.update_unread_count()
 
-    def send_email_message(self, email_message, thread_id=None):
+    def send_email_message(self, message_file, thread_id=None):
         """
         Send email.
 
         Args:
-            email_message (instance): Email instance
+            message_file (file): the MIME message, see EmailOutboxMessage.message_file
             thread_id (string): Thread ID of original message that is replied or forwarded on
         """
         # Send message.
-        message_dict = self.connector.send_email_message(email_message.as_string(), thread_id)
+        message_dict = self.connector.send_email_message(message_file, thread_id)
 
         try:
             full_message_dict = self.connector.get_message_info(message_dict['id'])
@@ -432,19 +803,19 @@ class GmailManager(object):
             logger.debug('Message already deleted from remote')
         else:
             # Store updated message.
-            self.message_builder.store_message_info(full_message_dict, message_dict['id'])
+            self.message_builder.store_message_info(full_message_dict, message_dict['id'], create=True)
             self.message_builder.save()
             self.update_unread_count()
 
-    def create_draft_email_message(self, email_message):
+    def create_draft_email_message(self, message_file):
         """
         Create email draft.
 
         Args:
-            email_message (instance): Email instance
+            message_file (file): the MIME message, see EmailOutboxMessage.message_file
         """
         # Create draft message.
-        message_dict = self.connector.create_draft_email_message(email_message.as_string())
+        message_dict = self.connector.create_draft_email_message(message_file)
 
         try:
             full_message_dict = self.connector.get_message_info(message_dict['message']['id'])
@@ -457,16 +828,16 @@ class GmailManager(object):
             self.message_builder.save()
             self.update_unread_count()
 
-    def update_draft_email_message(self, email_message, draft_id):
+    def update_draft_email_message(self, message_file, draft_id):
         """
         Update email draft.
 
         Args:
-            email_message (instance): Email instance
+            message_file (file): the MIME message, see EmailOutboxMessage.message_file
             draft_id (string): id of current draft
         """
         # Update draft message.
-        message_dict = self.connector.update_draft_email_message(email_message.as_string(), draft_id)
+        message_dict = self.connector.update_draft_email_message(message_file, draft_id)
 
         try:
             full_message_dict = self.connector.get_message_info(message_dict['message']['id'])
@@ -500,5 +871,4 @@ class GmailManager(object):
         self.connector.cleanup()
         self.connector = None
         self.email_account = None
-
-        gc.collect()
+        self.label_cache = None
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email', '0016_set_first_sync_current_accounts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailattachment',
+            name='attachment_id',
+            field=models.TextField(default=''),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='emailattachment',
+            name='content_type',
+            field=models.CharField(default='', max_length=255),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email', '0017_emailattachment_attachment_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailattachment',
+            name='content_hash',
+            field=models.CharField(default='', max_length=64, db_index=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email', '0018_emailattachment_content_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailThread',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('thread_id', models.CharField(max_length=50)),
+                ('subject', models.TextField(default='')),
+                ('snippet', models.TextField(default='')),
+                ('last_message_date', models.DateTimeField(null=True, db_index=True)),
+                ('message_count', models.PositiveIntegerField(default=0)),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('account', models.ForeignKey(related_name='threads', to='email.EmailAccount')),
+                ('participants', models.ManyToManyField(related_name='threads', to='email.Recipient')),
+            ],
+            options={
+                'ordering': ['-last_message_date'],
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='emailthread',
+            unique_together=set([('account', 'thread_id')]),
+        ),
+    ]
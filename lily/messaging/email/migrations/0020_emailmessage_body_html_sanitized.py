@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email', '0019_emailthread'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailmessage',
+            name='body_html_sanitized',
+            field=models.TextField(default=''),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='emailmessage',
+            name='sanitize_version',
+            field=models.PositiveIntegerField(default=0, db_index=True),
+            preserve_default=True,
+        ),
+    ]
@@ -8,14 +8,18 @@ from email.mime.text import MIMEText
 import logging
 import mimetypes
 import os
+import re
+import tempfile
 import textwrap
+import uuid
 
 from django.conf import settings
 from django.core.files.uploadedfile import InMemoryUploadedFile, TemporaryUploadedFile
 from django.core.files.storage import default_storage
 from django.core.mail import SafeMIMEText, SafeMIMEMultipart
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import connections, models, transaction, IntegrityError
+from django.db.models import Count, Max
 from django.db.models.signals import post_delete
 from django.dispatch import receiver
 from django_extensions.db.models import TimeStampedModel
@@ -26,13 +30,21 @@ from lily.tenant.models import TenantMixin
 from lily.users.models import LilyUser
 from lily.utils.models.mixins import DeletedMixin
 
-from ..sanitize import sanitize_html_email
+from ..sanitize import SANITIZE_VERSION, sanitize_html_email
 
 
 logger = logging.getLogger(__name__)
 
 
 def get_attachment_upload_path(instance, filename):
+    if getattr(instance, 'content_hash', None):
+        # Files with the same content are stored once per tenant.
+        return settings.EMAIL_ATTACHMENT_BLOB_UPLOAD_TO % {
+            'tenant_id': instance.tenant_id,
+            'content_hash': instance.content_hash,
+            'filename': filename
+        }
+
     if isinstance(instance, EmailOutboxAttachment):
         message_id = instance.email_outbox_message_id
     else:
@@ -160,12 +172,43 @@ class Recipient(models.Model):
         unique_together = ('name', 'email_address')
 
 
+class EmailMessageManager(models.Manager):
+    def upsert(self, email_message, update_fields):
+        """
+        Insert the EmailMessage or update it if the account already has a message with the same message_id.
+
+        The insert is done in a savepoint, so a concurrent worker that stored the same message first only costs
+        a failed insert and a lookup of the pk, without aborting the surrounding transaction.
+
+        Args:
+            email_message (instance): unsaved EmailMessage instance, its pk is set afterwards
+            update_fields (list): names of the fields to update when the message already exists
+
+        Returns:
+            boolean: True if the message was inserted
+        """
+        try:
+            with transaction.atomic(using=self.db):
+                email_message.save(force_insert=True, using=self.db)
+        except IntegrityError:
+            email_message.pk = self.filter(
+                account_id=email_message.account_id,
+                message_id=email_message.message_id,
+            ).values_list('pk', flat=True).get()
+            email_message._state.adding = False
+            email_message.save(update_fields=update_fields, using=self.db)
+            return False
+
+        return True
+
+
 class EmailMessage(models.Model):
     """
     EmailMessage has all information from an email message
     """
     account = models.ForeignKey(EmailAccount, related_name='messages')
     body_html = models.TextField(default='')
+    body_html_sanitized = models.TextField(default='')
     body_text = models.TextField(default='')
     draft_id = models.CharField(max_length=50, db_index=True, default='')
     has_attachment = models.BooleanField(default=False)
@@ -176,11 +219,30 @@ class EmailMessage(models.Model):
     received_by = models.ManyToManyField(Recipient, related_name='received_messages')
     received_by_cc = models.ManyToManyField(Recipient, related_name='received_messages_as_cc')
     sender = models.ForeignKey(Recipient, related_name='sent_messages')
+    sanitize_version = models.PositiveIntegerField(default=0, db_index=True)
     sent_date = models.DateTimeField(db_index=True)
     snippet = models.TextField(default='')
     subject = models.TextField(default='')
     thread_id = models.CharField(max_length=50, db_index=True)
 
+    objects = EmailMessageManager()
+
+    def sanitize_body(self):
+        """
+        Store the sanitized version of body_html in body_html_sanitized, without saving.
+        """
+        self.body_html_sanitized = sanitize_html_email(self.body_html)
+        self.sanitize_version = SANITIZE_VERSION
+
+    def get_sanitized_body_html(self):
+        """
+        Return the sanitized html body, it's only sanitized here if the stored one is outdated.
+        """
+        if self.sanitize_version == SANITIZE_VERSION:
+            return self.body_html_sanitized
+
+        return sanitize_html_email(self.body_html)
+
     @property
     def tenant_id(self):
         return self.account.tenant_id
@@ -248,6 +310,178 @@ class EmailMessage(models.Model):
         ordering = ['-sent_date']
 
 
+class EmailThreadManager(models.Manager):
+    def update_threads(self, email_account, thread_ids):
+        """
+        Recalculate the EmailThreads with the given thread_ids from their messages.
+
+        Missing threads are created and threads without messages are deleted. The thread rows are locked while
+        they're recalculated, so concurrent workers storing messages of the same thread don't overwrite each
+        other with stale counts. Only threads and participants that changed are written.
+
+        Sync paths don't call this for every message, they queue the threads with queue_thread_updates.
+
+        Args:
+            email_account (instance): EmailAccount instance
+            thread_ids (iterable): thread_ids of the threads
+        """
+        thread_ids = sorted(set(thread_id for thread_id in thread_ids if thread_id))
+        if not thread_ids:
+            return
+
+        with transaction.atomic():
+            self._create_missing(email_account, thread_ids)
+            threads = {
+                thread.thread_id: thread for thread in self.select_for_update().filter(
+                    account=email_account,
+                    thread_id__in=thread_ids,
+                ).order_by('pk')
+            }
+
+            messages = EmailMessage.objects.filter(account=email_account, thread_id__in=thread_ids).order_by()
+            stats = {
+                row['thread_id']: row for row in messages.values('thread_id').annotate(
+                    message_count=Count('id'),
+                    last_message_date=Max('sent_date'),
+                )
+            }
+            unread_counts = dict(messages.filter(read=False).values_list('thread_id').annotate(Count('id')))
+            latest_messages = {
+                row['thread_id']: row for row in messages.order_by('thread_id', '-sent_date').distinct(
+                    'thread_id',
+                ).values('thread_id', 'subject', 'snippet')
+            }
+
+            empty_thread_pks = [thread.pk for thread_id, thread in threads.items() if thread_id not in stats]
+            if empty_thread_pks:
+                self.filter(pk__in=empty_thread_pks).delete()
+
+            for thread_id, row in stats.items():
+                thread = threads[thread_id]
+                values = {
+                    'subject': latest_messages[thread_id]['subject'],
+                    'snippet': latest_messages[thread_id]['snippet'],
+                    'last_message_date': row['last_message_date'],
+                    'message_count': row['message_count'],
+                    'unread_count': unread_counts.get(thread_id, 0),
+                }
+                changed_fields = [name for name, value in values.items() if getattr(thread, name) != value]
+                if changed_fields:
+                    for name in changed_fields:
+                        setattr(thread, name, values[name])
+                    thread.save(update_fields=changed_fields)
+
+            thread_pks = dict((thread_id, threads[thread_id].pk) for thread_id in stats)
+            participants = set()
+            for field_name in ['sender', 'received_by', 'received_by_cc']:
+                participants.update(
+                    (thread_pks[thread_id], recipient_id)
+                    for thread_id, recipient_id in messages.values_list('thread_id', field_name).distinct()
+                    if recipient_id
+                )
+
+            # Only write the participants that changed, most updates just add a message from a known sender.
+            through = self.model.participants.through
+            rows = through.objects.filter(emailthread_id__in=thread_pks.values())
+            existing = dict(
+                ((thread_pk, recipient_id), pk)
+                for pk, thread_pk, recipient_id in rows.values_list('pk', 'emailthread_id', 'recipient_id')
+            )
+            removed_pks = [pk for row, pk in existing.items() if row not in participants]
+            if removed_pks:
+                through.objects.filter(pk__in=removed_pks).delete()
+            through.objects.bulk_create([
+                through(emailthread_id=thread_pk, recipient_id=recipient_id)
+                for thread_pk, recipient_id in participants if (thread_pk, recipient_id) not in existing
+            ])
+
+    def update_unread_counts(self, email_account, thread_ids):
+        """
+        Recalculate only the unread counts of the EmailThreads, after messages were marked as (un)read.
+
+        Uses a single UPDATE statement, that only writes the threads whose count changed.
+
+        Args:
+            email_account (instance): EmailAccount instance
+            thread_ids (iterable): thread_ids of the threads
+        """
+        thread_ids = list(set(thread_id for thread_id in thread_ids if thread_id))
+        if not thread_ids:
+            return
+
+        connection = connections[self.db]
+        tables = {
+            'threads': connection.ops.quote_name(self.model._meta.db_table),
+            'messages': connection.ops.quote_name(EmailMessage._meta.db_table),
+        }
+        unread_count = (
+            '(SELECT COUNT(*) FROM %(messages)s message WHERE message.account_id = %(threads)s.account_id '
+            'AND message.thread_id = %(threads)s.thread_id AND NOT message.read)' % tables
+        )
+        sql = 'UPDATE %s SET unread_count = %s WHERE account_id = %%s AND thread_id IN (%s) AND unread_count <> %s' % (
+            tables['threads'],
+            unread_count,
+            ', '.join(['%s'] * len(thread_ids)),
+            unread_count,
+        )
+
+        connection.cursor().execute(sql, [email_account.pk] + thread_ids)
+
+    def _create_missing(self, email_account, thread_ids):
+        """
+        Create empty EmailThreads for the thread_ids that don't have one yet.
+
+        Threads created by another worker in the meantime make the bulk insert fail, then the threads are created
+        one by one.
+
+        Args:
+            email_account (instance): EmailAccount instance
+            thread_ids (list): thread_ids of the threads
+        """
+        existing = set(self.filter(
+            account=email_account,
+            thread_id__in=thread_ids,
+        ).values_list('thread_id', flat=True))
+        missing = [thread_id for thread_id in thread_ids if thread_id not in existing]
+        if not missing:
+            return
+
+        try:
+            with transaction.atomic():
+                self.bulk_create([self.model(account=email_account, thread_id=thread_id) for thread_id in missing])
+        except IntegrityError:
+            for thread_id in missing:
+                self.get_or_create(account=email_account, thread_id=thread_id)
+
+
+class EmailThread(models.Model):
+    """
+    Conversation of EmailMessages with the same thread_id, kept up to date while syncing.
+    """
+    account = models.ForeignKey(EmailAccount, related_name='threads')
+    thread_id = models.CharField(max_length=50)
+    subject = models.TextField(default='')
+    snippet = models.TextField(default='')
+    participants = models.ManyToManyField(Recipient, related_name='threads')
+    last_message_date = models.DateTimeField(null=True, db_index=True)
+    message_count = models.PositiveIntegerField(default=0)
+    unread_count = models.PositiveIntegerField(default=0)
+
+    objects = EmailThreadManager()
+
+    @property
+    def messages(self):
+        return EmailMessage.objects.filter(account_id=self.account_id, thread_id=self.thread_id).order_by('sent_date')
+
+    def __unicode__(self):
+        return self.subject
+
+    class Meta:
+        app_label = 'email'
+        unique_together = ('account', 'thread_id')
+        ordering = ['-last_message_date']
+
+
 class EmailHeader(models.Model):
     """
     Headers for an EmailMessage
@@ -266,9 +500,16 @@ class EmailHeader(models.Model):
 class EmailAttachment(models.Model):
     """
     Email attachment for an EmailMessage
+
+    When attachments are fetched on demand, only the metadata is stored during sync. Until the file is
+    downloaded, attachment_id holds the Gmail id of the attachment and attachment only holds the filename.
     """
     attachment = models.FileField(upload_to=get_attachment_upload_path, max_length=255)
+    attachment_id = models.TextField(default='')
     cid = models.TextField(default='')
+    # SHA-256 of the file, attachments with the same hash and filename share the file in the storage.
+    content_hash = models.CharField(max_length=64, default='', db_index=True)
+    content_type = models.CharField(max_length=255, default='')
     inline = models.BooleanField(default=False)
     message = models.ForeignKey(EmailMessage, related_name='attachments')
     size = models.PositiveIntegerField(default=0)
@@ -280,7 +521,15 @@ class EmailAttachment(models.Model):
     def name(self):
         return self.attachment.name.split('/')[-1]
 
+    @property
+    def is_downloaded(self):
+        return not self.attachment_id
+
     def download_url(self):
+        if not self.is_downloaded:
+            # The proxy downloads the file first.
+            return reverse('email_attachment_proxy_view', kwargs={'pk': self.pk})
+
         return reverse('download', kwargs={
             'model_name': 'email',
             'field_name': 'attachment',
@@ -429,7 +678,17 @@ class EmailOutboxMessage(TenantMixin, models.Model):
     to = models.TextField(verbose_name=_('to'))
     original_message_id = models.CharField(null=True, blank=True, max_length=50, db_index=True)
 
-    def message(self):
+    def message(self, attachment_placeholders=None):
+        """
+        Build the MIME message.
+
+        Args:
+            attachment_placeholders (dict, optional): with EmailOutboxAttachment pk: placeholder, these attachments
+                get the placeholder as base64 payload instead of their file, see message_file
+
+        Returns:
+            SafeMIMEMultipart instance, or False if an attachment couldn't be read
+        """
         from ..utils import get_attachment_filename_from_url, replace_cid_and_change_headers
 
         to = anyjson.loads(self.to)
@@ -472,23 +731,28 @@ class EmailOutboxMessage(TenantMixin, models.Model):
             if attachment.inline:
                 continue
 
+            filename = get_attachment_filename_from_url(attachment.attachment.name)
+
+            main_type, sub_type = attachment.get_content_type().split('/', 1)
+
+            if attachment_placeholders and attachment.pk in attachment_placeholders:
+                msg = MIMEBase(main_type, sub_type)
+                msg['Content-Transfer-Encoding'] = 'base64'
+                msg.set_payload(attachment_placeholders[attachment.pk])
+                msg.add_header('Content-Disposition', 'attachment', filename=os.path.basename(filename))
+                email_message.attach(msg)
+                continue
+
             try:
                 storage_file = default_storage._open(attachment.attachment.name)
             except IOError:
                 logger.exception('Couldn\'t get attachment, not sending %s' % self.id)
                 return False
 
-            filename = get_attachment_filename_from_url(attachment.attachment.name)
-
             storage_file.open()
             content = storage_file.read()
             storage_file.close()
 
-            content_type, encoding = mimetypes.guess_type(filename)
-            if content_type is None or encoding is not None:
-                content_type = 'application/octet-stream'
-            main_type, sub_type = content_type.split('/', 1)
-
             if main_type == 'text':
                 msg = MIMEText(content, _subtype=sub_type)
             elif main_type == 'image':
@@ -524,12 +788,66 @@ class EmailOutboxMessage(TenantMixin, models.Model):
 
         return email_message
 
+    def message_file(self):
+        """
+        Write the MIME message to a temporary file.
+
+        The attachments are streamed from the storage and encoded one chunk at a time, so they're never completely
+        in memory. Only the message without attachments is built in memory.
+
+        Returns:
+            SpooledTemporaryFile with the message, at position 0
+        """
+        from ..utils import encode_base64_to_file, iter_stored_file
+
+        names = {}
+        placeholders = {}
+        for attachment in self.attachments.all():
+            if not attachment.inline:
+                placeholder = 'attachment-%s-%s' % (attachment.pk, uuid.uuid4().hex)
+                placeholders[attachment.pk] = placeholder
+                names[placeholder] = attachment.attachment.name
+
+        message_file = tempfile.SpooledTemporaryFile(max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE)
+        message_string = self.message(attachment_placeholders=placeholders).as_string()
+        if names:
+            # The placeholders are replaced by the encoded files, the lines around them are kept as they are.
+            parts = re.split('(%s)\n?' % '|'.join(names), message_string)
+        else:
+            parts = [message_string]
+
+        for part in parts:
+            if part in names:
+                encode_base64_to_file(iter_stored_file(names[part], 0), message_file)
+            else:
+                message_file.write(part)
+
+        message_file.seek(0)
+        return message_file
+
     class Meta:
         app_label = 'email'
         verbose_name = _('email outbox message')
         verbose_name_plural = _('email outbox messages')
 
 
+class UnreferencedAttachmentFile(models.Model):
+    """
+    File in the storage of a deleted EmailAttachment, that is deleted by delete_unreferenced_attachment_files.
+
+    The row is inserted in the transaction that deletes the attachment, so the file is kept when that transaction
+    is rolled back. Files that are referred to again by the time they're swept are kept as well.
+    """
+    name = models.CharField(max_length=255)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __unicode__(self):
+        return self.name
+
+    class Meta:
+        app_label = 'email'
+
+
 class EmailOutboxAttachment(TenantMixin):
     inline = models.BooleanField(default=False)
     attachment = models.FileField(upload_to=get_outbox_attachment_upload_path, max_length=255)
@@ -540,6 +858,20 @@ class EmailOutboxAttachment(TenantMixin):
     def __unicode__(self):
         return self.attachment.name
 
+    def get_content_type(self):
+        """
+        Get the content type of the file, guessed from the filename when it wasn't stored.
+        """
+        if '/' in self.content_type:
+            return self.content_type
+
+        content_type, encoding = mimetypes.guess_type(self.attachment.name)
+        if content_type is None or encoding is not None:
+            # Compressed files like .tar.gz would otherwise be sent as the type of their contents.
+            return 'application/octet-stream'
+
+        return content_type
+
     class Meta:
         app_label = 'email'
         verbose_name = _('email outbox attachment')
@@ -549,5 +881,25 @@ class EmailOutboxAttachment(TenantMixin):
 @receiver(post_delete, sender=EmailAttachment)
 def post_delete_mail_attachment_handler(sender, **kwargs):
     attachment = kwargs['instance']
-    storage, filename = attachment.attachment.storage, attachment.attachment.name
-    storage.delete(filename)
+    if not attachment.is_downloaded:
+        # There's no file in the storage yet.
+        return
+
+    # Other attachments with the same content_hash or forwarded attachments may still refer to the file, or do
+    # so before this transaction commits. So the file is only deleted later, when nothing refers to it anymore.
+    UnreferencedAttachmentFile.objects.create(name=attachment.attachment.name)
+
+
+@receiver(post_delete, sender=EmailOutboxAttachment)
+def post_delete_outbox_attachment_handler(sender, **kwargs):
+    attachment = kwargs['instance']
+    name = attachment.attachment.name
+    upload_directory = os.path.dirname(get_outbox_attachment_upload_path(attachment, ''))
+
+    # Forwarded attachments refer to the file of the original EmailAttachment. When the original was deleted
+    # first, the file was kept for this attachment, so check again if anything still refers to it.
+    is_forwarded = (
+        name.startswith(os.path.dirname(upload_directory) + '/') and os.path.dirname(name) != upload_directory
+    )
+    if is_forwarded or EmailAttachment.objects.filter(attachment=name).exists():
+        UnreferencedAttachmentFile.objects.create(name=name)
@@ -0,0 +1,197 @@
+import logging
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+
+from lily.celery import app
+
+
+logger = logging.getLogger(__name__)
+
+MUTATIONS_CACHE_KEY = 'email_label_mutations_%s'
+MUTATIONS_LOCK_KEY = 'email_label_mutations_lock_%s'
+MUTATIONS_FLUSH_KEY = 'email_label_mutations_flush_%s'
+THREADS_CACHE_KEY = 'email_thread_updates_%s'
+THREADS_LOCK_KEY = 'email_thread_updates_lock_%s'
+THREADS_FLUSH_KEY = 'email_thread_updates_flush_%s'
+
+# Seconds before a lock or pending mutations expire, so a crashed worker can't block an account forever.
+MUTATIONS_LOCK_TIMEOUT = 10
+MUTATIONS_TIMEOUT = 24 * 60 * 60
+
+
+def merge_label_mutations(pending, mutations):
+    """
+    Merge label mutations into the pending label mutations, later mutations win.
+
+    Args:
+        pending (dict): with message_id: (set of label_ids to add, set of label_ids to remove)
+        mutations (dict): with message_id: (label_ids to add, label_ids to remove)
+
+    Returns:
+        pending (dict): the updated pending mutations
+    """
+    for message_id, (add_labels, remove_labels) in mutations.items():
+        add, remove = pending.setdefault(message_id, (set(), set()))
+
+        remove.difference_update(add_labels)
+        add.update(add_labels)
+        add.difference_update(remove_labels)
+        remove.update(remove_labels)
+
+    return pending
+
+
+def group_label_mutations(mutations):
+    """
+    Group messages that have exactly the same label mutations, so they can be sent in one batchModify call.
+
+    Args:
+        mutations (dict): with message_id: (label_ids to add, label_ids to remove)
+
+    Returns:
+        dict with (frozenset of label_ids to add, frozenset of label_ids to remove): list of message_ids
+    """
+    groups = {}
+    for message_id, (add_labels, remove_labels) in mutations.items():
+        if add_labels or remove_labels:
+            groups.setdefault((frozenset(add_labels), frozenset(remove_labels)), []).append(message_id)
+
+    return groups
+
+
+@contextmanager
+def mutations_lock(email_account_id, lock_key=MUTATIONS_LOCK_KEY):
+    """
+    Lock the pending label mutations of an EmailAccount for all workers.
+
+    The lock expires after MUTATIONS_LOCK_TIMEOUT seconds, so a stale lock is taken over after waiting that long.
+    Every holder stores its own token in the lock, so a worker whose lock was taken over doesn't release the
+    lock of the worker that took it over.
+
+    Args:
+        email_account_id (int): id of the EmailAccount
+        lock_key (str, optional): format of the cache key of the lock, to lock other pending changes
+    """
+    key = lock_key % email_account_id
+    token = uuid.uuid4().hex
+    started = time.time()
+    while not cache.add(key, token, MUTATIONS_LOCK_TIMEOUT):
+        if time.time() - started > MUTATIONS_LOCK_TIMEOUT:
+            logger.warning('Taking over stale lock %s' % key)
+            cache.set(key, token, MUTATIONS_LOCK_TIMEOUT)
+            break
+        time.sleep(0.05)
+
+    try:
+        yield
+    finally:
+        if cache.get(key) == token:
+            cache.delete(key)
+
+
+def queue_label_mutations(email_account_id, mutations, requeue=False, countdown=None):
+    """
+    Add label mutations to the pending mutations of the EmailAccount and schedule a flush.
+
+    Mutations that arrive within GMAIL_LABEL_MUTATION_DELAY seconds are merged and sent to Gmail together.
+
+    Args:
+        email_account_id (int): id of the EmailAccount
+        mutations (dict): with message_id: (label_ids to add, label_ids to remove)
+        requeue (boolean, optional): if True, the mutations are older than the pending ones, e.g. after a
+            failed flush, so the pending mutations win
+        countdown (int, optional): seconds before the flush, defaults to GMAIL_LABEL_MUTATION_DELAY
+    """
+    if countdown is None:
+        countdown = settings.GMAIL_LABEL_MUTATION_DELAY
+
+    key = MUTATIONS_CACHE_KEY % email_account_id
+    with mutations_lock(email_account_id):
+        pending = cache.get(key) or {}
+        if requeue:
+            pending = merge_label_mutations(merge_label_mutations({}, mutations), pending)
+        else:
+            pending = merge_label_mutations(pending, mutations)
+        cache.set(key, pending, MUTATIONS_TIMEOUT)
+
+    # Only schedule a flush if there isn't one scheduled already. The flag expires in case the flush got lost.
+    if cache.add(MUTATIONS_FLUSH_KEY % email_account_id, True, countdown + 60):
+        app.send_task(
+            'flush_label_mutations',
+            args=[email_account_id],
+            countdown=countdown,
+        )
+
+
+def pop_label_mutations(email_account_id):
+    """
+    Take all pending label mutations of the EmailAccount.
+
+    Args:
+        email_account_id (int): id of the EmailAccount
+
+    Returns:
+        dict with message_id: (set of label_ids to add, set of label_ids to remove)
+    """
+    key = MUTATIONS_CACHE_KEY % email_account_id
+    with mutations_lock(email_account_id):
+        pending = cache.get(key) or {}
+        cache.delete(key)
+        # New mutations should schedule a new flush.
+        cache.delete(MUTATIONS_FLUSH_KEY % email_account_id)
+
+    return pending
+
+
+def queue_thread_updates(email_account_id, thread_ids):
+    """
+    Add threads to the pending thread updates of the EmailAccount and schedule an update.
+
+    Threads that change within GMAIL_THREAD_UPDATE_DELAY seconds, e.g. by all message tasks of a sync page,
+    are recalculated together by one update_email_threads task.
+
+    Args:
+        email_account_id (int): id of the EmailAccount
+        thread_ids (iterable): thread_ids of the changed threads
+    """
+    thread_ids = set(thread_id for thread_id in thread_ids if thread_id)
+    if not thread_ids:
+        return
+
+    key = THREADS_CACHE_KEY % email_account_id
+    with mutations_lock(email_account_id, THREADS_LOCK_KEY):
+        pending = cache.get(key) or set()
+        pending.update(thread_ids)
+        cache.set(key, pending, MUTATIONS_TIMEOUT)
+
+    # Only schedule an update if there isn't one scheduled already. The flag expires in case the update got lost.
+    if cache.add(THREADS_FLUSH_KEY % email_account_id, True, settings.GMAIL_THREAD_UPDATE_DELAY + 60):
+        app.send_task(
+            'update_email_threads',
+            args=[email_account_id],
+            countdown=settings.GMAIL_THREAD_UPDATE_DELAY,
+        )
+
+
+def pop_thread_updates(email_account_id):
+    """
+    Take all pending thread updates of the EmailAccount.
+
+    Args:
+        email_account_id (int): id of the EmailAccount
+
+    Returns:
+        set of thread_ids
+    """
+    key = THREADS_CACHE_KEY % email_account_id
+    with mutations_lock(email_account_id, THREADS_LOCK_KEY):
+        pending = cache.get(key) or set()
+        cache.delete(key)
+        # New changes should schedule a new update.
+        cache.delete(THREADS_FLUSH_KEY % email_account_id)
+
+    return pending
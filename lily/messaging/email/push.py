@@ -0,0 +1,118 @@
+import anyjson
+import logging
+import time
+import uuid
+from base64 import b64decode, b64encode
+
+import requests
+from django.core.cache import cache
+
+
+logger = logging.getLogger(__name__)
+
+PUSH_WATCH_KEY = 'email_watch_%s'
+
+
+def set_watch_expiration(email_account_id, expiration):
+    """
+    Remember until when Gmail sends push notifications for the EmailAccount.
+
+    Args:
+        email_account_id (int): id of the EmailAccount
+        expiration (int): expiration of the watch in ms since epoch, as returned by Gmail
+    """
+    expiration = int(expiration) / 1000.0
+    timeout = int(expiration - time.time())
+    if timeout > 0:
+        cache.set(PUSH_WATCH_KEY % email_account_id, expiration, timeout)
+
+
+def clear_watch_expiration(email_account_id):
+    """
+    Forget the watch of the EmailAccount, after it was stopped or can't be renewed anymore.
+
+    Args:
+        email_account_id (int): id of the EmailAccount
+    """
+    cache.delete(PUSH_WATCH_KEY % email_account_id)
+
+
+def get_watch_expirations(email_account_ids):
+    """
+    Get until when Gmail sends push notifications for EmailAccounts.
+
+    Args:
+        email_account_ids (list): ids of the EmailAccounts
+
+    Returns:
+        dict with email_account_id: expiration timestamp, for the accounts with an active watch
+    """
+    values = cache.get_many([PUSH_WATCH_KEY % pk for pk in email_account_ids])
+
+    return {pk: values[PUSH_WATCH_KEY % pk] for pk in email_account_ids if PUSH_WATCH_KEY % pk in values}
+
+
+def parse_push_notification(body):
+    """
+    Get the mailbox and history id from a Gmail push notification, as delivered by a Pub/Sub push subscription.
+
+    Args:
+        body (str): body of the request
+
+    Returns:
+        tuple with the email address and history id of the notification
+
+    Raises:
+        ValueError: if the body isn't a valid notification
+    """
+    try:
+        data = anyjson.deserialize(b64decode(anyjson.deserialize(body)['message']['data']))
+        return data['emailAddress'], int(data['historyId'])
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError('Invalid push notification: %s' % e)
+
+
+def build_push_notification(email_address, history_id):
+    """
+    Build a Gmail push notification the way Pub/Sub delivers it to a push subscription.
+
+    Args:
+        email_address (str): email address of the mailbox that changed
+        history_id (int): history id of the change
+
+    Returns:
+        str: body of the request
+    """
+    data = anyjson.serialize({
+        'emailAddress': email_address,
+        'historyId': history_id,
+    })
+
+    return anyjson.serialize({
+        'message': {
+            'data': b64encode(data),
+            'message_id': uuid.uuid4().hex,
+        },
+        'subscription': 'projects/local/subscriptions/gmail',
+    })
+
+
+def publish_push_notification(url, email_address, history_id):
+    """
+    Stand-in for Pub/Sub, to test the push notifications without Google.
+
+    Args:
+        url (str): url of the webhook, including the token
+        email_address (str): email address of the mailbox that changed
+        history_id (int): history id of the change
+
+    Returns:
+        int: status code of the response
+    """
+    response = requests.post(
+        url,
+        data=build_push_notification(email_address, history_id),
+        headers={'Content-Type': 'application/json'},
+    )
+
+    return response.status_code
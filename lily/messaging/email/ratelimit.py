@@ -0,0 +1,147 @@
+import logging
+import time
+
+import redis
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+# Atomically refill the token bucket of an account and take the requested tokens.
+# The rate of the bucket recovers linearly after it was lowered by a rate limit error from Gmail.
+# Returns the seconds to wait before the tokens are available, the tokens are only taken if no wait is needed.
+# More tokens than the capacity are taken from a full bucket, the balance goes negative and later calls wait
+# until it is paid back.
+ACQUIRE_SCRIPT = """
+local key = KEYS[1]
+local now = tonumber(ARGV[1])
+local max_rate = tonumber(ARGV[2])
+local capacity = tonumber(ARGV[3])
+local recovery = tonumber(ARGV[4])
+local requested = tonumber(ARGV[5])
+
+local data = redis.call('HMGET', key, 'tokens', 'timestamp', 'rate')
+local tokens = tonumber(data[1]) or capacity
+local timestamp = tonumber(data[2]) or now
+local rate = tonumber(data[3]) or max_rate
+
+local elapsed = math.max(0, now - timestamp)
+rate = math.min(max_rate, rate + elapsed * recovery)
+tokens = math.min(capacity, tokens + elapsed * rate)
+
+local needed = math.min(requested, capacity)
+local wait = 0
+if tokens >= needed then
+    tokens = tokens - requested
+else
+    wait = (needed - tokens) / rate
+end
+
+redis.call('HMSET', key, 'tokens', tokens, 'timestamp', now, 'rate', rate)
+redis.call('EXPIRE', key, 3600)
+return tostring(wait)
+"""
+
+# Halve the rate of the bucket and empty it, after Gmail returned a rate limit error.
+PENALIZE_SCRIPT = """
+local key = KEYS[1]
+local now = tonumber(ARGV[1])
+local max_rate = tonumber(ARGV[2])
+local min_rate = tonumber(ARGV[3])
+
+local rate = tonumber(redis.call('HGET', key, 'rate')) or max_rate
+rate = math.max(min_rate, rate / 2)
+
+redis.call('HMSET', key, 'tokens', 0, 'timestamp', now, 'rate', rate)
+redis.call('EXPIRE', key, 3600)
+return tostring(rate)
+"""
+
+
+class GmailRateLimiter(object):
+    """
+    Token bucket per EmailAccount, shared by all workers through Redis.
+
+    Every worker takes tokens before calling the Gmail api for an account. When Gmail returns a rate limit
+    error, the rate of the account is halved and recovers linearly to max_rate again.
+
+    Attributes:
+        max_rate (float): max api calls per second per account
+        min_rate (float): min api calls per second per account after rate limit errors
+        capacity (int): max number of calls in a burst
+        recovery (float): calls per second the rate is increased every second
+    """
+    key = 'gmail_rate_limit_%s'
+
+    def __init__(self, max_rate, min_rate, capacity, recovery):
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.capacity = capacity
+        self.recovery = recovery
+        self.redis = None
+        self.acquire_script = None
+        self.penalize_script = None
+
+    def get_redis(self):
+        """
+        Connect to Redis and register the scripts on first use.
+        """
+        if self.redis is None:
+            self.redis = redis.StrictRedis(
+                host=settings.REDIS.hostname,
+                port=settings.REDIS.port,
+                password=settings.REDIS.password,
+            )
+            self.acquire_script = self.redis.register_script(ACQUIRE_SCRIPT)
+            self.penalize_script = self.redis.register_script(PENALIZE_SCRIPT)
+
+        return self.redis
+
+    def acquire(self, email_account_id, tokens=1):
+        """
+        Take tokens for api calls for the EmailAccount.
+
+        When Redis isn't available, the calls aren't limited.
+
+        Args:
+            email_account_id (int): id of the EmailAccount
+            tokens (int, optional): number of api calls
+
+        Returns:
+            float: seconds to wait before the calls can be done, 0 if the tokens are taken
+        """
+        try:
+            self.get_redis()
+            return float(self.acquire_script(
+                keys=[self.key % email_account_id],
+                args=[time.time(), self.max_rate, self.capacity, self.recovery, tokens],
+            ))
+        except redis.RedisError:
+            logger.exception('Couldn\'t check rate limit for account %s' % email_account_id)
+            return 0
+
+    def penalize(self, email_account_id):
+        """
+        Lower the rate for the EmailAccount after Gmail returned a rate limit error.
+
+        Args:
+            email_account_id (int): id of the EmailAccount
+        """
+        try:
+            self.get_redis()
+            rate = self.penalize_script(
+                keys=[self.key % email_account_id],
+                args=[time.time(), self.max_rate, self.min_rate],
+            )
+        except redis.RedisError:
+            logger.exception('Couldn\'t lower rate limit for account %s' % email_account_id)
+        else:
+            logger.warning('Rate limit for account %s lowered to %s calls per second' % (email_account_id, rate))
+
+
+gmail_rate_limiter = GmailRateLimiter(
+    max_rate=settings.GMAIL_RATE_LIMIT,
+    min_rate=settings.GMAIL_RATE_LIMIT_MIN,
+    capacity=settings.GMAIL_RATE_LIMIT_BURST,
+    recovery=settings.GMAIL_RATE_LIMIT_RECOVERY,
+)
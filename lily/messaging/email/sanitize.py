@@ -1,5 +1,8 @@
 import bleach
 
+# Version of the whitelists below, bump it when they change so stored bodies are sanitized again in the background.
+SANITIZE_VERSION = 2
+
 _ALLOWED_TAGS = [
     'a', 'abbr', 'acronym', 'address', 'area', 'article', 'aside', 'b', 'base', 'bdi', 'big', 'blockquote', 'body',
     'br', 'button', 'caption', 'center', 'cite', 'code', 'col', 'colgroup', 'data', 'datalist', 'dd', 'del', 'details',
@@ -24,6 +27,9 @@ _ALLOWED_ATTRIBUTES = [
     'usemap', 'valign', 'value', 'vspace', 'width', 'wrap'
 ]
 
+# Inline images refer to their attachment with a cid: url, they're replaced by links when the body is rendered.
+_ALLOWED_PROTOCOLS = bleach.ALLOWED_PROTOCOLS + ['cid']
+
 _ALLOWED_STYLES = [
     'background', 'background-attachment', 'background-color', 'background-image', 'background-position',
     'background-repeat', 'border', 'border-bottom', 'border-bottom-color', 'border-bottom-style',
@@ -51,6 +57,7 @@ def sanitize_html_email(html):
         tags=_ALLOWED_TAGS,
         attributes=_ALLOWED_ATTRIBUTES,
         styles=_ALLOWED_STYLES,
+        protocols=_ALLOWED_PROTOCOLS,
         strip=True,
         strip_comments=True
     )
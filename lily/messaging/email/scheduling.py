@@ -0,0 +1,302 @@
+import logging
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+
+from lily.celery import app
+
+
+logger = logging.getLogger(__name__)
+
+SYNC_IN_FLIGHT_KEY = 'email_sync_in_flight_%s'
+SYNC_STATE_KEY = 'email_sync_state_%s'
+SYNC_REQUESTED_KEY = 'email_sync_requested_%s'
+SCHEDULER_LOCK_KEY = 'email_sync_scheduler_lock'
+FIRST_SYNC_HEAD_KEY = 'email_first_sync_head_%s'
+FIRST_SYNC_TAIL_KEY = 'email_first_sync_tail_%s'
+FIRST_SYNC_TASK_KEY = 'email_first_sync_task_%s_%s'
+
+# Seconds before the sync state and the queued first sync tasks of an account expire.
+SYNC_STATE_TIMEOUT = 24 * 60 * 60
+FIRST_SYNC_TIMEOUT = 7 * 24 * 60 * 60
+
+
+def mark_sync_started(email_account_id):
+    """
+    Mark a sync of the EmailAccount as queued or running.
+
+    The mark expires after GMAIL_SYNC_LOCK_LIFETIME seconds, so a lost task doesn't block the account forever.
+
+    Args:
+        email_account_id (int): id of the EmailAccount
+
+    Returns:
+        boolean: False if there already is a sync in flight for the account
+    """
+    return cache.add(SYNC_IN_FLIGHT_KEY % email_account_id, True, settings.GMAIL_SYNC_LOCK_LIFETIME)
+
+
+def refresh_sync_started(email_account_id):
+    """
+    Extend the mark of a running sync of the EmailAccount, e.g. after every page of a long listing.
+
+    A sync that takes longer than GMAIL_SYNC_LOCK_LIFETIME seconds would otherwise lose its mark, and the scheduler
+    would start another sync of the same account while it's still running.
+
+    Args:
+        email_account_id (int): id of the EmailAccount
+    """
+    cache.set(SYNC_IN_FLIGHT_KEY % email_account_id, True, settings.GMAIL_SYNC_LOCK_LIFETIME)
+
+
+def mark_sync_finished(email_account_id, changes=0):
+    """
+    Mark the sync of the EmailAccount as done and remember when it was done.
+
+    Args:
+        email_account_id (int): id of the EmailAccount
+        changes (int, optional): number of changes processed by the sync
+    """
+    cache.set(SYNC_STATE_KEY % email_account_id, (time.time(), changes), SYNC_STATE_TIMEOUT)
+    cache.delete(SYNC_IN_FLIGHT_KEY % email_account_id)
+
+
+def request_sync(email_account_id):
+    """
+    Queue a sync for the EmailAccount right away, e.g. after a push notification.
+
+    When a sync is already in flight it may have missed the change, so another sync is queued after it finished.
+
+    Args:
+        email_account_id (int): id of the EmailAccount
+
+    Returns:
+        boolean: True if a sync was queued
+    """
+    if mark_sync_started(email_account_id):
+        app.send_task('synchronize_email_account', args=[email_account_id], queue='email_scheduled_tasks')
+        return True
+
+    cache.set(SYNC_REQUESTED_KEY % email_account_id, True, settings.GMAIL_SYNC_LOCK_LIFETIME)
+    return False
+
+
+def pop_sync_request(email_account_id):
+    """
+    Check if a sync was requested for the EmailAccount while its previous sync was in flight.
+
+    Args:
+        email_account_id (int): id of the EmailAccount
+
+    Returns:
+        boolean: True if a sync was requested
+    """
+    requested = cache.get(SYNC_REQUESTED_KEY % email_account_id)
+    if requested:
+        cache.delete(SYNC_REQUESTED_KEY % email_account_id)
+
+    return bool(requested)
+
+
+def get_sync_priority(state, now):
+    """
+    Calculate how urgent a sync of an EmailAccount is.
+
+    The priority is the number of seconds since the last sync, up to doubled for accounts that had a lot of
+    changes in their last sync. Accounts that haven't been synced yet come first.
+
+    Args:
+        state (tuple): (timestamp of the last sync, number of changes) or None
+        now (float): current timestamp
+
+    Returns:
+        float: higher is more urgent
+    """
+    if state is None:
+        return float('inf')
+
+    last_synced, changes = state
+    volume = min(changes, settings.GMAIL_PARTIAL_SYNC_LIMIT) / float(settings.GMAIL_PARTIAL_SYNC_LIMIT)
+    return max(0, now - last_synced) * (1 + volume)
+
+
+def order_by_sync_priority(email_account_ids, states, now):
+    """
+    Sort EmailAccounts by the urgency of a sync, most urgent first.
+
+    Args:
+        email_account_ids (list): ids of the EmailAccounts
+        states (dict): with email_account_id: state as used by get_sync_priority
+        now (float): current timestamp
+
+    Returns:
+        list: the sorted ids
+    """
+    return sorted(email_account_ids, key=lambda pk: get_sync_priority(states.get(pk), now), reverse=True)
+
+
+def get_sync_states(email_account_ids):
+    """
+    Get the sync states of EmailAccounts that don't have a sync in flight.
+
+    Args:
+        email_account_ids (list): ids of the EmailAccounts
+
+    Returns:
+        dict with email_account_id: state as used by get_sync_priority, for accounts without a sync in flight
+    """
+    keys = [SYNC_IN_FLIGHT_KEY % pk for pk in email_account_ids] + [SYNC_STATE_KEY % pk for pk in email_account_ids]
+    values = cache.get_many(keys)
+
+    return {
+        pk: values.get(SYNC_STATE_KEY % pk)
+        for pk in email_account_ids if SYNC_IN_FLIGHT_KEY % pk not in values
+    }
+
+
+def interleave(lists):
+    """
+    Take items from the lists in turn, so every list gets an equal share of the first items.
+
+    Args:
+        lists (list): lists of items
+
+    Returns:
+        list: all items, interleaved
+    """
+    result = []
+    for i in range(max(len(items) for items in lists) if lists else 0):
+        result.extend(items[i] for items in lists if i < len(items))
+
+    return result
+
+
+@contextmanager
+def scheduler_lock():
+    """
+    Make sure only one scheduler run dispatches tasks at the same time.
+
+    Yields:
+        boolean: True if the lock was taken
+    """
+    locked = cache.add(SCHEDULER_LOCK_KEY, True, settings.GMAIL_SYNC_LOCK_LIFETIME)
+    try:
+        yield locked
+    finally:
+        if locked:
+            cache.delete(SCHEDULER_LOCK_KEY)
+
+
+def queue_first_sync_task(email_account_id, position, task_name, args):
+    """
+    Add a task to the first sync queue of the EmailAccount.
+
+    The tasks aren't sent to the broker directly, the scheduler dispatches them fairly between tenants.
+
+    The queue only lives in the cache, so the cache may evict any part of it. The listing of the first sync is the
+    only producer and keeps the position of the next task itself, so an evicted tail is written again at the right
+    position and the scheduler finds the gap, see pop_first_sync_tasks.
+
+    Args:
+        email_account_id (int): id of the EmailAccount
+        position (int): position of the task in the queue, starting at 0 for every listing
+        task_name (str): name of the task
+        args (list): arguments for the task
+    """
+    if position == 0:
+        # Forget the queue of a previous listing.
+        clear_first_sync_tasks(email_account_id)
+
+    cache.set(FIRST_SYNC_TASK_KEY % (email_account_id, position), (task_name, args), FIRST_SYNC_TIMEOUT)
+    # Only move the tail after the task is stored, so the scheduler never reads a missing task.
+    cache.set(FIRST_SYNC_TAIL_KEY % email_account_id, position + 1, FIRST_SYNC_TIMEOUT)
+
+
+def pop_first_sync_tasks(email_account_id, limit):
+    """
+    Take tasks from the first sync queue of the EmailAccount, oldest first.
+
+    Only call this for accounts whose listing is done, the queue then has at least the first_sync_finished task
+    until that task is dispatched. Evicted or expired tasks or positions are expected, the messages of those
+    tasks would never be downloaded. So when any part of the queue is missing, the whole queue is cleared and
+    None is returned, the first sync has to start over. Messages that are stored already only get their labels
+    updated then.
+
+    Args:
+        email_account_id (int): id of the EmailAccount
+        limit (int): max number of tasks
+
+    Returns:
+        list of (task_name, args) tuples, or None if tasks were lost
+    """
+    positions = cache.get_many([FIRST_SYNC_HEAD_KEY % email_account_id, FIRST_SYNC_TAIL_KEY % email_account_id])
+    head = positions.get(FIRST_SYNC_HEAD_KEY % email_account_id, 0)
+    tail = positions.get(FIRST_SYNC_TAIL_KEY % email_account_id)
+
+    keys = []
+    values = {}
+    if tail is not None and head <= tail:
+        keys = [FIRST_SYNC_TASK_KEY % (email_account_id, i) for i in range(head, min(tail, head + limit))]
+        values = cache.get_many(keys)
+
+    if tail is None or head > tail or len(values) < len(keys):
+        logger.warning('Lost first sync tasks for account %s, restarting the first sync' % email_account_id)
+        clear_first_sync_tasks(email_account_id)
+        return None
+
+    if not keys:
+        return []
+
+    cache.set(FIRST_SYNC_HEAD_KEY % email_account_id, head + len(keys), FIRST_SYNC_TIMEOUT)
+    cache.delete_many(keys)
+
+    return [values[key] for key in keys]
+
+
+def clear_first_sync_tasks(email_account_id):
+    """
+    Remove all tasks from the first sync queue of the EmailAccount.
+
+    Args:
+        email_account_id (int): id of the EmailAccount
+    """
+    head = cache.get(FIRST_SYNC_HEAD_KEY % email_account_id) or 0
+    tail = cache.get(FIRST_SYNC_TAIL_KEY % email_account_id) or 0
+    cache.delete_many([FIRST_SYNC_TASK_KEY % (email_account_id, i) for i in range(head, tail)])
+    cache.delete_many([FIRST_SYNC_HEAD_KEY % email_account_id, FIRST_SYNC_TAIL_KEY % email_account_id])
+
+
+def dispatch_first_sync_tasks(email_account_ids_by_tenant):
+    """
+    Send queued first sync tasks to the broker with fair queuing per tenant.
+
+    Every tenant gets GMAIL_FIRST_SYNC_TASKS_PER_TENANT tasks per run, divided over its accounts (but at least
+    one task per account). So a tenant with many or big mailboxes can't fill the first sync queue for everybody
+    else.
+
+    Args:
+        email_account_ids_by_tenant (dict): with tenant_id: ids of EmailAccounts with a first sync in progress
+
+    Returns:
+        list: ids of the EmailAccounts that lost first sync tasks and need a new first sync
+    """
+    limit = settings.GMAIL_FIRST_SYNC_TASKS_PER_TENANT
+    tenant_tasks = []
+    lost_email_account_ids = []
+    for tenant_id, email_account_ids in email_account_ids_by_tenant.items():
+        share = max(1, limit // len(email_account_ids))
+        account_tasks = []
+        for pk in email_account_ids:
+            tasks = pop_first_sync_tasks(pk, share)
+            if tasks is None:
+                lost_email_account_ids.append(pk)
+            else:
+                account_tasks.append(tasks)
+        tenant_tasks.append(interleave(account_tasks))
+
+    for task_name, args in interleave(tenant_tasks):
+        app.send_task(task_name, args=args, queue='email_first_sync')
+
+    return lost_email_account_ids
@@ -1,6 +1,42 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
 import httplib2
+from django.conf import settings
+from googleapiclient.discovery import build, build_from_document, DISCOVERY_URI
+
+
+logger = logging.getLogger(__name__)
+
+# The Gmail discovery document, fetched once per process.
+_discovery_document = None
+
+
+def get_gmail_discovery_document():
+    """
+    Get the Gmail discovery document, only fetch it when it isn't fetched yet by this process.
+
+    Returns:
+        string with the discovery document or None if it couldn't be fetched
+    """
+    global _discovery_document
+
+    if _discovery_document is None:
+        uri = DISCOVERY_URI.format(api='gmail', apiVersion='v1')
+        try:
+            response, content = httplib2.Http().request(uri)
+        except Exception:
+            logger.exception('Couldn\'t fetch gmail discovery document')
+        else:
+            if response.status == 200:
+                _discovery_document = content
+            else:
+                logger.warning('Couldn\'t fetch gmail discovery document, status %s' % response.status)
 
-from googleapiclient.discovery import build
+    return _discovery_document
 
 
 def build_gmail_service(credentials):
@@ -14,4 +50,128 @@ def build_gmail_service(credentials):
       Gmail service object.
     """
     http = credentials.authorize(httplib2.Http())
+
+    discovery_document = get_gmail_discovery_document()
+    if discovery_document:
+        return build_from_document(discovery_document, http=http)
+
     return build('gmail', 'v1', http=http)
+
+
+class GmailServiceCache(object):
+    """
+    Per process cache of authorized Gmail service objects, keyed by EmailAccount id.
+
+    A service is checked out with acquire and handed back with release, so a service (and the httplib2.Http
+    it uses) is never used by two threads or greenlets at the same time. Entries are evicted when they are
+    older than the timeout or when the cache holds more than max_size services (least recently used first).
+
+    Attributes:
+        max_size (int): max number of idle services in the cache
+        timeout (int): seconds before a cached service is rebuilt
+    """
+    def __init__(self, max_size, timeout):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.size = 0
+        # Maps account id to a list of idle (service, credentials, created) tuples.
+        self.entries = OrderedDict()
+
+    def _check_pid(self):
+        """
+        Clear the cache when the process was forked, connections can't be shared between processes.
+        """
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.entries.clear()
+            self.size = 0
+
+    def acquire(self, email_account, get_credentials):
+        """
+        Get a cached service for the EmailAccount or build a new one.
+
+        The credentials are read and checked on every acquire, like before services were cached. A cached
+        service is only used when it was built with the same refresh token, so a service of revoked or replaced
+        credentials is never used, whichever process stored the new credentials.
+
+        Args:
+            email_account (instance): EmailAccount instance
+            get_credentials (function): called with the email_account to get valid credentials
+
+        Returns:
+            Gmail service object
+        """
+        # Raises InvalidCredentialsError if the account has no valid credentials anymore.
+        stored_credentials = get_credentials(email_account)
+
+        entry = None
+        with self.lock:
+            self._check_pid()
+            idle = self.entries.get(email_account.pk)
+            while idle:
+                entry = idle.pop()
+                self.size -= 1
+                same_credentials = entry[1].refresh_token == stored_credentials.refresh_token
+                if same_credentials and time.time() - entry[2] < self.timeout:
+                    break
+                entry = None
+
+            if idle is not None and not idle:
+                del self.entries[email_account.pk]
+
+        if entry is not None:
+            service, credentials, created = entry
+            if credentials.access_token_expired:
+                # Refresh in place, the new token is stored by the credentials storage.
+                try:
+                    credentials.refresh(httplib2.Http())
+                except Exception:
+                    logger.warning('Couldn\'t refresh cached credentials for account %s' % email_account.pk)
+                else:
+                    return service, credentials, created
+            else:
+                return service, credentials, created
+
+        return build_gmail_service(stored_credentials), stored_credentials, time.time()
+
+    def release(self, email_account_id, entry):
+        """
+        Hand back a service acquired with acquire, so it can be reused.
+
+        Args:
+            email_account_id (int): id of the EmailAccount
+            entry (tuple): as returned by acquire
+        """
+        if time.time() - entry[2] >= self.timeout:
+            return
+
+        with self.lock:
+            self._check_pid()
+            self.entries.setdefault(email_account_id, []).append(entry)
+            # Mark as most recently used.
+            self.entries[email_account_id] = self.entries.pop(email_account_id)
+            self.size += 1
+
+            while self.size > self.max_size:
+                account_id, idle = self.entries.popitem(last=False)
+                self.size -= len(idle)
+
+    def invalidate(self, email_account_id):
+        """
+        Remove all cached services for the EmailAccount from the cache of this process, e.g. when it got new
+        credentials. Other processes notice the new credentials when the service is acquired.
+
+        Args:
+            email_account_id (int): id of the EmailAccount
+        """
+        with self.lock:
+            self._check_pid()
+            self.size -= len(self.entries.pop(email_account_id, []))
+
+
+gmail_service_cache = GmailServiceCache(
+    max_size=settings.GMAIL_SERVICE_CACHE_SIZE,
+    timeout=settings.GMAIL_SERVICE_CACHE_TIMEOUT,
+)
@@ -1,42 +1,119 @@
 import logging
+import time
 import traceback
+from datetime import timedelta
 
+from celery.exceptions import Retry
 from celery.task import task
-from django.core.files.base import ContentFile
+from django.conf import settings
+from django.core.cache import cache
 from django.core.files.storage import default_storage
+from django.utils import timezone
 
 from lily.utils.functions import post_intercom_event
+from .connector import RateLimitError
 from .manager import GmailManager, ManagerError
 from .models.models import (EmailAccount, EmailMessage, EmailOutboxMessage, EmailTemplateAttachment,
-                            EmailOutboxAttachment, EmailAttachment)
+                            EmailOutboxAttachment, EmailAttachment, EmailThread, UnreferencedAttachmentFile)
+from .mutations import pop_label_mutations, pop_thread_updates, queue_label_mutations, queue_thread_updates
+from .push import clear_watch_expiration, get_watch_expirations, set_watch_expiration
+from .sanitize import SANITIZE_VERSION, sanitize_html_email
+from .scheduling import (dispatch_first_sync_tasks, get_sync_states, mark_sync_finished, mark_sync_started,
+                         order_by_sync_priority, pop_sync_request, request_sync, scheduler_lock)
+from .utils import cache_email_body
 
 
 logger = logging.getLogger(__name__)
 
+RESANITIZE_LOCK_KEY = 'email_resanitize_lock'
+ATTACHMENT_SWEEP_LOCK_KEY = 'email_attachment_sweep_lock'
 
-@task(name='synchronize_email_account_scheduler')
-def synchronize_email_account_scheduler():
+
+def defer_task(task, countdown, args=None):
     """
-    Start new tasks for every active mailbox to start synchronizing.
+    Send a task again after it was deferred by the rate limit of the account, without using up a retry.
+
+    The retries of a task are kept for errors, so an account that stays rate limited for a while only delays its
+    tasks instead of dropping them.
+
+    Args:
+        task (instance): the bound task that is running
+        countdown (float): seconds before the task should run again
+        args (tuple, optional): arguments of the new attempt, defaults to the arguments of the running task
+
+    Returns:
+        Retry instance, to raise so the worker marks the running task as retried
     """
-    for email_account in EmailAccount.objects.filter(is_authorized=True, is_deleted=False):
-        logger.debug('Scheduling sync for %s', email_account.email_address)
+    request = task.request
+    task.subtask_from_request(request, args, None, countdown=countdown, retries=request.retries).apply_async()
+    return Retry(when=countdown)
 
-        if not email_account.history_id:
-            # First synchronize
-            logger.debug('Adding task for first sync for %s', email_account.email_address)
-            first_synchronize_email_account.apply_async(
-                args=(email_account.pk,),
-                max_retries=1,
-                default_retry_delay=100,
-            )
-        else:
-            # Incremental synchronize
-            logger.info('Adding task for sync for: %s', email_account.email_address)
-            synchronize_email_account.apply_async(
-                args=(email_account.pk,),
-                max_retries=1,
-                default_retry_delay=100,
+
+@task(name='synchronize_email_account_scheduler')
+def synchronize_email_account_scheduler():
+    """
+    Start new sync tasks for the active mailboxes.
+
+    Accounts that still have a sync queued or running are skipped. The other accounts are synced in order of
+    staleness and the number of changes in their last sync, at most GMAIL_SYNC_MAX_PER_RUN per run. Queued
+    first sync downloads are dispatched with fair queuing per tenant.
+    """
+    with scheduler_lock() as locked:
+        if not locked:
+            logger.info('Previous scheduler run still busy, skipping')
+            return
+
+        email_accounts = list(EmailAccount.objects.filter(
+            is_authorized=True,
+            is_deleted=False,
+        ).values_list('pk', 'tenant_id', 'history_id', 'first_sync_finished'))
+
+        history_ids = {pk: history_id for pk, tenant_id, history_id, first_sync_finished in email_accounts}
+        states = get_sync_states(history_ids.keys())
+        now = time.time()
+
+        # Accounts with push notifications are synced when they change, polling them is only a fallback.
+        for pk in get_watch_expirations(states.keys()):
+            if states[pk] and now - states[pk][0] < settings.GMAIL_PUSH_POLL_INTERVAL:
+                del states[pk]
+
+        scheduled = 0
+        for pk in order_by_sync_priority(states.keys(), states, now):
+            if scheduled >= settings.GMAIL_SYNC_MAX_PER_RUN:
+                break
+            if not mark_sync_started(pk):
+                continue
+
+            scheduled += 1
+            if not history_ids[pk]:
+                # First synchronize
+                logger.debug('Adding task for first sync for %s', pk)
+                first_synchronize_email_account.apply_async(
+                    args=(pk,),
+                    max_retries=1,
+                    default_retry_delay=100,
+                )
+            else:
+                # Incremental synchronize
+                logger.info('Adding task for sync for: %s', pk)
+                synchronize_email_account.apply_async(
+                    args=(pk,),
+                    max_retries=1,
+                    default_retry_delay=100,
+                )
+
+        first_sync_account_ids = {}
+        for pk, tenant_id, history_id, first_sync_finished in email_accounts:
+            if history_id and not first_sync_finished:
+                first_sync_account_ids.setdefault(tenant_id, []).append(pk)
+
+        lost_email_account_ids = dispatch_first_sync_tasks(first_sync_account_ids)
+        if lost_email_account_ids:
+            # Without a history id, the accounts get a new first sync on the next run. Messages that are
+            # downloaded already only get their labels updated.
+            EmailAccount.objects.filter(pk__in=lost_email_account_ids).update(
+                history_id=None,
+                first_sync_finished=False,
             )
 
 
@@ -52,15 +129,20 @@ def synchronize_email_account(account_id):
         email_account = EmailAccount.objects.get(pk=account_id, is_deleted=False)
     except EmailAccount.DoesNotExist:
         logger.warning('EmailAccount no longer exists: %s', account_id)
+        mark_sync_finished(account_id)
         return False
 
+    changes = 0
     if email_account.is_authorized:
-        manager = GmailManager(email_account)
+        manager = GmailManager(email_account, defer_rate_limits=True)
         try:
-            manager.sync_by_history()
+            changes = manager.sync_by_history()
             logger.info('History page sync done for: %s', email_account)
         except ManagerError:
             pass
+        except RateLimitError:
+            # The history id is saved per page, so the next sync continues where this one stopped.
+            logger.info('Rate limited, continuing sync on next run for: %s', email_account)
         except Exception:
             logger.exception('No sync for account %s' % email_account)
         finally:
@@ -68,6 +150,90 @@ def synchronize_email_account(account_id):
     else:
         logger.info('Not syncing, no authorization for: %s', email_account.email_address)
 
+    mark_sync_finished(account_id, changes)
+    if pop_sync_request(account_id):
+        # A push notification arrived during the sync, it may have missed the change.
+        request_sync(account_id)
+
+
+@task(name='renew_email_account_watches')
+def renew_email_account_watches():
+    """
+    Start watch tasks for the mailboxes without push notifications or with a watch that expires within a day.
+
+    Gmail stops sending push notifications when the watch isn't renewed within 7 days.
+    """
+    if not settings.GMAIL_PUSH_TOPIC:
+        return
+
+    email_account_ids = list(EmailAccount.objects.filter(
+        is_authorized=True,
+        is_deleted=False,
+        history_id__isnull=False,
+    ).values_list('pk', flat=True))
+
+    expirations = get_watch_expirations(email_account_ids)
+    renew_before = time.time() + 24 * 60 * 60
+    for pk in email_account_ids:
+        if expirations.get(pk, 0) < renew_before:
+            watch_email_account.apply_async(args=(pk,))
+
+
+@task(name='watch_email_account', logger=logger)
+def watch_email_account(account_id):
+    """
+    Let Gmail send push notifications for changes in the mailbox.
+
+    Args:
+        account_id (int): id of the EmailAccount
+    """
+    try:
+        email_account = EmailAccount.objects.get(pk=account_id, is_deleted=False)
+    except EmailAccount.DoesNotExist:
+        logger.warning('EmailAccount no longer exists: %s', account_id)
+        return
+
+    manager = GmailManager(email_account)
+    try:
+        response = manager.connector.watch(settings.GMAIL_PUSH_TOPIC)
+        set_watch_expiration(account_id, response['expiration'])
+        logger.debug('Watching %s until %s', email_account, response['expiration'])
+    except Exception:
+        # Polling keeps the account in sync until the next renewal.
+        logger.exception('Couldn\'t watch account %s' % email_account)
+    finally:
+        manager.cleanup()
+
+
+@task(name='unwatch_email_account', logger=logger)
+def unwatch_email_account(account_id):
+    """
+    Stop the push notifications for the mailbox of a deleted EmailAccount.
+
+    Args:
+        account_id (int): id of the EmailAccount
+    """
+    try:
+        email_account = EmailAccount.objects.get(pk=account_id)
+    except EmailAccount.DoesNotExist:
+        logger.warning('EmailAccount no longer exists: %s', account_id)
+        return
+
+    clear_watch_expiration(account_id)
+    try:
+        manager = GmailManager(email_account)
+    except ManagerError:
+        # Without credentials the watch can't be stopped, it expires within 7 days.
+        return
+
+    try:
+        manager.connector.stop_watch()
+        logger.debug('Stopped watching %s', email_account)
+    except Exception:
+        logger.exception('Couldn\'t stop watching account %s' % email_account)
+    finally:
+        manager.cleanup()
+
 
 @task(name='first_synchronize_email_account', logger=logger)
 def first_synchronize_email_account(account_id):
@@ -91,6 +257,8 @@ def first_synchronize_email_account(account_id):
         finally:
             manager.cleanup()
 
+    mark_sync_finished(account_id)
+
 
 @task(name='first_sync_finished', logger=logger)
 def first_sync_finished(account_id):
@@ -130,10 +298,12 @@ def download_email_message(self, account_id, message_id):
     except EmailAccount.DoesNotExist:
         logger.warning('EmailAccount no longer exists: %s', account_id)
     else:
-        manager = GmailManager(email_account)
+        manager = GmailManager(email_account, defer_rate_limits=True)
         try:
             logger.debug('Fetch message %s for: %s' % (message_id, email_account))
             manager.download_message(message_id)
+        except RateLimitError as exc:
+            raise defer_task(self, exc.countdown)
         except Exception as exc:
             logger.exception('Fetch message %s for: %s failed' % (message_id, email_account))
             raise self.retry(exc=exc)
@@ -141,6 +311,44 @@ def download_email_message(self, account_id, message_id):
             manager.cleanup()
 
 
+@task(name='download_email_messages', logger=logger, acks_late=True, bind=True)
+def download_email_messages(self, account_id, message_ids):
+    """
+    Download a chunk of messages with a single manager.
+
+    Messages that are already stored are skipped on a retry, so the chunk resumes where it stopped.
+
+    Args:
+        account_id (int): id of the EmailAccount
+        message_ids (list): google ids of EmailMessages
+    """
+    try:
+        email_account = EmailAccount.objects.get(pk=account_id, is_deleted=False)
+    except EmailAccount.DoesNotExist:
+        logger.warning('EmailAccount no longer exists: %s', account_id)
+        return
+
+    manager = GmailManager(email_account, defer_rate_limits=True)
+    try:
+        logger.debug('Fetch %s messages for: %s' % (len(message_ids), email_account))
+        failed_message_ids = manager.download_messages(message_ids)
+        countdown = manager.connector.deferred_countdown
+    except RateLimitError as exc:
+        raise defer_task(self, exc.countdown)
+    except Exception as exc:
+        logger.exception('Fetch messages for: %s failed' % email_account)
+        raise self.retry(exc=exc)
+    finally:
+        manager.cleanup()
+
+    if failed_message_ids:
+        # Only retry the messages that couldn't be downloaded.
+        logger.warning('Retrying %s messages for: %s' % (len(failed_message_ids), email_account))
+        if countdown is not None:
+            raise defer_task(self, countdown, args=(account_id, failed_message_ids))
+        raise self.retry(args=(account_id, failed_message_ids))
+
+
 @task(name='update_labels_for_message', logger=logger, bind=True)
 def update_labels_for_message(self, account_id, email_id):
     """
@@ -155,10 +363,12 @@ def update_labels_for_message(self, account_id, email_id):
     except EmailAccount.DoesNotExist:
         logger.warning('EmailAccount no longer exists: %s', email_id)
     else:
-        manager = GmailManager(account)
+        manager = GmailManager(account, defer_rate_limits=True)
         try:
             logger.debug('Changing labels for: %s', email_id)
             manager.update_labels_for_message(email_id)
+        except RateLimitError as exc:
+            raise defer_task(self, exc.countdown)
         except Exception as exc:
             logger.exception('Failed changing labels for %s' % email_id)
             raise self.retry(exc=exc)
@@ -273,6 +483,68 @@ def add_and_remove_labels_for_message(self, email_id, add_labels=None, remove_la
             manager.cleanup()
 
 
+@task(name='flush_label_mutations', logger=logger, bind=True)
+def flush_label_mutations(self, account_id):
+    """
+    Send all pending label mutations of the EmailAccount to Gmail.
+
+    Mutations that fail are queued again with a new flush instead of retrying this task, so they aren't left
+    pending without a flush after the last retry.
+
+    Args:
+        account_id (int): id of the EmailAccount
+    """
+    try:
+        email_account = EmailAccount.objects.get(pk=account_id, is_deleted=False)
+    except EmailAccount.DoesNotExist:
+        logger.warning('EmailAccount no longer exists: %s', account_id)
+        return
+
+    mutations = pop_label_mutations(account_id)
+    if not mutations:
+        return
+
+    manager = GmailManager(email_account, defer_rate_limits=True)
+    try:
+        logger.debug('Changing labels for %s messages of: %s' % (len(mutations), email_account))
+        manager.batch_add_and_remove_labels(mutations)
+    except RateLimitError as exc:
+        # Queue the mutations again, which schedules the flush that sends them.
+        queue_label_mutations(account_id, mutations, requeue=True, countdown=exc.countdown)
+    except Exception:
+        logger.exception('Failed changing labels for %s' % email_account)
+        # Queue the mutations again, which schedules the flush that sends them.
+        queue_label_mutations(account_id, mutations, requeue=True, countdown=self.default_retry_delay)
+    finally:
+        manager.cleanup()
+
+
+@task(name='update_email_threads', logger=logger)
+def update_email_threads(account_id):
+    """
+    Recalculate all pending thread updates of the EmailAccount.
+
+    Args:
+        account_id (int): id of the EmailAccount
+    """
+    try:
+        email_account = EmailAccount.objects.get(pk=account_id, is_deleted=False)
+    except EmailAccount.DoesNotExist:
+        logger.warning('EmailAccount no longer exists: %s', account_id)
+        return
+
+    thread_ids = pop_thread_updates(account_id)
+    if not thread_ids:
+        return
+
+    try:
+        EmailThread.objects.update_threads(email_account, thread_ids)
+    except Exception:
+        logger.exception('Failed updating %s threads for %s' % (len(thread_ids), email_account))
+        # Queue the threads again, this schedules a new update.
+        queue_thread_updates(account_id, thread_ids)
+
+
 @task(name='delete_email_message', logger=logger, bind=True)
 def delete_email_message(self, email_id):
     """
@@ -360,21 +632,22 @@ def send_message(email_outbox_message_id, original_message_id=None):
             except EmailAttachment.DoesNotExist:
                 pass
             else:
+                if not original_attachment.is_downloaded:
+                    attachment_manager = GmailManager(original_attachment.message.account)
+                    try:
+                        original_attachment = attachment_manager.download_attachment(original_attachment)
+                    finally:
+                        attachment_manager.cleanup()
+
                 outbox_attachment = EmailOutboxAttachment()
                 outbox_attachment.email_outbox_message = email_outbox_message
                 outbox_attachment.tenant_id = original_attachment.message.tenant_id
 
-                file = default_storage._open(original_attachment.attachment.name)
-                file.open()
-                content = file.read()
-                file.close()
-
-                file = ContentFile(content)
-                file.name = original_attachment.attachment.name
-
-                outbox_attachment.attachment = file
+                # Refer to the stored file instead of copying it.
+                outbox_attachment.attachment = original_attachment.attachment.name
+                outbox_attachment.content_type = original_attachment.content_type
                 outbox_attachment.inline = original_attachment.inline
-                outbox_attachment.size = file.size
+                outbox_attachment.size = original_attachment.size
                 outbox_attachment.save()
 
     if not email_account.is_authorized:
@@ -382,7 +655,8 @@ def send_message(email_outbox_message_id, original_message_id=None):
     else:
         manager = GmailManager(email_account)
         try:
-            manager.send_email_message(email_outbox_message.message(), original_message_thread_id)
+            with email_outbox_message.message_file() as message_file:
+                manager.send_email_message(message_file, original_message_thread_id)
             logger.debug('Message sent from: %s', email_account)
             # Seems like everything went right, so the EmailOutboxMessage object isn't needed any more
             email_outbox_message.delete()
@@ -426,7 +700,8 @@ def create_draft_email_message(email_outbox_message_id):
 
     manager = GmailManager(email_account)
     try:
-        manager.create_draft_email_message(email_outbox_message.message())
+        with email_outbox_message.message_file() as message_file:
+            manager.create_draft_email_message(message_file)
         logger.debug('Message saved as draft for: %s', email_account)
         # Seems like everything went right, so the EmailOutboxMessage object isn't needed any more
         email_outbox_message.delete()
@@ -463,7 +738,8 @@ def update_draft_email_message(email_outbox_message_id, current_draft_pk):
     if current_draft.draft_id:
         # Update current draft.
         try:
-            manager.update_draft_email_message(email_outbox_message.message(), draft_id=current_draft.draft_id)
+            with email_outbox_message.message_file() as message_file:
+                manager.update_draft_email_message(message_file, draft_id=current_draft.draft_id)
             logger.debug('Updated draft for: %s', email_account)
             # Seems like everything went right, so the EmailOutboxMessage object isn't needed any more.
             email_outbox_message.delete()
@@ -476,7 +752,8 @@ def update_draft_email_message(email_outbox_message_id, current_draft_pk):
     else:
         # There is no draft pk stored, just remove and create a new draft.
         try:
-            manager.create_draft_email_message(email_outbox_message.message())
+            with email_outbox_message.message_file() as message_file:
+                manager.create_draft_email_message(message_file)
             manager.delete_email_message(current_draft)
             logger.debug('Message saved as draft and removed current draft, for: %s', email_account)
             # Seems like everything went right, so the EmailOutboxMessage object isn't needed any more.
@@ -536,3 +813,100 @@ def mark_message_as_spam(email_id):
             logger.exception('Failed marking as spam: %s', email_message)
         finally:
             manager.cleanup()
+
+
+@task(name='cache_email_bodies', logger=logger)
+def cache_email_bodies(email_ids):
+    """
+    Render the html bodies of EmailMessages into the render cache, so they're a cache hit when they're opened.
+
+    Args:
+        email_ids (list): ids of the EmailMessages
+    """
+    for email_message in EmailMessage.objects.filter(pk__in=email_ids).prefetch_related('attachments'):
+        try:
+            cache_email_body(email_message, list(email_message.attachments.all()))
+        except Exception:
+            logger.exception('Failed rendering body of: %s', email_message)
+
+
+@task(name='resanitize_email_bodies', logger=logger)
+def resanitize_email_bodies():
+    """
+    Sanitize stored html bodies again that were sanitized with an older version of the whitelists.
+
+    Every task handles EMAIL_RESANITIZE_BATCH_SIZE messages and queues the next batch, until all bodies are up
+    to date.
+    """
+    if not cache.add(RESANITIZE_LOCK_KEY, True, settings.GMAIL_SYNC_LOCK_LIFETIME):
+        return
+
+    try:
+        email_messages = EmailMessage.objects.filter(
+            sanitize_version__lt=SANITIZE_VERSION,
+        ).order_by().only('pk', 'body_html')[:settings.EMAIL_RESANITIZE_BATCH_SIZE]
+
+        count = 0
+        for email_message in email_messages:
+            # Update without saving the instance, so the message isn't indexed again.
+            EmailMessage.objects.filter(pk=email_message.pk).update(
+                body_html_sanitized=sanitize_html_email(email_message.body_html),
+                sanitize_version=SANITIZE_VERSION,
+            )
+            count += 1
+    finally:
+        cache.delete(RESANITIZE_LOCK_KEY)
+
+    logger.info('Sanitized %s email bodies again' % count)
+    if count == settings.EMAIL_RESANITIZE_BATCH_SIZE:
+        resanitize_email_bodies.delay()
+
+
+@task(name='delete_unreferenced_attachment_files', logger=logger)
+def delete_unreferenced_attachment_files():
+    """
+    Delete the files of deleted attachments from the storage, when no attachment refers to them anymore.
+
+    Only files of attachments that were deleted more than EMAIL_ATTACHMENT_DELETE_DELAY seconds ago are checked,
+    so an attachment that is being stored with the same file has been committed. Every task handles
+    EMAIL_ATTACHMENT_DELETE_BATCH_SIZE files and queues the next batch.
+    """
+    # Only one task at a time, so a file is never checked and deleted by two workers.
+    if not cache.add(ATTACHMENT_SWEEP_LOCK_KEY, True, settings.GMAIL_SYNC_LOCK_LIFETIME):
+        return
+
+    try:
+        files = list(UnreferencedAttachmentFile.objects.filter(
+            created__lt=timezone.now() - timedelta(seconds=settings.EMAIL_ATTACHMENT_DELETE_DELAY),
+        ).order_by('pk')[:settings.EMAIL_ATTACHMENT_DELETE_BATCH_SIZE])
+
+        names = set(unreferenced_file.name for unreferenced_file in files)
+        referenced_names = set(EmailAttachment.objects.filter(
+            attachment__in=names,
+        ).values_list('attachment', flat=True))
+        # Forwarded attachments refer to the file of the original.
+        referenced_names.update(EmailOutboxAttachment.objects.filter(
+            attachment__in=names,
+        ).values_list('attachment', flat=True))
+
+        deleted = 0
+        failed_names = set()
+        for name in names - referenced_names:
+            try:
+                default_storage.delete(name)
+            except Exception:
+                logger.exception('Couldn\'t delete attachment file %s' % name)
+                failed_names.add(name)
+            else:
+                deleted += 1
+
+        # Files that couldn't be deleted are tried again in a next run.
+        UnreferencedAttachmentFile.objects.filter(pk__in=[
+            unreferenced_file.pk for unreferenced_file in files if unreferenced_file.name not in failed_names
+        ]).delete()
+    finally:
+        cache.delete(ATTACHMENT_SWEEP_LOCK_KEY)
+
+    logger.info('Deleted %s of %s unreferenced attachment files' % (deleted, len(names)))
+    if len(files) == settings.EMAIL_ATTACHMENT_DELETE_BATCH_SIZE:
+        delete_unreferenced_attachment_files.delay()
@@ -0,0 +1,241 @@
+import HTMLParser
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models import Q
+from django.template import Context, Template
+
+from lily.accounts.models import Account
+from lily.contacts.models import Contact
+
+from .models.models import TemplateVariable
+
+
+CUSTOM_VARIABLE_REGEX = re.compile(r'\[\[ custom\.(.*?) \]\]')
+
+
+def parse_custom_variable(custom_variable):
+    """
+    Split a custom variable as used in a template, e.g. `signature` or `signature.public`.
+
+    Args:
+        custom_variable (str): the part after `custom.`
+
+    Returns:
+        tuple with the lowercased name of the variable and a boolean if it's a public variable
+    """
+    try:
+        name, public = custom_variable.split('.')
+    except ValueError:
+        name, public = custom_variable, None
+
+    return name.lower(), bool(public)
+
+
+def find_custom_variables(texts):
+    """
+    Find the custom variables in all texts.
+    """
+    for text in texts:
+        for custom_variable in CUSTOM_VARIABLE_REGEX.findall(text):
+            yield custom_variable
+
+
+def get_custom_variables(texts, user):
+    """
+    Get the TemplateVariables used in the texts with one query.
+
+    Args:
+        texts (list): the texts of the template, e.g. the body and the subject
+        user (instance): LilyUser whose private variables can be used
+
+    Returns:
+        dict with custom_variable: text of the TemplateVariable, for the variables that exist
+    """
+    custom_variables = set(find_custom_variables(texts))
+    if not custom_variables:
+        return {}
+
+    parsed = {custom_variable: parse_custom_variable(custom_variable) for custom_variable in custom_variables}
+
+    query = Q()
+    for name, public in set(parsed.values()):
+        if public:
+            query |= Q(name__iexact=name, is_public=True)
+        else:
+            query |= Q(name__iexact=name, owner=user)
+
+    texts_by_name = {}
+    for variable in TemplateVariable.objects.filter(query).order_by('pk'):
+        if variable.is_public:
+            texts_by_name.setdefault((variable.name.lower(), True), variable.text)
+        if variable.owner_id == user.pk:
+            texts_by_name.setdefault((variable.name.lower(), False), variable.text)
+
+    return {
+        custom_variable: texts_by_name[key]
+        for custom_variable, key in parsed.items() if key in texts_by_name
+    }
+
+
+def substitute_custom_variables(text, variables):
+    """
+    Replace the custom variables in the text with the text of the TemplateVariables.
+
+    Unknown variables are left in place, so they render as empty strings.
+
+    Args:
+        text (str): text of the template
+        variables (dict): as returned by get_custom_variables
+
+    Returns:
+        str: the text with the variables replaced
+    """
+    def replace(match):
+        return variables.get(match.group(1), match.group(0))
+
+    return CUSTOM_VARIABLE_REGEX.sub(replace, text)
+
+
+def to_django_template(text):
+    """
+    Convert the bracket style of email templates ([[ user.first_name ]]) to Django template syntax.
+    """
+    return text.replace('[[', '{{').replace(']]', '}}')
+
+
+class CompiledTemplateCache(object):
+    """
+    Per process cache of compiled email templates.
+
+    Templates are keyed by id and modification time, so an edited template is compiled again. The custom
+    variables are part of the source of the template, so a hash of the substituted variables is part of the
+    key as well. The least recently used templates are evicted when the cache holds more than max_size templates.
+
+    Attributes:
+        max_size (int): max number of compiled templates in the cache
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get_key(self, email_template, field, variables):
+        """
+        Get the cache key of a field of the EmailTemplate with the custom variables.
+        """
+        digest = hashlib.md5()
+        for custom_variable, text in sorted(variables.items()):
+            digest.update(custom_variable.encode('utf-8'))
+            digest.update('\0')
+            digest.update(text.encode('utf-8'))
+            digest.update('\0')
+
+        return email_template.pk, email_template.modified, field, digest.hexdigest()
+
+    def get(self, email_template, field, variables):
+        """
+        Get the compiled template for a field of the EmailTemplate, compile it when it isn't cached yet.
+
+        Args:
+            email_template (instance): EmailTemplate instance
+            field (str): name of the field, body_html or subject
+            variables (dict): as returned by get_custom_variables
+
+        Returns:
+            Template instance
+        """
+        key = self.get_key(email_template, field, variables)
+        with self.lock:
+            template = self.entries.pop(key, None)
+            if template is not None:
+                # Mark as most recently used.
+                self.entries[key] = template
+                return template
+
+        # Compile outside the lock, two threads compiling the same template at once is harmless.
+        source = substitute_custom_variables(getattr(email_template, field), variables)
+        template = Template(to_django_template(source))
+
+        with self.lock:
+            self.entries[key] = template
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+        return template
+
+
+compiled_template_cache = CompiledTemplateCache(max_size=settings.EMAIL_TEMPLATE_CACHE_SIZE)
+
+
+def get_template_lookups(user, recipients):
+    """
+    Get the context for rendering a template for every recipient, with one query for the contacts and accounts.
+
+    The account of a contact with exactly one function is used instead of the given account.
+
+    Args:
+        user (instance): LilyUser that renders the template
+        recipients (list): (contact_id, account_id) tuples, both may be None
+
+    Returns:
+        list of dicts with the context for every recipient, in the same order
+    """
+    contact_ids = set(contact_id for contact_id, account_id in recipients if contact_id is not None)
+    contacts = Contact.objects.filter(pk__in=contact_ids).prefetch_related('functions') if contact_ids else []
+    contacts = {contact.pk: contact for contact in contacts}
+
+    account_ids = set(account_id for contact_id, account_id in recipients if account_id is not None)
+    for contact in contacts.values():
+        functions = contact.functions.all()
+        if len(functions) == 1:
+            account_ids.add(functions[0].account_id)
+    accounts = {account.pk: account for account in Account.objects.filter(pk__in=account_ids)} if account_ids else {}
+
+    lookups = []
+    for contact_id, account_id in recipients:
+        lookup = {'user': user}
+
+        if account_id in accounts:
+            lookup['account'] = accounts[account_id]
+
+        if contact_id in contacts:
+            contact = contacts[contact_id]
+            lookup['contact'] = contact
+            functions = contact.functions.all()
+            if len(functions) == 1 and functions[0].account_id in accounts:
+                lookup['account'] = accounts[functions[0].account_id]
+
+        lookups.append(lookup)
+
+    return lookups
+
+
+def render_email_template(email_template, user, lookups):
+    """
+    Render the body and subject of the EmailTemplate for every context.
+
+    The custom variables are looked up once and the compiled templates are reused between calls.
+
+    Args:
+        email_template (instance): EmailTemplate instance
+        user (instance): LilyUser whose private variables can be used
+        lookups (list): dicts with the context for every render, see get_template_lookups
+
+    Returns:
+        list of (body, subject) tuples, in the same order as the lookups
+    """
+    variables = get_custom_variables([email_template.body_html, email_template.subject], user)
+    body_template = compiled_template_cache.get(email_template, 'body_html', variables)
+    subject_template = compiled_template_cache.get(email_template, 'subject', variables)
+
+    # Make sure HTML entities are displayed correctly in the subject.
+    html_parser = HTMLParser.HTMLParser()
+
+    return [
+        (body_template.render(Context(lookup)), html_parser.unescape(subject_template.render(Context(lookup))))
+        for lookup in lookups
+    ]
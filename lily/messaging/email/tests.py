@@ -1,7 +1,50 @@
+import anyjson
+import base64
+import datetime
+import gc
+import redis
+import StringIO
+import time
+import weakref
+from email import message_from_file
 from unittest import TestCase
 
+from celery.exceptions import Retry
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.urlresolvers import reverse
+from django.test import TestCase as DatabaseTestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+from googleapiclient.errors import HttpError
+
 from python_imap.utils import convert_html_to_text
 
+from .builders.label import LabelBuilder
+from . import connector, manager, mutations, services, tasks
+from .builders.message import MessageBuilder, decode_message_body
+from .connector import ConnectorError, GmailConnector, LabelNotFoundError, MessageNotFoundError, RateLimitError
+from .credentials import InvalidCredentialsError
+from .factories import GmailAccountFactory
+from .manager import GmailManager
+from .models.models import (EmailAccount, EmailAttachment, EmailHeader, EmailLabel, EmailMessage,
+                            EmailOutboxAttachment, EmailOutboxMessage, EmailTemplate, EmailThread, NoEmailMessageId,
+                            Recipient,
+                            UnreferencedAttachmentFile)
+from .mutations import (MUTATIONS_LOCK_KEY, THREADS_FLUSH_KEY, group_label_mutations, merge_label_mutations,
+                        mutations_lock, pop_label_mutations, queue_label_mutations)
+from .push import (build_push_notification, clear_watch_expiration, get_watch_expirations, parse_push_notification,
+                   set_watch_expiration)
+from .ratelimit import GmailRateLimiter
+from .sanitize import SANITIZE_VERSION
+from .utils import (EMAIL_BODY_ORIGIN_PLACEHOLDER, cache_email_body, decode_base64url_to_file, encode_base64_to_file,
+                    get_email_body_cache_key, parse_range_header, replace_email_body_origin)
+from .scheduling import (FIRST_SYNC_HEAD_KEY, FIRST_SYNC_TAIL_KEY, FIRST_SYNC_TASK_KEY, SYNC_IN_FLIGHT_KEY,
+                         interleave, mark_sync_started, order_by_sync_priority, pop_first_sync_tasks,
+                         queue_first_sync_task, refresh_sync_started)
+from .templating import CompiledTemplateCache, parse_custom_variable, substitute_custom_variables
+
 
 class ConvertHTMLToTextTestCase(TestCase):
 
@@ -59,3 +102,1128 @@ Bye!
         result = 'Test link title <http://www.test.com>'
 
         self.assertEqual(convert_html_to_text(html, keep_linebreaks=True), result)
+
+
+class LabelMutationsTestCase(TestCase):
+
+    def test_merge_later_mutation_wins(self):
+        pending = merge_label_mutations({}, {'a': (['STARRED'], [])})
+        pending = merge_label_mutations(pending, {'a': ([], ['STARRED'])})
+
+        self.assertEqual(pending, {'a': (set(), {'STARRED'})})
+
+    def test_merge_combines_labels(self):
+        pending = merge_label_mutations({}, {'a': (['STARRED'], ['INBOX'])})
+        pending = merge_label_mutations(pending, {'a': (['Label_1'], []), 'b': ([], ['UNREAD'])})
+
+        self.assertEqual(pending, {
+            'a': ({'STARRED', 'Label_1'}, {'INBOX'}),
+            'b': (set(), {'UNREAD'}),
+        })
+
+    def test_group_same_mutations(self):
+        groups = group_label_mutations({
+            'a': ({'STARRED'}, set()),
+            'b': ({'STARRED'}, set()),
+            'c': (set(), {'STARRED'}),
+            'd': (set(), set()),
+        })
+
+        self.assertEqual(sorted(groups[(frozenset(['STARRED']), frozenset())]), ['a', 'b'])
+        self.assertEqual(groups[(frozenset(), frozenset(['STARRED']))], ['c'])
+        self.assertEqual(len(groups), 2)
+
+
+class FakeApp(object):
+
+    def __init__(self):
+        self.sent_tasks = []
+
+    def send_task(self, name, args=None, countdown=None):
+        self.sent_tasks.append((name, args, countdown))
+
+
+class LabelMutationsQueueTestCase(TestCase):
+
+    def setUp(self):
+        self.app = mutations.app
+        mutations.app = FakeApp()
+
+    def tearDown(self):
+        mutations.app = self.app
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_lock_released(self):
+        with mutations_lock(1):
+            self.assertIsNotNone(cache.get(MUTATIONS_LOCK_KEY % 1))
+
+        self.assertIsNone(cache.get(MUTATIONS_LOCK_KEY % 1))
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_lock_taken_over_not_released(self):
+        with mutations_lock(1):
+            # The lock expired and another worker took it over.
+            cache.set(MUTATIONS_LOCK_KEY % 1, 'other worker')
+
+        self.assertEqual(cache.get(MUTATIONS_LOCK_KEY % 1), 'other worker')
+        cache.delete(MUTATIONS_LOCK_KEY % 1)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                       GMAIL_LABEL_MUTATION_DELAY=5)
+    def test_requeue_schedules_flush(self):
+        queue_label_mutations(1, {'a': (['STARRED'], [])})
+        pending = pop_label_mutations(1)
+
+        # The flush failed, so the mutations are queued again.
+        queue_label_mutations(1, pending, requeue=True, countdown=30)
+        queue_label_mutations(1, {'b': (['STARRED'], [])})
+
+        self.assertEqual(mutations.app.sent_tasks, [
+            ('flush_label_mutations', [1], 5),
+            ('flush_label_mutations', [1], 30),
+        ])
+        self.assertEqual(sorted(pop_label_mutations(1)), ['a', 'b'])
+
+
+class RateLimiterTestCase(TestCase):
+
+    def setUp(self):
+        self.rate_limiter = GmailRateLimiter(max_rate=10, min_rate=1, capacity=5, recovery=0.5)
+        try:
+            self.rate_limiter.get_redis().ping()
+        except redis.RedisError:
+            self.skipTest('Redis isn\'t available')
+        self.email_account_id = 'test'
+        self.rate_limiter.redis.delete(self.rate_limiter.key % self.email_account_id)
+
+    def tearDown(self):
+        self.rate_limiter.redis.delete(self.rate_limiter.key % self.email_account_id)
+
+    def test_takes_tokens(self):
+        self.assertEqual(self.rate_limiter.acquire(self.email_account_id, 5), 0)
+        self.assertGreater(self.rate_limiter.acquire(self.email_account_id, 1), 0)
+
+    def test_more_than_capacity(self):
+        # A full bucket lets a batch larger than the capacity through, but the calls are still counted.
+        self.assertEqual(self.rate_limiter.acquire(self.email_account_id, 20), 0)
+        self.assertGreater(self.rate_limiter.acquire(self.email_account_id, 1), 1)
+
+
+class FakeTaskRequest(object):
+    args = (1, ['message'])
+    retries = 2
+
+
+class FakeTask(object):
+    """
+    Stand-in for a bound task, that keeps the options of the attempts it sends.
+    """
+    request = FakeTaskRequest()
+
+    def __init__(self):
+        self.sent = []
+
+    def subtask_from_request(self, request, args, kwargs, **options):
+        self.sent.append((args or request.args, options))
+        return self
+
+    def apply_async(self):
+        pass
+
+
+class DeferTaskTestCase(TestCase):
+
+    def test_retries_not_used(self):
+        fake_task = FakeTask()
+
+        self.assertIsInstance(tasks.defer_task(fake_task, 30), Retry)
+        self.assertEqual(fake_task.sent, [((1, ['message']), {'countdown': 30, 'retries': 2})])
+
+    def test_new_arguments(self):
+        fake_task = FakeTask()
+
+        tasks.defer_task(fake_task, 30, args=(1, ['other']))
+
+        self.assertEqual(fake_task.sent[0][0], (1, ['other']))
+
+
+class FakeCredentials(object):
+    access_token_expired = False
+
+    def __init__(self, refresh_token):
+        self.refresh_token = refresh_token
+
+
+class GmailServiceCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.build_gmail_service = services.build_gmail_service
+        services.build_gmail_service = lambda credentials: object()
+        self.cache = services.GmailServiceCache(max_size=10, timeout=60)
+        self.email_account = EmailAccount(pk=1)
+
+    def tearDown(self):
+        services.build_gmail_service = self.build_gmail_service
+
+    def acquire_and_release(self, credentials):
+        entry = self.cache.acquire(self.email_account, lambda email_account: credentials)
+        self.cache.release(self.email_account.pk, entry)
+        return entry[0]
+
+    def test_service_reused(self):
+        service = self.acquire_and_release(FakeCredentials('token'))
+
+        self.assertIs(self.acquire_and_release(FakeCredentials('token')), service)
+
+    def test_new_credentials_build_new_service(self):
+        service = self.acquire_and_release(FakeCredentials('token'))
+
+        self.assertIsNot(self.acquire_and_release(FakeCredentials('new token')), service)
+
+    def test_invalid_credentials_not_cached(self):
+        self.acquire_and_release(FakeCredentials('token'))
+
+        def get_credentials(email_account):
+            raise InvalidCredentialsError()
+
+        with self.assertRaises(InvalidCredentialsError):
+            self.cache.acquire(self.email_account, get_credentials)
+
+
+class FakeHttpResponse(dict):
+
+    def __init__(self, status):
+        super(FakeHttpResponse, self).__init__(status=status)
+        self.status = status
+        self.reason = 'error'
+
+
+class FakeBatch(object):
+    """
+    Batch request that answers with the next outcome of every message, in reverse order like Gmail may do.
+    """
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.calls = []
+
+    def add(self, call, request_id):
+        self.calls.append((request_id, call))
+
+    def execute(self):
+        self.service.batches.append([request_id for request_id, call in self.calls])
+        for request_id, message_id in reversed(self.calls):
+            outcome = self.service.outcomes[message_id].pop(0)
+            if isinstance(outcome, Exception):
+                self.callback(request_id, None, outcome)
+            else:
+                self.callback(request_id, outcome, None)
+
+
+class FakeGmailService(object):
+    """
+    Stand-in for the Gmail api service, messages().get returns the message id as service call.
+
+    Attributes:
+        outcomes (dict): with message_id: list of responses or exceptions, one for every attempt
+        batches (list): request ids of every executed batch
+    """
+    def __init__(self, outcomes):
+        self.outcomes = outcomes
+        self.batches = []
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self, callback)
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def get(self, userId, id, quotaUser, fields=None):
+        return id
+
+
+class FakeRateLimiter(object):
+
+    def __init__(self):
+        self.penalized = 0
+
+    def acquire(self, email_account_id, tokens):
+        return 0
+
+    def penalize(self, email_account_id):
+        self.penalized += 1
+
+
+def http_error(code, message=''):
+    return HttpError(FakeHttpResponse(code), anyjson.serialize({'error': {'code': code, 'message': message}}))
+
+
+def create_connector(service, defer_rate_limits=False, history_id=None):
+    # Skip __init__, it needs credentials.
+    gmail_connector = GmailConnector.__new__(GmailConnector)
+    gmail_connector.email_account = EmailAccount(pk=1, history_id=history_id)
+    gmail_connector.history_id = history_id
+    gmail_connector.defer_rate_limits = defer_rate_limits
+    gmail_connector.deferred_countdown = None
+    gmail_connector.service = service
+    gmail_connector.get_backoff_time = lambda n: 0
+    return gmail_connector
+
+
+class ConnectorBatchTestCase(TestCase):
+
+    def setUp(self):
+        self.gmail_rate_limiter = connector.gmail_rate_limiter
+        connector.gmail_rate_limiter = FakeRateLimiter()
+
+    def tearDown(self):
+        connector.gmail_rate_limiter = self.gmail_rate_limiter
+
+    def create_connector(self, outcomes, defer_rate_limits=False):
+        return create_connector(FakeGmailService(outcomes), defer_rate_limits=defer_rate_limits)
+
+    def get_message_info_list(self, gmail_connector, message_ids):
+        with override_settings(GMAIL_FULL_MESSAGE_BATCH_SIZE=2):
+            return gmail_connector.get_message_info_list(message_ids)
+
+    def test_responses_by_message_id(self):
+        gmail_connector = self.create_connector({
+            message_id: [{'id': message_id}] for message_id in ['a', 'b', 'c']
+        })
+
+        results = self.get_message_info_list(gmail_connector, ['a', 'b', 'c'])
+
+        self.assertEqual(results, {message_id: {'id': message_id} for message_id in ['a', 'b', 'c']})
+        self.assertEqual(sorted(len(batch) for batch in gmail_connector.service.batches), [1, 2])
+
+    def test_errors_per_call(self):
+        gmail_connector = self.create_connector({
+            'found': [{'id': 'found'}],
+            'missing': [http_error(404)],
+            'invalid': [http_error(400, 'Invalid id value')],
+        })
+
+        results = self.get_message_info_list(gmail_connector, ['found', 'missing', 'invalid'])
+
+        self.assertEqual(results['found'], {'id': 'found'})
+        self.assertIsInstance(results['missing'], MessageNotFoundError)
+        self.assertIsInstance(results['invalid'], ConnectorError)
+        # Calls that can't succeed aren't retried.
+        self.assertEqual(len(gmail_connector.service.batches), 2)
+
+    def test_backend_error_retried(self):
+        gmail_connector = self.create_connector({
+            'a': [{'id': 'a'}],
+            'b': [http_error(503), {'id': 'b'}],
+        })
+
+        results = self.get_message_info_list(gmail_connector, ['a', 'b'])
+
+        self.assertEqual(results, {'a': {'id': 'a'}, 'b': {'id': 'b'}})
+        self.assertEqual(gmail_connector.service.batches[1:], [['b']])
+
+    def test_rate_limit_deferred(self):
+        gmail_connector = self.create_connector({
+            'a': [{'id': 'a'}],
+            'b': [http_error(429)],
+        }, defer_rate_limits=True)
+
+        results = self.get_message_info_list(gmail_connector, ['a', 'b'])
+
+        self.assertEqual(results['a'], {'id': 'a'})
+        self.assertIsInstance(results['b'], RateLimitError)
+        self.assertIsNotNone(gmail_connector.deferred_countdown)
+        self.assertEqual(connector.gmail_rate_limiter.penalized, 1)
+
+
+class FakeServiceCall(object):
+
+    def __init__(self, response):
+        self.response = response
+
+    def execute(self):
+        return self.response
+
+
+class FakeHistoryService(object):
+    """
+    Stand-in for the Gmail api service, history().list returns the next page.
+
+    Attributes:
+        pages (list): responses of the history list
+        requests (list): keyword arguments of every history list call
+    """
+    def __init__(self, pages):
+        self.pages = pages
+        self.requests = []
+
+    def users(self):
+        return self
+
+    def history(self):
+        return self
+
+    def list(self, **kwargs):
+        self.requests.append(kwargs)
+        return FakeServiceCall(self.pages[len(self.requests) - 1])
+
+
+class ConnectorHistoryTestCase(TestCase):
+
+    def setUp(self):
+        self.gmail_rate_limiter = connector.gmail_rate_limiter
+        connector.gmail_rate_limiter = FakeRateLimiter()
+
+    def tearDown(self):
+        connector.gmail_rate_limiter = self.gmail_rate_limiter
+
+    def test_pages_use_start_history_id(self):
+        service = FakeHistoryService([
+            {'history': [{'id': '11'}, {'id': '12'}], 'nextPageToken': 'second', 'historyId': '20'},
+            {'history': [{'id': '15'}], 'nextPageToken': 'third', 'historyId': '20'},
+            {'history': [{'id': '18'}], 'historyId': '20'},
+        ])
+        gmail_connector = create_connector(service, history_id='10')
+
+        checkpoints = []
+        for history in gmail_connector.get_history_pages():
+            checkpoints.append(gmail_connector.history_id)
+
+        self.assertEqual([request['startHistoryId'] for request in service.requests], ['10', '10', '10'])
+        self.assertEqual([request['pageToken'] for request in service.requests], [None, 'second', 'third'])
+        self.assertEqual(checkpoints, ['12', '15', '20'])
+
+
+class SyncSchedulingTestCase(TestCase):
+
+    def test_never_synced_first(self):
+        states = {1: (900, 0), 2: None, 3: (950, 0)}
+
+        self.assertEqual(order_by_sync_priority([1, 2, 3], states, 1000), [2, 1, 3])
+
+    def test_changes_raise_priority(self):
+        # Account 2 is less stale, but had a full partial sync worth of changes.
+        states = {1: (900, 0), 2: (940, 10000)}
+
+        self.assertEqual(order_by_sync_priority([1, 2], states, 1000), [2, 1])
+
+    def test_interleave(self):
+        self.assertEqual(interleave([[1, 2, 3], [4], [5, 6]]), [1, 4, 5, 2, 6, 3])
+        self.assertEqual(interleave([]), [])
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_first_sync_tasks_in_order(self):
+        for i in range(3):
+            queue_first_sync_task(1, i, 'download_email_messages', [1, [str(i)]])
+
+        self.assertEqual(pop_first_sync_tasks(1, 2), [('download_email_messages', [1, ['0']]),
+                                                      ('download_email_messages', [1, ['1']])])
+        self.assertEqual(pop_first_sync_tasks(1, 2), [('download_email_messages', [1, ['2']])])
+        self.assertEqual(pop_first_sync_tasks(1, 2), [])
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_lost_first_sync_tasks(self):
+        for i in range(3):
+            queue_first_sync_task(1, i, 'download_email_messages', [1, [str(i)]])
+        # Evicted by the cache.
+        cache.delete(FIRST_SYNC_TASK_KEY % (1, 1))
+
+        self.assertIsNone(pop_first_sync_tasks(1, 3))
+        # The queue is cleared, the first sync starts over.
+        self.assertIsNone(cache.get(FIRST_SYNC_TASK_KEY % (1, 2)))
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_evicted_positions(self):
+        for i in range(4):
+            queue_first_sync_task(1, i, 'download_email_messages', [1, [str(i)]])
+        pop_first_sync_tasks(1, 2)
+        # Evicted by the cache while the listing was still queueing tasks.
+        cache.delete_many([FIRST_SYNC_HEAD_KEY % 1, FIRST_SYNC_TAIL_KEY % 1])
+        queue_first_sync_task(1, 4, 'first_sync_finished', [1])
+
+        self.assertIsNone(pop_first_sync_tasks(1, 10))
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_evicted_queue(self):
+        queue_first_sync_task(1, 0, 'first_sync_finished', [1])
+        cache.clear()
+
+        self.assertIsNone(pop_first_sync_tasks(1, 10))
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                       GMAIL_SYNC_LOCK_LIFETIME=60)
+    def test_refresh_sync_started(self):
+        self.assertTrue(mark_sync_started(1))
+        cache.delete(SYNC_IN_FLIGHT_KEY % 1)
+        refresh_sync_started(1)
+
+        self.assertFalse(mark_sync_started(1))
+
+
+class PushNotificationTestCase(TestCase):
+
+    def test_parse_published_notification(self):
+        body = build_push_notification('user@example.com', 12345)
+
+        self.assertEqual(parse_push_notification(body), ('user@example.com', 12345))
+
+    def test_parse_invalid_notification(self):
+        self.assertRaises(ValueError, parse_push_notification, '{"message": {}}')
+        self.assertRaises(ValueError, parse_push_notification, 'not json')
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_clear_watch_expiration(self):
+        expiration = (time.time() + 60) * 1000
+        set_watch_expiration(1, expiration)
+        set_watch_expiration(2, expiration)
+
+        clear_watch_expiration(1)
+
+        self.assertEqual(get_watch_expirations([1, 2]).keys(), [2])
+
+
+class AttachmentDecodingTestCase(TestCase):
+
+    @override_settings(GMAIL_CHUNK_SIZE=10)
+    def test_decode_in_chunks(self):
+        data = ''.join(chr(i) for i in range(256)) * 3
+        file = StringIO.StringIO()
+
+        size = decode_base64url_to_file(base64.urlsafe_b64encode(data).rstrip('='), file)
+
+        self.assertEqual(size, len(data))
+        self.assertEqual(file.read(), data)
+
+
+class RangeHeaderTestCase(TestCase):
+
+    def test_range(self):
+        self.assertEqual(parse_range_header('bytes=0-499', 1000), (0, 499))
+
+    def test_open_range(self):
+        self.assertEqual(parse_range_header('bytes=500-', 1000), (500, 999))
+
+    def test_suffix_range(self):
+        self.assertEqual(parse_range_header('bytes=-300', 1000), (700, 999))
+
+    def test_end_beyond_size(self):
+        self.assertEqual(parse_range_header('bytes=900-2000', 1000), (900, 999))
+
+    def test_multiple_ranges_return_whole_file(self):
+        self.assertIsNone(parse_range_header('bytes=0-1,5-6', 1000))
+
+    def test_unsatisfiable(self):
+        self.assertRaises(ValueError, parse_range_header, 'bytes=1000-', 1000)
+
+
+class AttachmentEncodingTestCase(TestCase):
+
+    def test_encode_in_chunks(self):
+        data = ''.join(chr(i) for i in range(256)) * 3
+        file = StringIO.StringIO()
+
+        # Chunks that don't line up with the 57 bytes per base64 line.
+        encode_base64_to_file((data[i:i + 100] for i in range(0, len(data), 100)), file)
+
+        self.assertEqual(file.getvalue(), base64.encodestring(data))
+
+
+class DecodeMessageBodyTestCase(TestCase):
+
+    def test_header_encoding(self):
+        self.assertEqual(decode_message_body('caf\xe9', 'iso-8859-1'), u'caf\xe9')
+
+    def test_meta_charset(self):
+        body = '<html><head><meta charset="windows-1252"></head><body>caf\xe9</body></html>'
+
+        self.assertEqual(decode_message_body(body, is_html=True), body.decode('windows-1252'))
+
+    def test_unknown_header_encoding_falls_back_to_utf8(self):
+        self.assertEqual(decode_message_body('caf\xc3\xa9', 'x-unknown'), u'caf\xe9')
+
+    def test_bom(self):
+        self.assertEqual(decode_message_body('\xef\xbb\xbfcaf\xc3\xa9'), u'caf\xe9')
+
+
+class EmailBodyCacheKeyTestCase(TestCase):
+
+    def setUp(self):
+        self.email_message = EmailMessage(pk=1, body_html=u'<p>caf\xe9 <img src="cid:logo"></p>')
+        self.attachments = [EmailAttachment(pk=2, cid='<logo>'), EmailAttachment(pk=3, cid='')]
+
+    def test_same_message_same_key(self):
+        self.assertEqual(
+            get_email_body_cache_key(self.email_message, self.attachments),
+            get_email_body_cache_key(self.email_message, list(reversed(self.attachments))),
+        )
+
+    def test_changed_body_changes_key(self):
+        key = get_email_body_cache_key(self.email_message, self.attachments)
+        self.email_message.body_html = u'<p>changed</p>'
+
+        self.assertNotEqual(get_email_body_cache_key(self.email_message, self.attachments), key)
+
+    def test_changed_attachments_change_key(self):
+        self.assertNotEqual(
+            get_email_body_cache_key(self.email_message, self.attachments),
+            get_email_body_cache_key(self.email_message, self.attachments[:1]),
+        )
+
+
+class SanitizedBodyTestCase(TestCase):
+
+    def test_sanitize_body(self):
+        email_message = EmailMessage(body_html='<p onclick="alert(1)">Hi<script>alert(1)</script></p>')
+        email_message.sanitize_body()
+
+        self.assertEqual(email_message.sanitize_version, SANITIZE_VERSION)
+        self.assertNotIn('onclick', email_message.body_html_sanitized)
+        self.assertNotIn('<script>', email_message.body_html_sanitized)
+
+    def test_stored_body_is_used(self):
+        email_message = EmailMessage(body_html='<p>raw</p>', body_html_sanitized='<p>stored</p>',
+                                     sanitize_version=SANITIZE_VERSION)
+
+        self.assertEqual(email_message.get_sanitized_body_html(), '<p>stored</p>')
+
+    def test_outdated_body_is_sanitized(self):
+        email_message = EmailMessage(body_html='<p>raw<script>alert(1)</script></p>',
+                                     body_html_sanitized='<p>stored</p>', sanitize_version=SANITIZE_VERSION - 1)
+
+        self.assertNotIn('<script>', email_message.get_sanitized_body_html())
+        self.assertIn('raw', email_message.get_sanitized_body_html())
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_inline_images_kept(self):
+        email_message = EmailMessage(pk=1, body_html='<p>hi <img src="cid:logo@x"></p>')
+        email_message.sanitize_body()
+
+        self.assertIn('src="cid:logo@x"', email_message.body_html_sanitized)
+
+        body = cache_email_body(email_message, [EmailAttachment(pk=2, cid='<logo@x>')])
+        proxy_url = reverse('email_attachment_proxy_view', kwargs={'pk': 2})
+
+        self.assertIn('src="%s%s"' % (EMAIL_BODY_ORIGIN_PLACEHOLDER, proxy_url), body)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_origin_only_replaced_in_links(self):
+        email_message = EmailMessage(pk=1, body_html='<p>__lily_email_body_origin__ <img src="cid:logo@x"></p>')
+        email_message.sanitize_body()
+
+        body = replace_email_body_origin(
+            cache_email_body(email_message, [EmailAttachment(pk=2, cid='<logo@x>')]),
+            'https://app.example.com',
+        )
+
+        self.assertIn('__lily_email_body_origin__', body)
+        self.assertIn('src="https://app.example.com/', body)
+        self.assertNotIn(EMAIL_BODY_ORIGIN_PLACEHOLDER, body)
+
+
+class EmailTemplateRenderTestCase(TestCase):
+
+    def create_template(self, body_html, modified=datetime.datetime(2016, 1, 1)):
+        return EmailTemplate(pk=1, subject='Hi [[ contact.first_name ]]', body_html=body_html, modified=modified)
+
+    def test_parse_custom_variable(self):
+        self.assertEqual(parse_custom_variable('Signature'), ('signature', False))
+        self.assertEqual(parse_custom_variable('signature.public'), ('signature', True))
+
+    def test_substitute_custom_variables(self):
+        text = '[[ custom.a ]] [[ custom.b.public ]] [[ custom.a ]] [[ custom.unknown ]]'
+        variables = {'a': 'A', 'b.public': 'B\\1'}
+
+        self.assertEqual(substitute_custom_variables(text, variables), 'A B\\1 A [[ custom.unknown ]]')
+
+    def test_compiled_once(self):
+        cache = CompiledTemplateCache(max_size=10)
+        template = self.create_template('[[ custom.a ]]')
+
+        compiled = cache.get(template, 'body_html', {'a': 'A'})
+
+        self.assertIs(cache.get(template, 'body_html', {'a': 'A'}), compiled)
+        self.assertIsNot(cache.get(template, 'body_html', {'a': 'other'}), compiled)
+
+    def test_modified_template_compiled_again(self):
+        cache = CompiledTemplateCache(max_size=10)
+        compiled = cache.get(self.create_template('old'), 'body_html', {})
+        template = self.create_template('new', modified=datetime.datetime(2016, 1, 2))
+
+        self.assertIsNot(cache.get(template, 'body_html', {}), compiled)
+
+    def test_least_recently_used_evicted(self):
+        cache = CompiledTemplateCache(max_size=2)
+        for field in ('body_html', 'subject', 'body_html', 'subject', 'body_html'):
+            cache.get(self.create_template('body'), field, {})
+        cache.get(self.create_template('body', modified=datetime.datetime(2016, 1, 2)), 'body_html', {})
+
+        self.assertEqual([key[2] for key in cache.entries], ['body_html', 'body_html'])
+
+
+class EmailMessageUpsertTestCase(DatabaseTestCase):
+
+    def setUp(self):
+        self.email_account = GmailAccountFactory.create()
+        self.sender = Recipient.objects.create(name='Sender', email_address='sender@example.com')
+
+    def create_message(self, **kwargs):
+        return EmailMessage(account=self.email_account, message_id='message', thread_id='thread',
+                            sender=self.sender, sent_date=timezone.now(), **kwargs)
+
+    def test_insert(self):
+        email_message = self.create_message(subject='first')
+
+        self.assertTrue(EmailMessage.objects.upsert(email_message, ['subject']))
+        self.assertEqual(EmailMessage.objects.get(pk=email_message.pk).subject, 'first')
+
+    def test_update_existing(self):
+        existing = self.create_message(subject='first', snippet='kept')
+        existing.save()
+        email_message = self.create_message(subject='second', snippet='ignored')
+
+        self.assertFalse(EmailMessage.objects.upsert(email_message, ['subject']))
+        self.assertEqual(email_message.pk, existing.pk)
+
+        stored = EmailMessage.objects.get(account=self.email_account)
+        self.assertEqual(stored.subject, 'second')
+        self.assertEqual(stored.snippet, 'kept')
+
+
+def fail(*args, **kwargs):
+    raise RuntimeError('Insert failed')
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                   ES_DISABLED=True)
+class MessageBuilderBulkTestCase(DatabaseTestCase):
+
+    def setUp(self):
+        # Skip __init__, it needs credentials and only the account is used when saving.
+        self.manager = GmailManager.__new__(GmailManager)
+        self.manager.email_account = GmailAccountFactory.create()
+        self.builder = MessageBuilder(self.manager)
+        # An update is scheduled already, so the thread updates aren't sent to the broker.
+        cache.set(THREADS_FLUSH_KEY % self.manager.email_account.pk, True)
+
+    def tearDown(self):
+        EmailHeader.objects.__dict__.pop('bulk_create', None)
+
+    def add_message(self, message_id):
+        self.builder.bulk_messages.append({
+            'message': EmailMessage(account=self.manager.email_account, message_id=message_id, thread_id='thread',
+                                    subject='Subject', sent_date=timezone.now()),
+            'labels': [],
+            'headers': [EmailHeader(name='Subject', value='Subject')],
+            'sender': ('Sender', 'sender@example.com'),
+            'received_by': [('To', 'to@example.com')],
+            'received_by_cc': [],
+            'attachments': [],
+            'inline_attachments': {},
+        })
+
+    def test_messages_saved_with_rows(self):
+        self.add_message('first')
+        self.add_message('second')
+
+        self.builder.save_bulk()
+
+        email_messages = EmailMessage.objects.filter(account=self.manager.email_account)
+        self.assertEqual(sorted(email_messages.values_list('message_id', flat=True)), ['first', 'second'])
+        for email_message in email_messages:
+            self.assertEqual(email_message.sender.email_address, 'sender@example.com')
+            self.assertEqual([recipient.email_address for recipient in email_message.received_by.all()],
+                             ['to@example.com'])
+            self.assertEqual(email_message.headers.count(), 1)
+
+    def test_failed_insert_leaves_no_messages(self):
+        self.add_message('first')
+        EmailHeader.objects.bulk_create = fail
+
+        self.assertRaises(RuntimeError, self.builder.save_bulk)
+
+        self.assertFalse(EmailMessage.objects.filter(account=self.manager.email_account).exists())
+
+
+class EmailThreadUpdateTestCase(DatabaseTestCase):
+
+    def setUp(self):
+        self.email_account = GmailAccountFactory.create()
+        self.alice = Recipient.objects.create(name='Alice', email_address='alice@example.com')
+        self.bob = Recipient.objects.create(name='Bob', email_address='bob@example.com')
+
+    def create_message(self, message_id, sender, days=0, read=True, thread_id='thread'):
+        return EmailMessage.objects.create(
+            account=self.email_account, message_id=message_id, thread_id=thread_id, sender=sender, read=read,
+            subject='Subject %s' % message_id, sent_date=timezone.now() + datetime.timedelta(days=days),
+        )
+
+    def test_aggregates(self):
+        self.create_message('first', self.alice, read=False)
+        last = self.create_message('second', self.bob, days=1)
+
+        EmailThread.objects.update_threads(self.email_account, ['thread'])
+
+        thread = EmailThread.objects.get(account=self.email_account, thread_id='thread')
+        self.assertEqual(thread.message_count, 2)
+        self.assertEqual(thread.unread_count, 1)
+        self.assertEqual(thread.subject, 'Subject second')
+        self.assertEqual(thread.last_message_date, last.sent_date)
+        self.assertEqual(set(thread.participants.all()), {self.alice, self.bob})
+
+    def test_participants_updated(self):
+        first = self.create_message('first', self.alice)
+        self.create_message('second', self.bob, days=1)
+        EmailThread.objects.update_threads(self.email_account, ['thread'])
+
+        first.delete()
+        EmailThread.objects.update_threads(self.email_account, ['thread'])
+
+        thread = EmailThread.objects.get(account=self.email_account, thread_id='thread')
+        self.assertEqual(thread.message_count, 1)
+        self.assertEqual(list(thread.participants.all()), [self.bob])
+
+    def test_empty_thread_deleted(self):
+        email_message = self.create_message('first', self.alice)
+        EmailThread.objects.update_threads(self.email_account, ['thread'])
+
+        email_message.delete()
+        EmailThread.objects.update_threads(self.email_account, ['thread'])
+
+        self.assertFalse(EmailThread.objects.filter(account=self.email_account).exists())
+
+    def test_update_unread_counts(self):
+        email_message = self.create_message('first', self.alice)
+        self.create_message('other', self.alice, thread_id='other')
+        EmailThread.objects.update_threads(self.email_account, ['thread', 'other'])
+
+        EmailMessage.objects.filter(account=self.email_account).update(read=False)
+        EmailThread.objects.update_unread_counts(self.email_account, [email_message.thread_id])
+
+        unread_counts = dict(EmailThread.objects.values_list('thread_id', 'unread_count'))
+        self.assertEqual(unread_counts, {'thread': 1, 'other': 0})
+
+
+class FakeStorage(object):
+
+    def __init__(self):
+        self.deleted = []
+
+    def delete(self, name):
+        self.deleted.append(name)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                   EMAIL_ATTACHMENT_DELETE_DELAY=0)
+class AttachmentFileDeleteTestCase(DatabaseTestCase):
+
+    def setUp(self):
+        self.storage = FakeStorage()
+        self.default_storage = tasks.default_storage
+        tasks.default_storage = self.storage
+
+        email_account = GmailAccountFactory.create()
+        sender = Recipient.objects.create(name='Sender', email_address='sender@example.com')
+        self.email_message = EmailMessage.objects.create(account=email_account, message_id='message',
+                                                         thread_id='thread', sender=sender, sent_date=timezone.now())
+
+    def tearDown(self):
+        tasks.default_storage = self.default_storage
+
+    def create_attachment(self):
+        return EmailAttachment.objects.create(message=self.email_message, attachment='attachments/1/file.pdf',
+                                              content_hash='hash')
+
+    def test_shared_file_kept(self):
+        attachment = self.create_attachment()
+        self.create_attachment()
+
+        attachment.delete()
+        self.assertEqual(UnreferencedAttachmentFile.objects.count(), 1)
+
+        tasks.delete_unreferenced_attachment_files()
+        self.assertEqual(self.storage.deleted, [])
+        self.assertFalse(UnreferencedAttachmentFile.objects.exists())
+
+    def test_unreferenced_file_deleted(self):
+        self.create_attachment().delete()
+
+        tasks.delete_unreferenced_attachment_files()
+        self.assertEqual(self.storage.deleted, ['attachments/1/file.pdf'])
+        self.assertFalse(UnreferencedAttachmentFile.objects.exists())
+
+    def test_file_not_downloaded(self):
+        attachment = EmailAttachment.objects.create(message=self.email_message, attachment='file.pdf',
+                                                    attachment_id='gmail')
+
+        attachment.delete()
+
+        self.assertFalse(UnreferencedAttachmentFile.objects.exists())
+
+    def create_outbox_attachment(self, name):
+        email_outbox_message = EmailOutboxMessage.objects.create(
+            tenant=self.email_message.tenant, send_from=self.email_message.account, subject='Subject', body='',
+            to='[]', cc='[]', bcc='[]', mapped_attachments=0,
+        )
+        return EmailOutboxAttachment.objects.create(
+            tenant=self.email_message.tenant, email_outbox_message=email_outbox_message,
+            attachment=name % {'tenant_id': self.email_message.tenant_id, 'message_id': email_outbox_message.pk},
+        )
+
+    def test_forwarded_file_deleted(self):
+        name = 'messaging/email/attachments/%s/blobs/hash/file.pdf' % self.email_message.tenant_id
+        attachment = EmailAttachment.objects.create(message=self.email_message, attachment=name, content_hash='hash')
+        outbox_attachment = self.create_outbox_attachment(name)
+
+        attachment.delete()
+        tasks.delete_unreferenced_attachment_files()
+        self.assertEqual(self.storage.deleted, [])
+
+        outbox_attachment.delete()
+        tasks.delete_unreferenced_attachment_files()
+        self.assertEqual(self.storage.deleted, [name])
+
+    def test_outbox_files_kept(self):
+        self.create_outbox_attachment('messaging/email/attachments/%(tenant_id)s/%(message_id)s/upload.pdf').delete()
+        self.create_outbox_attachment('messaging/email/templates/attachments/%(tenant_id)s/1/template.pdf').delete()
+
+        self.assertFalse(UnreferencedAttachmentFile.objects.exists())
+
+
+class OutboxMessageFileTestCase(DatabaseTestCase):
+
+    def setUp(self):
+        email_account = GmailAccountFactory.create()
+        self.email_outbox_message = EmailOutboxMessage.objects.create(
+            tenant=email_account.tenant, send_from=email_account, subject='Subject', body='<p>Body</p>',
+            to='["to@example.com"]', cc='[]', bcc='[]', mapped_attachments=0,
+        )
+        self.names = []
+
+    def tearDown(self):
+        for name in self.names:
+            default_storage.delete(name)
+
+    def add_attachment(self, filename, content, content_type=''):
+        name = default_storage.save('messaging/email/tests/%s' % filename, ContentFile(content))
+        self.names.append(name)
+        EmailOutboxAttachment.objects.create(
+            tenant=self.email_outbox_message.tenant, email_outbox_message=self.email_outbox_message,
+            attachment=name, size=len(content), content_type=content_type,
+        )
+
+    def get_attachment_parts(self):
+        message = message_from_file(self.email_outbox_message.message_file())
+        return {
+            part.get_filename(): part for part in message.walk()
+            if part.get('Content-Disposition', '').startswith('attachment')
+        }
+
+    def test_attachments_round_trip(self):
+        content = ''.join(chr(i % 256) for i in range(100000))
+        self.add_attachment('report.bin', content, content_type='application/pdf')
+        self.add_attachment('archive.tar.gz', 'not really gzipped')
+
+        parts = self.get_attachment_parts()
+
+        self.assertEqual(sorted(parts), ['archive.tar.gz', 'report.bin'])
+        self.assertEqual(parts['report.bin'].get_content_type(), 'application/pdf')
+        self.assertEqual(parts['report.bin'].get_payload(decode=True), content)
+        self.assertEqual(parts['archive.tar.gz'].get_content_type(), 'application/octet-stream')
+        self.assertEqual(parts['archive.tar.gz'].get_payload(decode=True), 'not really gzipped')
+
+
+class ManagerReferenceCycleTestCase(TestCase):
+
+    def create_manager(self):
+        # Skip __init__, it needs credentials and only the builders are relevant here.
+        manager = GmailManager.__new__(GmailManager)
+        manager.message_builder = MessageBuilder(manager)
+        manager.label_builder = LabelBuilder(manager)
+        return manager
+
+    def setUp(self):
+        gc.collect()
+        gc.disable()
+
+    def tearDown(self):
+        gc.enable()
+
+    def test_manager_freed_without_collection(self):
+        manager = self.create_manager()
+        reference = weakref.ref(manager)
+        del manager
+
+        self.assertIsNone(reference())
+
+    def test_no_memory_growth(self):
+        self.create_manager()
+        objects = len(gc.get_objects())
+
+        for i in range(1000):
+            self.create_manager()
+
+        # Objects in reference cycles would pile up, because the collector is disabled.
+        self.assertLess(len(gc.get_objects()) - objects, 100)
+
+
+class FakeManagerConnector(object):
+
+    def __init__(self):
+        self.pages = []
+        self.history_saved = False
+        self.labels = []
+        self.deleted_labels = set()
+
+    def get_message_id_pages(self):
+        for page in self.pages:
+            yield page
+
+    def save_history_id(self):
+        self.history_saved = True
+
+    def get_label_list(self):
+        return self.labels
+
+    def batch_update_labels(self, message_ids, labels):
+        if self.deleted_labels.intersection(labels.get('addLabelIds', [])):
+            raise LabelNotFoundError
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                   ES_DISABLED=True)
+class GmailManagerTestCase(DatabaseTestCase):
+
+    def setUp(self):
+        cache.clear()
+        # Skip __init__, it needs credentials.
+        self.manager = GmailManager.__new__(GmailManager)
+        self.manager.email_account = GmailAccountFactory.create()
+        self.manager.connector = FakeManagerConnector()
+        self.manager.message_builder = MessageBuilder(self.manager)
+        self.manager.label_builder = LabelBuilder(self.manager)
+        self.manager.label_cache = None
+        self.remove_ids_from_index = manager.remove_ids_from_index
+
+    def tearDown(self):
+        manager.remove_ids_from_index = self.remove_ids_from_index
+
+    def test_first_sync_chunks(self):
+        account_id = self.manager.email_account.id
+        NoEmailMessageId.objects.create(account=self.manager.email_account, message_id='chat')
+        self.manager.connector.pages = [
+            [{'id': '1'}, {'id': '2'}, {'id': '3'}],
+            [{'id': 'chat'}, {'id': '4'}, {'id': '5'}],
+        ]
+
+        with self.settings(GMAIL_FIRST_SYNC_CHUNK_SIZE=2):
+            self.manager.full_synchronize()
+
+        self.assertEqual(pop_first_sync_tasks(account_id, 10), [
+            ('download_email_messages', [account_id, ['1', '2']]),
+            ('download_email_messages', [account_id, ['3', '4']]),
+            ('download_email_messages', [account_id, ['5']]),
+            ('first_sync_finished', [account_id]),
+        ])
+        self.assertTrue(self.manager.connector.history_saved)
+
+    def test_first_sync_streams_pages(self):
+        account_id = self.manager.email_account.id
+        queued_before_second_page = []
+
+        def get_message_id_pages():
+            yield [{'id': '1'}, {'id': '2'}]
+            queued_before_second_page.append(cache.get(FIRST_SYNC_TAIL_KEY % account_id))
+            yield [{'id': '3'}]
+
+        self.manager.connector.get_message_id_pages = get_message_id_pages
+
+        with self.settings(GMAIL_FIRST_SYNC_CHUNK_SIZE=2):
+            self.manager.full_synchronize()
+
+        # The first page is queued before the next page is listed.
+        self.assertEqual(queued_before_second_page, [1])
+        self.assertEqual(len(pop_first_sync_tasks(account_id, 10)), 3)
+
+    def create_label(self, label_id, **kwargs):
+        return EmailLabel.objects.create(account=self.manager.email_account, label_id=label_id, name=label_id,
+                                         **kwargs)
+
+    def test_labels_loaded_once(self):
+        inbox = self.create_label('INBOX')
+        self.create_label('SENT')
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.manager.get_label('INBOX'), inbox)
+            self.assertEqual(self.manager.get_label('SENT').label_id, 'SENT')
+
+    def test_new_label_fetched(self):
+        self.manager.load_label_cache()
+        self.manager.connector.labels = [{'id': 'Label_1', 'type': 'user', 'name': 'Work'}]
+
+        label = self.manager.get_label('Label_1')
+
+        self.assertEqual(label.name, 'Work')
+        self.assertEqual(EmailLabel.objects.get(account=self.manager.email_account, label_id='Label_1'), label)
+
+    def test_cache_reloaded_when_label_deleted(self):
+        label = self.create_label('Label_1')
+        self.manager.load_label_cache()
+        # The labels changed after the cache was loaded.
+        label.delete()
+        self.create_label('Label_2')
+        self.manager.connector.deleted_labels = {'Label_1'}
+
+        self.manager.batch_add_and_remove_labels({'message': (['Label_1'], [])})
+
+        self.assertEqual(sorted(self.manager.label_cache), ['Label_2'])
+
+    def create_message(self, message_id, labels, read=False):
+        sender = Recipient.objects.get_or_create(name='Sender', email_address='sender@example.com')[0]
+        email_message = EmailMessage.objects.create(account=self.manager.email_account, message_id=message_id,
+                                                    thread_id='thread', sender=sender, sent_date=timezone.now(),
+                                                    read=read)
+        email_message.labels.add(*labels)
+        return email_message
+
+    def test_unread_counts(self):
+        inbox = self.create_label('INBOX')
+        work = self.create_label('Label_1', unread=5)
+        self.create_label('Label_2')
+        self.create_message('1', [inbox, work])
+        self.create_message('2', [inbox])
+        self.create_message('3', [inbox, work], read=True)
+
+        self.manager.update_unread_count()
+
+        labels = EmailLabel.objects.filter(account=self.manager.email_account)
+        self.assertEqual(dict(labels.values_list('label_id', 'unread')), {'INBOX': 2, 'Label_1': 1, 'Label_2': 0})
+        for label in labels:
+            self.assertEqual(label.unread, label.messages.filter(read=False).count())
+
+    def test_delete_messages(self):
+        removed_ids = []
+        manager.remove_ids_from_index = lambda ids, mapping: removed_ids.extend(ids)
+        # An update is scheduled already, so the thread updates aren't sent to the broker.
+        cache.set(THREADS_FLUSH_KEY % self.manager.email_account.pk, True)
+        inbox = self.create_label('INBOX')
+        email_message = self.create_message('deleted', [inbox])
+        email_message.received_by.add(email_message.sender)
+        EmailHeader.objects.create(message=email_message, name='Subject', value='Subject')
+        EmailAttachment.objects.create(message=email_message, attachment='attachments/1/file.pdf')
+        kept_message = self.create_message('kept', [inbox])
+
+        self.manager.delete_messages(['deleted'])
+
+        self.assertEqual(list(EmailMessage.objects.filter(account=self.manager.email_account)), [kept_message])
+        self.assertEqual(removed_ids, [email_message.pk])
+        self.assertFalse(EmailHeader.objects.filter(message_id=email_message.pk).exists())
+        self.assertFalse(EmailAttachment.objects.filter(message_id=email_message.pk).exists())
+        for field_name in ['labels', 'received_by']:
+            through = getattr(EmailMessage, field_name).through
+            self.assertFalse(through.objects.filter(emailmessage_id=email_message.pk).exists())
+        self.assertEqual(list(inbox.messages.all()), [kept_message])
+        self.assertEqual(list(UnreferencedAttachmentFile.objects.values_list('name', flat=True)),
+                         ['attachments/1/file.pdf'])
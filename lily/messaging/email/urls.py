@@ -5,13 +5,14 @@ from .views import (SetupEmailAuth, OAuth2Callback, EmailAttachmentProxy, EmailT
                     CreateEmailTemplateView, UpdateEmailTemplateView, ParseEmailTemplateView, EmailMessageSendView,
                     EmailTemplateDeleteView, DetailEmailTemplateView, EmailMessageDraftView, EmailMessageReplyView,
                     EmailMessageForwardView, EmailMessageReplyAllView, CreateTemplateVariableView,
-                    UpdateTemplateVariableView)
+                    UpdateTemplateVariableView, GmailPushNotificationView)
 
 
 urlpatterns = patterns(
     '',
     url(r'^setup/$', SetupEmailAuth.as_view(), name='messaging_email_account_setup'),
     url(r'^callback/$', OAuth2Callback.as_view(), name='gmail_callback'),
+    url(r'^push/$', GmailPushNotificationView.as_view(), name='gmail_push_notification'),
     url(r'^html/(?P<pk>[\d-]+)/$', EmailMessageHTMLView.as_view(), name='messaging_email_html'),
     url(r'^attachment/(?P<pk>[\d-]+)/$', EmailAttachmentProxy.as_view(), name='email_attachment_proxy_view'),
 
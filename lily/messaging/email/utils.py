@@ -1,3 +1,5 @@
+import base64
+import hashlib
 import logging
 import re
 import mimetypes
@@ -6,20 +8,23 @@ from bs4 import BeautifulSoup
 import html2text
 from urllib import unquote
 
+from django.conf import settings
+from django.core.cache import cache
 from django.core.files.storage import default_storage
 from django.core.urlresolvers import reverse
 from django.db import models
 from django.template import Context, TemplateSyntaxError, VARIABLE_TAG_START, VARIABLE_TAG_END
 from django.template.loader import get_template_from_string
 from django.template.loader_tags import BlockNode, ExtendsNode
+from django.utils.crypto import salted_hmac
 from django.utils.translation import ugettext_lazy as _
 
 from lily.accounts.models import Account
 from lily.contacts.models import Contact
 
 from .decorators import get_safe_template
-from .models.models import EmailAttachment
-from .sanitize import sanitize_html_email
+from .models.models import EmailAttachment, get_attachment_upload_path
+from .sanitize import SANITIZE_VERSION, sanitize_html_email
 
 _EMAIL_PARAMETER_DICT = {}
 _EMAIL_PARAMETER_API_DICT = {}
@@ -27,6 +32,16 @@ _EMAIL_PARAMETER_CHOICES = {}
 
 logger = logging.getLogger(__name__)
 
+# Version of the rendering of email bodies, bump it when render_email_body changes so cached bodies are rendered again.
+EMAIL_BODY_RENDER_VERSION = 2
+EMAIL_BODY_CACHE_KEY = 'email_body_%s_%s_%s'
+# Stands in for the scheme and host of links in cached bodies, so a body is cached once for all hosts.
+# It's derived from the secret key, so a sender can't put it in a message to have it replaced.
+EMAIL_BODY_ORIGIN_PLACEHOLDER = '__lily_email_body_origin_%s__' % salted_hmac(
+    'lily.messaging.email.body_origin',
+    'placeholder',
+).hexdigest()[:20]
+
 
 def get_field_names(field):
     """
@@ -216,7 +231,152 @@ def get_attachment_filename_from_url(url):
     return unquote(url).split('/')[-1]
 
 
-def render_email_body(html, mapped_attachments, request):
+def parse_range_header(header, size):
+    """
+    Parse the Range header of a request for a file, only single byte ranges are supported.
+
+    Args:
+        header (string): value of the Range header, e.g. bytes=0-499
+        size (int): size of the file in bytes
+
+    Returns:
+        tuple with the first and last byte of the range, or None if the whole file should be returned
+
+    Raises:
+        ValueError: if the range can't be satisfied
+    """
+    match = re.match(r'^bytes=(\d*)-(\d*)$', (header or '').strip())
+    if not match or not any(match.groups()):
+        # Multiple or invalid ranges, the whole file is returned.
+        return None
+
+    start, end = match.groups()
+    if not start:
+        # The last bytes of the file, e.g. bytes=-500.
+        start, end = max(0, size - int(end)), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+
+    if start > end or start >= size:
+        raise ValueError('Range %s not satisfiable for %s bytes' % (header, size))
+
+    return start, end
+
+
+def iter_stored_file(name, start, end=None, chunk_size=None):
+    """
+    Read a range of a stored file in chunks, without loading the whole file.
+
+    Args:
+        name (string): name of the file in the default storage
+        start (int): first byte
+        end (int, optional): last byte, defaults to the end of the file
+        chunk_size (int, optional): max bytes per chunk, defaults to EMAIL_ATTACHMENT_STREAM_CHUNK_SIZE
+
+    Yields:
+        string: the next chunk of the file
+    """
+    chunk_size = chunk_size or settings.EMAIL_ATTACHMENT_STREAM_CHUNK_SIZE
+    stored_file = default_storage._open(name)
+    key = getattr(stored_file, 'key', None)
+    if key is not None:
+        # Read from S3 directly, the storage file would download the whole object first.
+        key.open_read(headers={'Range': 'bytes=%d-%s' % (start, '' if end is None else end)})
+        reader = key
+    else:
+        stored_file.seek(start)
+        reader = stored_file
+
+    try:
+        remaining = float('inf') if end is None else end - start + 1
+        while remaining > 0:
+            chunk = reader.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        reader.close()
+
+
+def decode_base64url_to_file(data, file, digest=None):
+    """
+    Decode base64url data to a file, one chunk at a time, so there's never a decoded copy of all data.
+
+    Args:
+        data (string): base64url encoded data
+        file (file): file to write the decoded data to
+        digest (instance, optional): hashlib hash object, updated with the decoded data
+
+    Returns:
+        int: number of bytes written
+    """
+    # Every 4 base64 characters decode to 3 bytes, so chunks have to be a multiple of 4 characters.
+    chunk_size = settings.GMAIL_CHUNK_SIZE - settings.GMAIL_CHUNK_SIZE % 4
+    size = 0
+    for i in range(0, len(data), chunk_size):
+        chunk = data[i:i + chunk_size].encode('UTF-8')
+        # Pad the last chunk, in case the padding was left out.
+        chunk += '=' * (-len(chunk) % 4)
+        decoded = base64.urlsafe_b64decode(chunk)
+        file.write(decoded)
+        if digest is not None:
+            digest.update(decoded)
+        size += len(decoded)
+
+    file.seek(0)
+    return size
+
+
+def deduplicate_attachments(attachments):
+    """
+    Let new attachments refer to the stored file when the same file is already stored, instead of uploading it.
+
+    Args:
+        attachments (list): EmailAttachment instances, the ones with a content_hash and an unsaved file are checked
+    """
+    names = [
+        (attachment, get_attachment_upload_path(attachment, attachment.attachment.name))
+        for attachment in attachments if attachment.content_hash and not attachment.attachment._committed
+    ]
+    if not names:
+        return
+
+    stored_names = set(EmailAttachment.objects.filter(
+        content_hash__in=set(attachment.content_hash for attachment, name in names),
+        attachment__in=set(name for attachment, name in names),
+    ).values_list('attachment', flat=True))
+
+    for attachment, name in names:
+        if name in stored_names:
+            attachment.attachment.close()
+            attachment.attachment = name
+        else:
+            # The first attachment uploads the file, the others refer to it.
+            stored_names.add(name)
+
+
+def encode_base64_to_file(chunks, file):
+    """
+    Encode data to MIME base64 lines of 76 characters and write it to a file, one chunk at a time.
+
+    Args:
+        chunks (iterable): strings with the data
+        file (file): file-like object to write to
+    """
+    rest = ''
+    for chunk in chunks:
+        data = rest + chunk
+        # Every line encodes 57 bytes, so only encode whole lines until the last chunk.
+        split = len(data) - len(data) % 57
+        file.write(base64.encodestring(data[:split]))
+        rest = data[split:]
+
+    if rest:
+        file.write(base64.encodestring(rest))
+
+
+def render_email_body(html, mapped_attachments, request, origin=None, sanitized=False):
     """
     Update all the target attributes in the <a> tag.
     After that replace the cid information in the html
@@ -225,6 +385,8 @@ def render_email_body(html, mapped_attachments, request):
         html (string): HTML string of the email body to be sent.
         mapped_attachments (list): List of linked attachments to the email
         request (instance): The django request
+        origin (string, optional): scheme and host of the links to attachments, defaults to those of the request
+        sanitized (boolean, optional): if True, the html is sanitized already
 
     Returns:
         html body (string)
@@ -233,12 +395,108 @@ def render_email_body(html, mapped_attachments, request):
         return None
 
     email_body = replace_anchors_in_html(html)
-    email_body = replace_cid_in_html(email_body, mapped_attachments, request)
+    email_body = replace_cid_in_html(email_body, mapped_attachments, request, origin, sanitized)
 
     return email_body
 
 
-def replace_cid_in_html(html, mapped_attachments, request):
+def get_email_body_cache_key(email_message, attachments):
+    """
+    Get the cache key of the rendered html body of an EmailMessage.
+
+    The key contains a hash of the body and the attachments, so it changes when the message changes, and the
+    versions of the rendering and the sanitizing.
+
+    Args:
+        email_message (instance): EmailMessage instance
+        attachments (list): EmailAttachment instances of the message
+
+    Returns:
+        string: the cache key
+    """
+    fingerprint = hashlib.md5(email_message.body_html.encode('utf-8'))
+    for attachment in sorted(attachments, key=lambda attachment: attachment.pk):
+        fingerprint.update(('|%s:%s' % (attachment.pk, attachment.cid)).encode('utf-8'))
+
+    version = '%s.%s' % (EMAIL_BODY_RENDER_VERSION, SANITIZE_VERSION)
+
+    return EMAIL_BODY_CACHE_KEY % (version, email_message.pk, fingerprint.hexdigest())
+
+
+def cache_email_body(email_message, attachments=None):
+    """
+    Render the html body of an EmailMessage for all hosts and cache it, unless it's cached already.
+
+    Args:
+        email_message (instance): EmailMessage instance
+        attachments (list, optional): EmailAttachment instances of the message, fetched when not given
+
+    Returns:
+        html body (string) with EMAIL_BODY_ORIGIN_PLACEHOLDER instead of the scheme and host of links
+    """
+    if attachments is None:
+        attachments = list(email_message.attachments.all())
+
+    key = get_email_body_cache_key(email_message, attachments)
+    body = cache.get(key)
+    if body is None:
+        body = render_email_body(
+            email_message.get_sanitized_body_html(),
+            attachments,
+            None,
+            origin=EMAIL_BODY_ORIGIN_PLACEHOLDER,
+            sanitized=True,
+        )
+        cache.set(key, body, settings.EMAIL_BODY_CACHE_TIMEOUT)
+
+    return body
+
+
+def render_cached_email_body(email_message, request):
+    """
+    Render the html body of an EmailMessage like render_email_body, but only once for every version of the message.
+
+    Args:
+        email_message (instance): EmailMessage instance
+        request (instance): The django request
+
+    Returns:
+        html body (string)
+    """
+    return replace_email_body_origin(cache_email_body(email_message), get_request_origin(request))
+
+
+def replace_email_body_origin(body, origin):
+    """
+    Put the scheme and host in the links of a body rendered by cache_email_body.
+
+    Only the links to attachments have the placeholder and they're all in src attributes, so text of the
+    message is never replaced.
+
+    Args:
+        body (string): html body with EMAIL_BODY_ORIGIN_PLACEHOLDER
+        origin (string): scheme and host of the links
+
+    Returns:
+        html body (string)
+    """
+    return body.replace('src="%s' % EMAIL_BODY_ORIGIN_PLACEHOLDER, 'src="%s' % origin)
+
+
+def get_request_origin(request):
+    """
+    Get the scheme and host of the request, e.g. https://app.hellolily.com.
+
+    Args:
+        request (instance): The django request
+
+    Returns:
+        string: scheme and host
+    """
+    return '%s://%s' % ('https' if request.is_secure() else 'http', request.META['HTTP_HOST'])
+
+
+def replace_cid_in_html(html, mapped_attachments, request, origin=None, sanitized=False):
     """
     Replace all the cid image information with a link to the image
 
@@ -246,6 +504,8 @@ def replace_cid_in_html(html, mapped_attachments, request):
         html (string): HTML string of the email body to be sent.
         mapped_attachments (list): List of linked attachments to the email
         request (instance): The django request
+        origin (string, optional): scheme and host of the links to attachments, defaults to those of the request
+        sanitized (boolean, optional): if True, the html is sanitized already and only the cids are replaced
 
     Returns:
         html body (string)
@@ -261,13 +521,12 @@ def replace_cid_in_html(html, mapped_attachments, request):
         inline_images = soup.findAll('img', {'src': lambda src: src and src.startswith('cid:')})
 
     if (not soup or soup.get_text() == '') and not inline_images:
-        html = sanitize_html_email(html)
+        if not sanitized:
+            html = sanitize_html_email(html)
         return html
 
-    protocol = 'http'
-    if request.is_secure():
-        protocol = 'https'
-    host = request.META['HTTP_HOST']
+    if origin is None:
+        origin = get_request_origin(request)
 
     for image in inline_images:
         image_cid = image.get('src')[4:]
@@ -275,12 +534,13 @@ def replace_cid_in_html(html, mapped_attachments, request):
         for attachment in mapped_attachments:
             if (attachment.cid[1:-1] == image_cid or attachment.cid == image_cid) and attachment.cid not in cid_done:
                 proxy_url = reverse('email_attachment_proxy_view', kwargs={'pk': attachment.pk})
-                image['src'] = '%s://%s%s' % (protocol, host, proxy_url)
+                image['src'] = '%s%s' % (origin, proxy_url)
                 image['cid'] = image_cid
                 cid_done.append(attachment.cid)
 
     html = soup.encode_contents()
-    html = sanitize_html_email(html)
+    if not sanitized:
+        html = sanitize_html_email(html)
 
     return html
 
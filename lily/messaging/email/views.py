@@ -1,9 +1,8 @@
 from itertools import chain
 import anyjson
-import HTMLParser
 import logging
+import math
 import mimetypes
-import re
 import urllib
 
 from braces.views import StaticContextMixin
@@ -14,12 +13,14 @@ from django.conf import settings
 from django.contrib import messages
 from django.contrib.messages.views import SuccessMessageMixin
 from django.core.files.storage import default_storage
-from django.core.servers.basehttp import FileWrapper
 from django.core.urlresolvers import reverse
-from django.http import HttpResponseRedirect, HttpResponseBadRequest, Http404, HttpResponse
-from django.template import Context, Template
+from django.http import (HttpResponseRedirect, HttpResponseBadRequest, HttpResponseForbidden, Http404, HttpResponse,
+                         HttpResponseNotModified, StreamingHttpResponse)
+from django.utils.crypto import constant_time_compare
+from django.utils.decorators import method_decorator
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
+from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import UpdateView, DeleteView, CreateView, FormView
 from django.views.generic.base import View
 from django.views.generic.detail import DetailView
@@ -34,15 +35,21 @@ from lily.tenant.middleware import get_current_user
 from lily.utils.functions import is_ajax, post_intercom_event
 from lily.utils.views.mixins import LoginRequiredMixin, FormActionMixin, AjaxFormMixin
 
+from .connector import ConnectorError, MessageNotFoundError, RateLimitError
 from .forms import (ComposeEmailForm, CreateUpdateEmailTemplateForm, CreateUpdateTemplateVariableForm,
                     EmailAccountCreateUpdateForm, EmailTemplateFileForm, EmailTemplateSetDefaultForm)
+from .manager import GmailManager, ManagerError
 from .models.models import (EmailMessage, EmailAttachment, EmailAccount, EmailTemplate, DefaultEmailTemplate,
                             EmailOutboxMessage, EmailOutboxAttachment, TemplateVariable, GmailCredentialsModel)
-from .services import build_gmail_service
+from .push import parse_push_notification
+from .scheduling import request_sync
+from .services import build_gmail_service, gmail_service_cache
 from .tasks import (send_message, create_draft_email_message, delete_email_message, archive_email_message,
                     update_draft_email_message)
 from .utils import (get_attachment_filename_from_url, get_email_parameter_choices, create_recipients,
-                    render_email_body, replace_cid_in_html, create_reply_body_header)
+                    render_cached_email_body, replace_cid_in_html, create_reply_body_header, iter_stored_file,
+                    parse_range_header)
+from .templating import get_template_lookups, render_email_template
 
 
 logger = logging.getLogger(__name__)
@@ -100,6 +107,8 @@ class OAuth2Callback(LoginRequiredMixin, View):
         # Store credentials based on new email account.
         storage = Storage(GmailCredentialsModel, 'id', account, 'credentials')
         storage.put(credentials)
+        # Services cached with the old credentials shouldn't be used anymore.
+        gmail_service_cache.invalidate(account.pk)
 
         # Set account as authorized.
         account.is_authorized = True
@@ -125,6 +134,40 @@ class OAuth2Callback(LoginRequiredMixin, View):
         return HttpResponseRedirect('/#/preferences/emailaccounts/edit/%s' % account.pk)
 
 
+class GmailPushNotificationView(View):
+    """
+    Webhook for the Pub/Sub push subscription of the Gmail push notifications.
+
+    Only the accounts of the changed mailbox are synced. Pub/Sub redelivers a notification until it gets a
+    success response, so invalid notifications are acknowledged as well.
+    """
+    @method_decorator(csrf_exempt)
+    def dispatch(self, request, *args, **kwargs):
+        return super(GmailPushNotificationView, self).dispatch(request, *args, **kwargs)
+
+    def post(self, request):
+        token = request.GET.get('token', '')
+        if not settings.GMAIL_PUSH_TOKEN or not constant_time_compare(token, settings.GMAIL_PUSH_TOKEN):
+            return HttpResponseForbidden()
+
+        try:
+            email_address, history_id = parse_push_notification(request.body)
+        except ValueError as e:
+            logger.warning(e)
+        else:
+            # Accounts that already have the change or are still waiting for their first sync are skipped.
+            email_accounts = EmailAccount.objects.filter(
+                email_address=email_address,
+                is_authorized=True,
+                is_deleted=False,
+                history_id__lt=history_id,
+            )
+            for pk in email_accounts.values_list('pk', flat=True):
+                request_sync(pk)
+
+        return HttpResponse(status=204)
+
+
 class EmailAccountUpdateView(LoginRequiredMixin, SuccessMessageMixin, FormActionMixin, StaticContextMixin, UpdateView):
     template_name = 'form.html'
     model = EmailAccount
@@ -166,7 +209,7 @@ class EmailMessageHTMLView(LoginRequiredMixin, DetailView):
 
     def get_context_data(self, **kwargs):
         context = super(EmailMessageHTMLView, self).get_context_data(**kwargs)
-        context['body_html'] = render_email_body(self.object.body_html, self.object.attachments.all(), self.request)
+        context['body_html'] = render_cached_email_body(self.object, self.request)
         return context
 
 
@@ -180,22 +223,77 @@ class EmailAttachmentProxy(View):
         except:
             raise Http404()
 
-        s3_file = default_storage._open(attachment.attachment.name)
-
-        wrapper = FileWrapper(s3_file)
-        if hasattr(s3_file, 'key'):
-            content_type = s3_file.key.content_type
-        else:
-            content_type = mimetypes.guess_type(s3_file.file.name)[0]
-
-        response = HttpResponse(wrapper, content_type=content_type)
+        if not attachment.is_downloaded:
+            try:
+                # Don't keep the request waiting when the account is rate limited.
+                manager = GmailManager(attachment.message.account, defer_rate_limits=True)
+            except ManagerError:
+                logger.exception('Couldn\'t download attachment %s' % attachment.pk)
+                return HttpResponse(status=502)
 
-        inline = 'attachment'
-        if attachment.inline:
-            inline = 'inline'
+            try:
+                attachment = manager.download_attachment(attachment)
+            except (MessageNotFoundError, EmailAttachment.DoesNotExist):
+                raise Http404()
+            except RateLimitError as e:
+                response = HttpResponse(status=503)
+                response['Retry-After'] = int(math.ceil(e.countdown))
+                return response
+            except (ManagerError, ConnectorError):
+                logger.exception('Couldn\'t download attachment %s' % attachment.pk)
+                return HttpResponse(status=502)
+            finally:
+                manager.cleanup()
+
+        name = attachment.attachment.name
+        etag = '"%s"' % (attachment.content_hash or '%s-%s' % (attachment.pk, attachment.size))
+        if etag in [tag.strip() for tag in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            return response
+
+        content_type = attachment.content_type or mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        disposition = '%s; filename=%s' % (
+            'inline' if attachment.inline else 'attachment',
+            get_attachment_filename_from_url(name),
+        )
 
-        response['Content-Disposition'] = '%s; filename=%s' % (inline, get_attachment_filename_from_url(s3_file.name))
-        response['Content-Length'] = attachment.size
+        if settings.EMAIL_ATTACHMENT_SIGNED_URLS:
+            s3_file = default_storage._open(name)
+            if hasattr(s3_file, 'key'):
+                # Let the browser download the file from S3 directly, the tenant is checked above.
+                return HttpResponseRedirect(s3_file.key.generate_url(
+                    settings.EMAIL_ATTACHMENT_SIGNED_URL_EXPIRE,
+                    response_headers={
+                        'response-content-type': content_type,
+                        'response-content-disposition': disposition,
+                    },
+                ))
+
+        size = attachment.size
+        byte_range = None
+        if 'HTTP_RANGE' in request.META and request.META.get('HTTP_IF_RANGE', etag) == etag:
+            try:
+                byte_range = parse_range_header(request.META['HTTP_RANGE'], size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = 'bytes */%s' % size
+                return response
+
+        if byte_range:
+            start, end = byte_range
+            response = StreamingHttpResponse(iter_stored_file(name, start, end), status=206, content_type=content_type)
+            response['Content-Range'] = 'bytes %s-%s/%s' % (start, end, size)
+        else:
+            start, end = 0, size - 1
+            response = StreamingHttpResponse(iter_stored_file(name, start, end), content_type=content_type)
+
+        response['Content-Disposition'] = disposition
+        response['Content-Length'] = end - start + 1
+        response['Accept-Ranges'] = 'bytes'
+        response['ETag'] = etag
+        # Attachments never change, so browsers can keep them.
+        response['Cache-Control'] = 'private, max-age=%s' % settings.EMAIL_ATTACHMENT_MAX_AGE
         return response
 
 
@@ -227,7 +325,12 @@ class EmailMessageComposeView(LoginRequiredMixin, FormView):
 
                 attachments = EmailAttachment.objects.filter(message_id=self.object.pk)
 
-                self.object.body_html = replace_cid_in_html(self.object.body_html, attachments, request)
+                self.object.body_html = replace_cid_in_html(
+                    self.object.get_sanitized_body_html(),
+                    attachments,
+                    request,
+                    sanitized=True,
+                )
             except EmailMessage.DoesNotExist:
                 pass
 
@@ -923,31 +1026,16 @@ class EmailTemplateGetDefaultView(LoginRequiredMixin, View):
 class DetailEmailTemplateView(LoginRequiredMixin, DetailView):
     def get(self, request, *args, **kwargs):
         template = EmailTemplate.objects.get(pk=kwargs.get('template_id'))
-        lookup = {'user': self.request.user}
 
-        if 'account_id' in self.request.GET:
-            try:
-                account = Account.objects.get(pk=self.request.GET.get('account_id'))
-            except Account.DoesNotExist:
-                pass
-            else:
-                lookup.update({'account': account})
+        try:
+            contact_id = int(self.request.GET['contact_id'])
+        except (KeyError, ValueError):
+            contact_id = None
 
-        if 'contact_id' in self.request.GET:
-            try:
-                contact = Contact.objects.get(pk=self.request.GET.get('contact_id'))
-            except Contact.DoesNotExist:
-                pass
-            else:
-                lookup.update({'contact': contact})
-                functions = contact.functions.all()
-                if len(functions) == 1:
-                    try:
-                        account = Account.objects.get(pk=functions[0].account_id)
-                    except Account.DoesNotExist:
-                        pass
-                    else:
-                        lookup.update({'account': account})
+        try:
+            account_id = int(self.request.GET['account_id'])
+        except (KeyError, ValueError):
+            account_id = None
 
         if 'emailaccount_id' in self.request.GET:
             try:
@@ -955,49 +1043,10 @@ class DetailEmailTemplateView(LoginRequiredMixin, DetailView):
             except EmailAccount.DoesNotExist:
                 pass
             else:
-                lookup.get('user').current_email_address = emailaccount.email_address
-
-        # Setup regex to find custom variables
-        search_regex = '\[\[ custom\.(.*?) \]\]'
-        # Find all occurrences.
-        search_result = re.findall(search_regex, template.body_html)
-
-        if search_result:
-            for custom_variable in search_result:
-                public = None
-
-                try:
-                    # Try to split to see if it's a public variable
-                    variable, public = custom_variable.split('.')
-                except ValueError:
-                    # Not a public variable, so .split raises an error
-                    variable = custom_variable
-
-                if public:
-                    template_variable = TemplateVariable.objects.filter(
-                        name__iexact=variable,
-                        is_public=True
-                    )
-                else:
-                    template_variable = TemplateVariable.objects.filter(
-                        name__iexact=variable,
-                        owner=get_current_user()
-                    )
-
-                if template_variable:
-                    # find = '\[\[ custom.' + custom_variable + '(\s)?\]\]'
-                    find = re.compile('\[\[ custom\.' + custom_variable + ' \]\]')
-                    replace = template_variable.first().text
-
-                    template.body_html = re.sub(find, replace, template.body_html, 1)
-
-        # Ugly hack to make parsing of new template brackets style work
-        parsed_template = Template(template.body_html.replace('[[', '{{').replace(']]', '}}')).render(Context(lookup))
-        parsed_subject = Template(template.subject.replace('[[', '{{').replace(']]', '}}')).render(Context(lookup))
+                self.request.user.current_email_address = emailaccount.email_address
 
-        # Make sure HTML entities are displayed correctly
-        html_parser = HTMLParser.HTMLParser()
-        parsed_subject = html_parser.unescape(parsed_subject)
+        lookups = get_template_lookups(self.request.user, [(contact_id, account_id)])
+        parsed_template, parsed_subject = render_email_template(template, self.request.user, lookups)[0]
 
         attachments = []
 
@@ -63,6 +63,46 @@ def remove_from_index(instance, mapping):
         logger.error(traceback.format_exc(e))
 
 
+def update_queryset_in_index(queryset, mapping):
+    """
+    Utility function to index all objects of a queryset at once, for changes that don't send
+    signals (e.g. bulk inserts and queryset updates).
+    All exceptions are caught, so failures will not interfere with the regular model updates.
+    """
+    if settings.ES_DISABLED:
+        return
+
+    try:
+        index_objects(mapping, queryset, main_index)
+        es.indices.refresh(get_index_name(main_index, mapping))
+    except Exception, e:
+        logger.error(traceback.format_exc(e))
+
+
+def remove_ids_from_index(ids, mapping):
+    """
+    Utility function to remove multiple objects from Elasticsearch with one bulk request, for deletes that
+    don't send signals.
+    All exceptions are caught, so failures will not interfere with the regular model updates.
+    """
+    if settings.ES_DISABLED or not ids:
+        return
+    logger.info(u'Removing %s instances of %s' % (len(ids), mapping.get_mapping_type_name()))
+
+    try:
+        main_index_with_type = get_index_name(main_index, mapping)
+        es.bulk(body=[{
+            'delete': {
+                '_index': main_index_with_type,
+                '_type': mapping.get_mapping_type_name(),
+                '_id': id_,
+            }
+        } for id_ in ids])
+        es.indices.refresh(main_index_with_type)
+    except Exception, e:
+        logger.error(traceback.format_exc(e))
+
+
 def index_objects(mapping, queryset, index, print_progress=False):
     """
     Index synchronously model specified mapping type with an optimized query.
@@ -32,6 +32,8 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_BACKEND = REDIS_URL
 CELERY_TASK_RESULT_EXPIRES = 300
 CELERY_TIMEZONE = TIME_ZONE
+# Number of tasks a worker process runs between full garbage collections, 0 to only use Python's own collection.
+WORKER_GC_TASK_INTERVAL = int(os.environ.get('WORKER_GC_TASK_INTERVAL', 100))
 
 # WARNING! When changing routes/queues, make sure you deleted them
 # on the message broker to prevent routing to old queues.
@@ -50,6 +52,24 @@ CELERY_ROUTES = (
     {'synchronize_email_account': {
         'queue': 'email_scheduled_tasks'
     }},
+    {'renew_email_account_watches': {
+        'queue': 'email_scheduled_tasks'
+    }},
+    {'watch_email_account': {
+        'queue': 'email_scheduled_tasks'
+    }},
+    {'unwatch_email_account': {
+        'queue': 'email_scheduled_tasks'
+    }},
+    {'resanitize_email_bodies': {
+        'queue': 'email_scheduled_tasks'
+    }},
+    {'update_email_threads': {
+        'queue': 'email_scheduled_tasks'
+    }},
+    {'delete_unreferenced_attachment_files': {
+        'queue': 'email_scheduled_tasks'
+    }},
     {'first_synchronize_email_account': {
         # Task created by this task, will be routed to queue3.
         'queue': 'email_scheduled_tasks'
@@ -58,6 +78,10 @@ CELERY_ROUTES = (
         # When task is created in first sync, this task will be routed to email_first_sync.
         'queue': 'email_scheduled_tasks'
     }},
+    {'download_email_messages': {
+        # When task is created in first sync, this task will be routed to email_first_sync.
+        'queue': 'email_scheduled_tasks'
+    }},
     {'update_labels_for_message': {
         # When task is created in first sync, this task will be routed to email_first_sync.
         'queue': 'email_scheduled_tasks'
@@ -68,4 +92,16 @@ CELERYBEAT_SCHEDULE = {
         'task': 'synchronize_email_account_scheduler',
         'schedule': timedelta(seconds=int(os.environ.get('EMAIL_SYNC_INTERVAL', 60))),
     },
+    'renew_email_account_watches': {
+        'task': 'renew_email_account_watches',
+        'schedule': timedelta(seconds=int(os.environ.get('EMAIL_WATCH_RENEWAL_INTERVAL', 60 * 60))),
+    },
+    'resanitize_email_bodies': {
+        'task': 'resanitize_email_bodies',
+        'schedule': timedelta(seconds=int(os.environ.get('EMAIL_RESANITIZE_INTERVAL', 60 * 60))),
+    },
+    'delete_unreferenced_attachment_files': {
+        'task': 'delete_unreferenced_attachment_files',
+        'schedule': timedelta(seconds=int(os.environ.get('EMAIL_ATTACHMENT_SWEEP_INTERVAL', 60 * 60))),
+    },
 }
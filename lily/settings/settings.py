@@ -125,6 +125,7 @@ ACCOUNT_LOGO_UPLOAD_TO = 'accounts/account/%(tenant_id)d/%(account_id)d/%(filena
 CONTACT_PICTURE_UPLOAD_TO = 'contacts/contact/%(tenant_id)d/%(contact_id)d/%(filename)s'
 LILYUSER_PICTURE_UPLOAD_TO = 'users/lilyuser/%(tenant_id)d/%(user_id)d/%(filename)s'
 EMAIL_ATTACHMENT_UPLOAD_TO = 'messaging/email/attachments/%(tenant_id)d/%(message_id)d/%(filename)s'
+EMAIL_ATTACHMENT_BLOB_UPLOAD_TO = 'messaging/email/attachments/%(tenant_id)d/blobs/%(content_hash)s/%(filename)s'
 EMAIL_TEMPLATE_ATTACHMENT_UPLOAD_TO = ('messaging/email/templates/attachments'
                                        '/%(tenant_id)d/%(template_id)d/%(filename)s')
 
@@ -551,9 +552,59 @@ ES_BLOCK = os.environ.get('ES_BLOCK', True)  # Default is False
 #######################################################################################################################
 GA_CLIENT_ID = os.environ.get('GA_CLIENT_ID', '')
 GA_CLIENT_SECRET = os.environ.get('GA_CLIENT_SECRET', '')
-GMAIL_FULL_MESSAGE_BATCH_SIZE = os.environ.get('GMAIL_FULL_MESSAGE_BATCH_SIZE', 300)
-GMAIL_LABEL_UPDATE_BATCH_SIZE = os.environ.get('GMAIL_LABEL_UPDATE_BATCH_SIZE', 500)
-GMAIL_PARTIAL_SYNC_LIMIT = os.environ.get('GMAIL_PARTIAL_SYNC_LIMIT', 899)
+# Number of calls per Gmail batch request, Gmail accepts at most 100.
+GMAIL_FULL_MESSAGE_BATCH_SIZE = int(os.environ.get('GMAIL_FULL_MESSAGE_BATCH_SIZE', 50))
+GMAIL_LABEL_UPDATE_BATCH_SIZE = int(os.environ.get('GMAIL_LABEL_UPDATE_BATCH_SIZE', 100))
+# Number of messages downloaded by a single first sync task.
+GMAIL_FIRST_SYNC_CHUNK_SIZE = int(os.environ.get('GMAIL_FIRST_SYNC_CHUNK_SIZE', 500))
+# Number of first sync tasks sent to the broker per tenant every scheduler run.
+GMAIL_FIRST_SYNC_TASKS_PER_TENANT = int(os.environ.get('GMAIL_FIRST_SYNC_TASKS_PER_TENANT', 10))
+# Max number of accounts scheduled for a sync every scheduler run, the most outdated accounts go first.
+GMAIL_SYNC_MAX_PER_RUN = int(os.environ.get('GMAIL_SYNC_MAX_PER_RUN', 200))
+# Max number of idle Gmail services cached per worker process and the seconds before they're rebuilt.
+GMAIL_SERVICE_CACHE_SIZE = int(os.environ.get('GMAIL_SERVICE_CACHE_SIZE', 50))
+GMAIL_SERVICE_CACHE_TIMEOUT = int(os.environ.get('GMAIL_SERVICE_CACHE_TIMEOUT', 1800))
+# Seconds to wait for more label changes of an account, before they're sent to Gmail together.
+GMAIL_LABEL_MUTATION_DELAY = int(os.environ.get('GMAIL_LABEL_MUTATION_DELAY', 5))
+# Seconds to wait for more changes to the threads of an account, before they're recalculated together.
+GMAIL_THREAD_UPDATE_DELAY = int(os.environ.get('GMAIL_THREAD_UPDATE_DELAY', 10))
+# Max number of history records processed by a single history sync.
+GMAIL_PARTIAL_SYNC_LIMIT = int(os.environ.get('GMAIL_PARTIAL_SYNC_LIMIT', 899))
+# Api calls per second per account shared by all workers, lowered on rate limit errors and recovering per second.
+GMAIL_RATE_LIMIT = float(os.environ.get('GMAIL_RATE_LIMIT', 25))
+GMAIL_RATE_LIMIT_MIN = float(os.environ.get('GMAIL_RATE_LIMIT_MIN', 1))
+GMAIL_RATE_LIMIT_BURST = int(os.environ.get('GMAIL_RATE_LIMIT_BURST', 50))
+GMAIL_RATE_LIMIT_RECOVERY = float(os.environ.get('GMAIL_RATE_LIMIT_RECOVERY', 0.5))
+# Pub/Sub topic Gmail publishes push notifications to, push notifications are disabled when it's empty.
+GMAIL_PUSH_TOPIC = os.environ.get('GMAIL_PUSH_TOPIC', '')
+# Secret token the Pub/Sub push subscription adds to the webhook url.
+GMAIL_PUSH_TOKEN = os.environ.get('GMAIL_PUSH_TOKEN', '')
+# Seconds between polls of an account that gets push notifications.
+GMAIL_PUSH_POLL_INTERVAL = int(os.environ.get('GMAIL_PUSH_POLL_INTERVAL', 900))
+# Only store the metadata of attachments during sync and download the files when they're requested.
+GMAIL_LAZY_ATTACHMENTS = boolean(os.environ.get('GMAIL_LAZY_ATTACHMENTS', 0))
+# Still download inline images during sync when attachments are downloaded on request.
+GMAIL_PREFETCH_INLINE_ATTACHMENTS = boolean(os.environ.get('GMAIL_PREFETCH_INLINE_ATTACHMENTS', 1))
+# Seconds a rendered html body of an email message is cached.
+EMAIL_BODY_CACHE_TIMEOUT = int(os.environ.get('EMAIL_BODY_CACHE_TIMEOUT', 7 * 24 * 60 * 60))
+# Render the html bodies of new messages during sync, instead of when they're opened for the first time.
+EMAIL_BODY_PRERENDER = boolean(os.environ.get('EMAIL_BODY_PRERENDER', 0))
+# Number of stored html bodies sanitized again per task, after the whitelists of the sanitizer changed.
+EMAIL_RESANITIZE_BATCH_SIZE = int(os.environ.get('EMAIL_RESANITIZE_BATCH_SIZE', 500))
+# Seconds before the file of a deleted attachment is deleted from the storage and the number of files per task.
+EMAIL_ATTACHMENT_DELETE_DELAY = int(os.environ.get('EMAIL_ATTACHMENT_DELETE_DELAY', 60 * 60))
+EMAIL_ATTACHMENT_DELETE_BATCH_SIZE = int(os.environ.get('EMAIL_ATTACHMENT_DELETE_BATCH_SIZE', 500))
+# Max bytes per chunk when streaming email attachments and the seconds browsers may cache them.
+EMAIL_ATTACHMENT_STREAM_CHUNK_SIZE = int(os.environ.get('EMAIL_ATTACHMENT_STREAM_CHUNK_SIZE', 64 * 1024))
+EMAIL_ATTACHMENT_MAX_AGE = int(os.environ.get('EMAIL_ATTACHMENT_MAX_AGE', 24 * 60 * 60))
+# Seconds a request waits for the download of an attachment by another request.
+EMAIL_ATTACHMENT_DOWNLOAD_TIMEOUT = int(os.environ.get('EMAIL_ATTACHMENT_DOWNLOAD_TIMEOUT', 60))
+# Redirect to a signed S3 url for email attachments instead of streaming them, valid for the given seconds.
+EMAIL_ATTACHMENT_SIGNED_URLS = boolean(os.environ.get('EMAIL_ATTACHMENT_SIGNED_URLS', 0))
+EMAIL_ATTACHMENT_SIGNED_URL_EXPIRE = int(os.environ.get('EMAIL_ATTACHMENT_SIGNED_URL_EXPIRE', 60))
+# Max number of compiled email templates cached per process and max number of recipients per bulk render.
+EMAIL_TEMPLATE_CACHE_SIZE = int(os.environ.get('EMAIL_TEMPLATE_CACHE_SIZE', 200))
+EMAIL_TEMPLATE_BULK_RENDER_LIMIT = int(os.environ.get('EMAIL_TEMPLATE_BULK_RENDER_LIMIT', 500))
 GMAIL_CALLBACK_URL = os.environ.get('GMAIL_CALLBACK_URL', 'http://localhost:8000/messaging/email/callback/')
 GMAIL_SYNC_DELAY_INTERVAL = 1
 GMAIL_SYNC_LOCK_LIFETIME = 300